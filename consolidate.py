@@ -1,8 +1,37 @@
-﻿import datetime
-import fnmatch
+﻿import argparse
+import codecs
+import datetime
+import difflib
+import hashlib
+import heapq
+import io
+import json
+import logging
+import math
+import mmap
 import os
 import re
-from typing import Dict, List, Set, Tuple
+import sqlite3
+import stat
+import threading
+import time
+import tokenize
+import zlib
+from collections import Counter, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+try:
+    import zstandard  # Optional: only needed for zstd-compressed output
+except ImportError:
+    zstandard = None
+
+from consolidate_cache import (CACHE_FORMAT_VERSION, DEFAULT_CACHE_PATH, IGNORE_INDEX_VERSION, RACY_MTIME_SECONDS,
+                               StripCache)
+from consolidate_git_index import GIT_INDEX_MODES, find_git_work_tree, git_hash_size, read_git_index
+from consolidate_output import COMPRESSION_SUFFIXES, OUTPUT_HEADER, OutputWriter, format_file_section
+from consolidate_symbols import SymbolIndex, symbol_index_path
+from consolidate_watch import ConsolidationWatcher
 
 """
 File Consolidation Script
@@ -18,6 +47,26 @@ Features:
 - Option to process child directories
 - Adds file path headers in the consolidated output
 - Option to enable/disable gitignore processing
+- Caches stripped file text between runs, so re-runs only re-process changed files
+- Git index fast path (--git-index): in git work trees, tracked files are read from .git/index (parsed directly,
+  no git needed) and only untracked files are found by walking; 'tracked' skips the walk altogether
+- Optional ignore index (--ignore-index): per-directory ignore decisions are cached too, and reused until a
+  .gitignore above the directory changes
+- Watch mode (--watch) that keeps the output up to date as files change
+- Non-interactive command line and importable consolidate() API for batch runs over many roots
+- Optional language-aware compaction (--compact): comments, Python docstrings, JSON minification, whitespace
+- Token or byte budgets (--budget): files are ranked by type, recency, size and depth; the most valuable are kept
+  whole and the rest are outlined, truncated or left out. Token estimates are cached per file
+- Deduplication (--dedup): repeated files become "(identical to ...)" references; --near-duplicates also
+  writes files similar to an earlier one (MinHash over word shingles) as a diff against it
+- Optional profiling (--profile): time per phase and counters as JSON or flamegraph folded stacks
+- Binary files are recognised from their first block and skipped; non-UTF-8 text falls back to cp1252/latin-1
+- Sharded (--shard-mb) and gzip/zstd-compressed (--compress) output with a JSON manifest of each file's
+  shard and byte offset, so tools can read one file without loading everything
+- Chunk export (--chunk-size): JSON Lines chunks with path, line range and content hash for retrieval pipelines,
+  cut at declarations and headings where possible; later runs only write new chunks and the ids of removed ones
+- Symbol index (--symbol-index): a SQLite sidecar mapping every identifier to the files, lines and byte offsets
+  where it occurs, written while the output streams; consolidate_query.py looks names up in it
 
 Usage:
 python consolidate_files.py
@@ -28,24 +77,267 @@ The script will prompt for:
 3. File extensions to include (default: common code file extensions)
 4. Whether to process child directories
 
+python consolidate_files.py DIR [DIR ...] [-e py ts md] [--child-dirs] [--no-gitignore] ...
+Runs without prompting (e.g. from CI); several directories are consolidated concurrently.
+See --help for all options. From Python: consolidate(["path/a", "path/b"], extensions=["py"]).
+
+python consolidate_files.py --watch
+Builds the output once, then rewrites it whenever files change (inotify on Linux, polling elsewhere).
+
 Customization:
-To add custom ignore patterns, modify the 'additional_ignore' string in the __main__ block.
+To add custom ignore patterns, modify the 'additional_ignore' string near the end of the script.
 These patterns will be applied in addition to those found in the .gitignore files.
 
 Dependencies:
 - Python 3.6+
-- No external libraries required
+- No external libraries required (zstandard is optional, for --compress zstd)
+- The consolidate_*.py modules next to this script: consolidate_git_index (reading .git/index), consolidate_cache
+  (StripCache), consolidate_output (OutputWriter), consolidate_symbols (SymbolIndex) and consolidate_watch (--watch)
 
 Notes:
 - Ensure you have read permissions for all directories and files you wish to consolidate.
 - The script creates a new file with a timestamp in its name to avoid overwriting existing files.
 - .gitignore files are processed hierarchically, with each file affecting only its directory and subdirectories.
+- Ignore rules follow git: negation (!), ** and escapes, with the last matching pattern winning and deeper
+  .gitignore files taking precedence. `consolidate_benchmark.py tree` checks this against git itself.
+- The cache lives in ~/.cache/consolidate/strip_cache.sqlite3 and can be deleted at any time. Entries unused for
+  30 days are pruned when it is opened.
+- Discovery makes about one stat per candidate file. --stat-workers overlaps those stats, which only pays off where
+  each one is slow (network mounts); `consolidate_benchmark.py syscalls` counts and times them.
+- Compaction changes the text the model sees (e.g. indentation is removed from brace languages); it is off by default.
 
 Author: Steve Biggs
 Last Modified: 2025.06.05
 Version: 3.0
 """
 
+# Progress goes through this logger: per-file detail (skipped files, loaded .gitignore files) at DEBUG,
+# stage summaries at INFO. main() sets the level from --log-level.
+logger = logging.getLogger("consolidate")
+
+
+# POSIX character classes allowed inside bracket expressions ("[[:digit:]]"), as regex set contents (ASCII, like git)
+_POSIX_CHARACTER_CLASSES = {
+    'alnum': 'A-Za-z0-9', 'alpha': 'A-Za-z', 'blank': ' \\t', 'cntrl': '\\x00-\\x1f\\x7f', 'digit': '0-9',
+    'graph': '!-~', 'lower': 'a-z', 'print': ' -~', 'punct': re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'),
+    'space': ' \\t\\n\\r\\f\\v', 'upper': 'A-Z', 'xdigit': '0-9A-Fa-f',
+}
+# Glob metacharacters of gitignore patterns; patterns without them are matched by plain set lookups.
+_GLOB_CHARS = re.compile(r'[*?\[]')
+# Like git with core.ignoreCase, match case-insensitively where the file system folds case (Windows).
+_CASE_INSENSITIVE = os.path.normcase('A') == 'a'
+
+
+def _gitignore_glob_to_regex(pattern: str) -> Tuple[str, Optional[str]]:
+    """Translate a gitignore glob into a regex matching a whole '/'-separated path.
+
+    Follows git's wildmatch: ``*``, ``?`` and ``[...]`` never match '/', a leading ``**/`` matches any number
+    of leading directories, a trailing ``/**`` everything inside, ``/**/`` zero or more directories, and
+    a backslash escapes the next character. Bracket expressions may hold POSIX classes such as ``[:upper:]``;
+    one with an unknown class never matches, as in git. Also returns the unescaped pattern when it has no wildcards,
+    so literal patterns can be matched by set lookups instead.
+    """
+    out = []
+    literal = []
+    has_wildcard = False
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            literal.append(pattern[i + 1])
+            i += 2
+            continue
+        if c == '*' and pattern.startswith('**', i):
+            at_start = i == 0 or pattern[i - 1] == '/'
+            at_end = i + 2 == n or pattern[i + 2] == '/'
+            if at_start and at_end:
+                has_wildcard = True
+                if i + 2 == n:
+                    # "a/**": everything inside a (or, on its own, everything)
+                    out.append('.*')
+                else:
+                    # "**/b" and "a/**/b": zero or more directories
+                    out.append('(?:.*/)?')
+                    i += 1
+                i += 2
+                continue
+        i += 1
+        if c == '*':
+            has_wildcard = True
+            while i < n and pattern[i] == '*':
+                i += 1
+            out.append('[^/]*')
+        elif c == '?':
+            has_wildcard = True
+            out.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                class_end = pattern.find(':]', j + 2) if pattern.startswith('[:', j) else -1
+                j = class_end + 2 if class_end >= 0 else j + (2 if pattern[j] == '\\' else 1)
+            if j >= n:
+                out.append('\\[')
+                literal.append('[')
+                continue
+            has_wildcard = True
+            negate = pattern[i] in '!^'
+            chars = []
+            valid = True
+            k = i + 1 if negate else i
+            while k < j:
+                class_end = pattern.find(':]', k + 2, j + 1) if pattern.startswith('[:', k) else -1
+                if class_end >= 0:
+                    class_name = pattern[k + 2:class_end]
+                    if class_name not in _POSIX_CHARACTER_CLASSES:
+                        logger.warning("Unknown character class [:%s:] in ignore pattern %r; it never matches",
+                                       class_name, pattern)
+                        valid = False
+                    chars.append(_POSIX_CHARACTER_CLASSES.get(class_name, ''))
+                    k = class_end + 2
+                    continue
+                if pattern[k] == '\\' and k + 1 < j:
+                    chars.append(re.escape(pattern[k + 1]))
+                    k += 2
+                    continue
+                chars.append('\\' + pattern[k] if pattern[k] in '[]\\^' else pattern[k])
+                k += 1
+            body = ''.join(chars)
+            # A bracket expression never matches '/'
+            if not valid:
+                out.append('(?!)')
+            else:
+                out.append(f"[^/{body}]" if negate else f"(?!/)[{body}]")
+            i = j + 1
+        else:
+            out.append(re.escape(c))
+            literal.append(c)
+    return ''.join(out), None if has_wildcard else ''.join(literal)
+
+
+def parse_gitignore_line(line: str) -> Optional[Tuple[str, bool, bool, bool]]:
+    """Split one .gitignore line into ``(pattern, negated, anchored, directory_only)``; None for blanks and comments.
+
+    As in git: '#' only starts a comment at the beginning of a line, trailing spaces are dropped unless
+    escaped, a leading '!' negates (``\!`` and ``\#`` are literal), a pattern with a slash anywhere but at
+    its end is relative to the .gitignore directory, and a trailing slash matches directories only.
+    """
+    line = line.rstrip('\n').rstrip('\r')
+    if not line or line.startswith('#'):
+        return None
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line) and not stripped.endswith('\\\\'):
+        stripped += ' '
+    line = stripped
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    directory_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    return line.lstrip('/') if anchored else line, negated, anchored, directory_only
+
+
+class _PatternGroup:
+    """Consecutive patterns of a .gitignore file that share their sign (ignore or re-include).
+
+    Within a group it does not matter which pattern matches, so literal patterns go into hash sets and
+    glob patterns are merged into one regex per kind.
+    """
+
+    def __init__(self, negated: bool):
+        self.negated = negated
+        self.names: Set[str] = set()  # "foo": an entry named foo at any depth
+        self.dir_names: Set[str] = set()  # "foo/": a directory named foo at any depth
+        self.paths: Set[str] = set()  # "/foo", "a/foo": exactly this relative path
+        self.dir_paths: Set[str] = set()  # "/foo/", "a/foo/": exactly this relative directory
+        self.globs: Dict[Tuple[bool, bool], List[str]] = {(anchored, directory_only): []
+                                                          for anchored in (False, True)
+                                                          for directory_only in (False, True)}
+        self.regexes: Dict[Tuple[bool, bool], 're.Pattern'] = {}
+
+    def add(self, pattern: str, anchored: bool, directory_only: bool):
+        regex, literal = _gitignore_glob_to_regex(pattern)
+        if literal is None:
+            self.globs[anchored, directory_only].append(regex)
+        elif anchored:
+            (self.dir_paths if directory_only else self.paths).add(literal)
+        else:
+            (self.dir_names if directory_only else self.names).add(literal)
+
+    def compile(self):
+        flags = re.DOTALL | (re.IGNORECASE if _CASE_INSENSITIVE else 0)
+        self.regexes = {kind: re.compile('(?:' + '|'.join(f'(?:{regex})' for regex in regexes) + r')\Z', flags)
+                        for kind, regexes in self.globs.items() if regexes}
+
+    def matches(self, rel_path: str, name: str, is_dir: bool) -> bool:
+        if name in self.names or rel_path in self.paths:
+            return True
+        if is_dir and (name in self.dir_names or rel_path in self.dir_paths):
+            return True
+        for (anchored, directory_only), regex in self.regexes.items():
+            if (is_dir or not directory_only) and regex.match(rel_path if anchored else name):
+                return True
+        return False
+
+
+class GitIgnorePatternSet:
+    """The patterns of a single .gitignore file, compiled once into a last-match-wins matcher.
+
+    Consecutive patterns with the same sign form a group (see _PatternGroup); checking the groups from last
+    to first, the first one that matches decides, which is git's "the last matching pattern wins" at the
+    cost of one group per change of sign instead of one check per pattern. A path is checked on its own:
+    callers check its parent directories first, because nothing inside an ignored directory can be
+    re-included.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.groups: List[_PatternGroup] = []
+        for line in patterns:
+            parsed = parse_gitignore_line(line)
+            if parsed is None:
+                continue
+            pattern, negated, anchored, directory_only = parsed
+            if _CASE_INSENSITIVE:
+                pattern = pattern.lower()
+            if not self.groups or self.groups[-1].negated != negated:
+                self.groups.append(_PatternGroup(negated))
+            self.groups[-1].add(pattern, anchored, directory_only)
+        for group in self.groups:
+            group.compile()
+
+    def __bool__(self) -> bool:
+        return bool(self.groups)
+
+    def decide(self, rel_path: str, is_dir: bool) -> Optional[bool]:
+        """True if the last pattern matching ``rel_path`` ignores it, False if it re-includes it, None if none
+        match. ``rel_path`` is '/'-separated and relative to the .gitignore directory."""
+        if not rel_path or rel_path == '.':
+            return None
+        if _CASE_INSENSITIVE:
+            rel_path = rel_path.lower()
+        name = rel_path.rpartition('/')[2]
+        for group in reversed(self.groups):
+            if group.matches(rel_path, name, is_dir):
+                return not group.negated
+        return None
+
+    def matches(self, rel_path: str, is_dir: bool) -> bool:
+        """Check whether this file's patterns ignore ``rel_path`` itself (its parent directories aside)."""
+        return self.decide(rel_path, is_dir) is True
+
+
+# Pattern sets active inside a directory, each paired with that directory's path relative to
+# the set's base directory ('' at the base itself, otherwise ending in '/').
+IgnoreLayers = Tuple[Tuple[GitIgnorePatternSet, str], ...]
+
 
 class GitIgnoreManager:
     """Manages gitignore patterns hierarchically throughout the directory structure."""
@@ -53,41 +345,54 @@ class GitIgnoreManager:
     def __init__(self, root_directory: str, respect_gitignore: bool = True):
         self.root_directory = os.path.abspath(root_directory)
         self.respect_gitignore = respect_gitignore
-        # Dictionary mapping directory paths to their gitignore patterns
-        self.gitignore_patterns_by_dir: Dict[str, List[str]] = {}
+        # Dictionary mapping directory paths to their compiled gitignore patterns (None: no usable .gitignore).
+        # Filled lazily as directories are visited, so ignored subtrees are never scanned for .gitignore files.
+        self.gitignore_patterns_by_dir: Dict[str, Optional[GitIgnorePatternSet]] = {}
         # Cache for pattern matching results
         self._match_cache: Dict[Tuple[str, str], bool] = {}
+        # Layers active inside each directory should_ignore has visited (None: the directory is ignored)
+        self._directory_layers_cache: Dict[str, Optional[IgnoreLayers]] = {}
+
+    def patterns_for_directory(self, directory: str, has_gitignore: Optional[bool] = None
+                               ) -> Optional[GitIgnorePatternSet]:
+        """Return the compiled patterns of ``directory``'s own .gitignore, loading it on first use.
+
+        ``has_gitignore`` lets a caller that has already listed the directory skip the existence check.
+        """
+        if directory in self.gitignore_patterns_by_dir:
+            return self.gitignore_patterns_by_dir[directory]
+
+        patterns = None
+        gitignore_path = os.path.join(directory, '.gitignore')
+        if has_gitignore or (has_gitignore is None and os.path.isfile(gitignore_path)):
+            patterns = GitIgnorePatternSet(self._read_gitignore_file(gitignore_path)) or None
+            if patterns is not None:
+                logger.debug("Loaded .gitignore from: %s", os.path.relpath(directory, self.root_directory))
+        self.gitignore_patterns_by_dir[directory] = patterns
+        return patterns
 
-        if self.respect_gitignore:
-            self._load_all_gitignore_files()
-
-    def _load_all_gitignore_files(self):
-        """Load all .gitignore files in the directory tree."""
-        for root, dirs, files in os.walk(self.root_directory):
-            if '.gitignore' in files:
-                gitignore_path = os.path.join(root, '.gitignore')
-                patterns = self._read_gitignore_file(gitignore_path)
-                if patterns:
-                    self.gitignore_patterns_by_dir[root] = patterns
-                    print(f"Loaded .gitignore from: {os.path.relpath(root, self.root_directory)}")
+    def forget_directory(self, directory: str):
+        """Drop ``directory``'s cached patterns (e.g. after its .gitignore changed) so they are reloaded."""
+        self.gitignore_patterns_by_dir.pop(directory, None)
+        self._match_cache.clear()
+        self._directory_layers_cache.clear()
 
     @staticmethod
     def _read_gitignore_file(gitignore_path: str) -> List[str]:
-        """Read patterns from a single .gitignore file."""
-        patterns = []
+        """Read the lines of a single .gitignore file; GitIgnorePatternSet parses them."""
         try:
-            with open(gitignore_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    # Remove inline comments and strip whitespace
-                    line = line.split('#')[0].strip()
-                    if line and not line.startswith('!'):  # Skip empty lines and negation patterns
-                        patterns.append(line)
+            with open(gitignore_path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+                return f.read().splitlines()
         except IOError as e:
-            print(f"Warning: Error reading .gitignore file {gitignore_path}: {e}")
-        return patterns
+            logger.warning("Error reading .gitignore file %s: %s", gitignore_path, e)
+            return []
+
+    def should_ignore(self, path: str, is_dir: Optional[bool] = None) -> bool:
+        """Check if a path should be ignored: it, or one of its parent directories, is ignored by the .gitignore
+        files from the root down (like git, nothing inside an ignored directory can be re-included).
 
-    def should_ignore(self, path: str) -> bool:
-        """Check if a path should be ignored based on gitignore patterns."""
+        Callers that already know whether ``path`` is a directory pass ``is_dir`` to save a stat.
+        """
         if not self.respect_gitignore:
             return False
 
@@ -97,175 +402,1097 @@ class GitIgnoreManager:
         if cache_key in self._match_cache:
             return self._match_cache[cache_key]
 
-        current_dir = os.path.dirname(abs_path)
-        # If checking a directory, use its own path for gitignore hierarchy.
-        # If checking a file, start from its parent.
-        # For consistency with how gitignore applies to contents of a dir,
-        # if abs_path is a dir, its patterns apply from its own .gitignore.
-        # If abs_path is a file, patterns apply from parent .gitignores.
-
-        # The loop should check .gitignore files from the item's directory upwards for files,
-        # and from the item's parent directory upwards for directories (as git usually does).
-        # However, current logic checks from os.path.dirname(abs_path) upwards.
-        # For a file `root/a/b/file.txt`, current_dir starts at `root/a/b`.
-        # For a dir `root/a/b/`, current_dir starts at `root/a/b`.
-        # This seems okay. A .gitignore in `root/a/b/` applies to `root/a/b/file.txt`
-        # and also to `root/a/b/` itself (e.g. if it contains `/b/`).
-
-        path_to_check_against_gitignore = abs_path
-
-        # Iterate from the directory containing the item, up to the root_directory
-        # For an item /a/b/c.txt, current_dir_iter starts at /a/b
-        # For an item /a/b/d/ (a dir), current_dir_iter starts at /a/b/d
-
-        # Let's adjust current_dir_iter to be the directory where the .gitignore would be located
-        # For a file /foo/bar/baz.txt, we check .gitignores in /foo/bar, /foo, /
-        # For a directory /foo/bar/baz/, we check .gitignores in /foo/bar/baz, /foo/bar, /foo, /
-
-        dir_of_item = os.path.dirname(path_to_check_against_gitignore)
-        if os.path.isdir(path_to_check_against_gitignore):
-            # If path_to_check_against_gitignore is a directory, start search for .gitignore in this directory itself
-            current_dir_iter = path_to_check_against_gitignore
+        parent, name = os.path.split(abs_path)
+        if abs_path == self.root_directory or not abs_path.startswith(self.root_directory + os.sep):
+            ignored = False
         else:
-            # If it's a file, start search for .gitignore in its parent directory
-            current_dir_iter = dir_of_item
-
-        while current_dir_iter.startswith(self.root_directory) and len(current_dir_iter) >= len(self.root_directory):
-            if current_dir_iter in self.gitignore_patterns_by_dir:
-                rel_path = os.path.relpath(path_to_check_against_gitignore, current_dir_iter)
-                # Pass abs_path (the absolute path of the item being checked) to _matches_patterns
-                if self._matches_patterns(rel_path, self.gitignore_patterns_by_dir[current_dir_iter], abs_path):
-                    self._match_cache[cache_key] = True
-                    return True
-
-            if current_dir_iter == self.root_directory:  # Stop if we are at the root and have checked it
-                break
-
-            parent = os.path.dirname(current_dir_iter)
-            if parent == current_dir_iter:  # Reached filesystem root or an unresolvable state
-                break
-            current_dir_iter = parent
-
-        self._match_cache[cache_key] = False
-        return False
+            layers = self._directory_layers(parent)
+            ignored = layers is None or self.matches_layers(layers, name,
+                                                            os.path.isdir(abs_path) if is_dir is None else is_dir)
+        self._match_cache[cache_key] = ignored
+        return ignored
+
+    def _directory_layers(self, directory: str) -> Optional[IgnoreLayers]:
+        """The layers that apply inside ``directory`` (below the root), or None if the directory is ignored."""
+        if directory in self._directory_layers_cache:
+            return self._directory_layers_cache[directory]
+        if directory == self.root_directory:
+            layers = self.add_directory_layer((), directory, None)
+        else:
+            parent, name = os.path.split(directory)
+            parent_layers = self._directory_layers(parent)
+            if parent_layers is None or self.matches_layers(parent_layers, name, True):
+                layers = None
+            else:
+                layers = self.add_directory_layer(self.shift_layers(parent_layers, name), directory, None)
+        self._directory_layers_cache[directory] = layers
+        return layers
+
+    def layers_for_directory(self, directory: str, top_directory: Optional[str] = None) -> IgnoreLayers:
+        """Collect the pattern sets that apply inside ``directory``, from ``top_directory`` (default: the root)
+        downwards."""
+        if not self.respect_gitignore:
+            return ()
+        directory = os.path.abspath(directory)
+        top_directory = os.path.abspath(top_directory) if top_directory else self.root_directory
+        if directory == top_directory or directory.startswith(top_directory + os.sep):
+            rel_parts = os.path.relpath(directory, top_directory).split(os.sep)
+            if rel_parts == ['.']:
+                rel_parts = []
+            current_dir = top_directory
+        else:
+            rel_parts = []
+            current_dir = directory
+
+        layers = []
+        for depth in range(len(rel_parts) + 1):
+            if depth:
+                current_dir = os.path.join(current_dir, rel_parts[depth - 1])
+            patterns = self.patterns_for_directory(current_dir)
+            if patterns is not None:
+                prefix = '/'.join(rel_parts[depth:])
+                layers.append((patterns, prefix + '/' if prefix else ''))
+        return tuple(layers)
+
+    @staticmethod
+    def shift_layers(layers: IgnoreLayers, child_name: str) -> IgnoreLayers:
+        """Re-express a directory's layers relative to one of its child directories."""
+        return tuple((patterns, f"{prefix}{child_name}/") for patterns, prefix in layers)
+
+    def add_directory_layer(self, inherited_layers: IgnoreLayers, directory: str,
+                            has_gitignore: Optional[bool]) -> IgnoreLayers:
+        """Append ``directory``'s own .gitignore (if any) to the layers inherited from its parent.
+
+        ``has_gitignore`` is None when the caller has not listed the directory, to check for the file here.
+        """
+        if not self.respect_gitignore or has_gitignore is False:
+            return inherited_layers
+        patterns = self.patterns_for_directory(directory, has_gitignore)
+        return inherited_layers + ((patterns, ''),) if patterns is not None else inherited_layers
 
     @staticmethod
-    def _matches_patterns(rel_path: str, patterns: List[str], item_abs_path: str) -> bool:
-        """Check if a relative path matches any of the given patterns."""
-        # Normalize rel_path to use forward slashes for matching.
-        normalized_rel_path = rel_path.replace(os.sep, '/')
-        if not normalized_rel_path:
-            pass
-
-        path_parts = normalized_rel_path.split('/')
-
-        for pattern_str in patterns:
-            processed_pattern = pattern_str.strip()
-            if not processed_pattern or processed_pattern.startswith('#'):
+    def matches_layers(layers: IgnoreLayers, name: str, is_dir: bool) -> bool:
+        """Check an entry of the directory that ``layers`` belong to against every active pattern set.
+
+        Deeper .gitignore files take precedence, so the layers are asked from the last one up; the first
+        with a matching pattern decides, and an entry no pattern matches is not ignored.
+        """
+        for patterns, prefix in reversed(layers):
+            decision = patterns.decide(prefix + name, is_dir)
+            if decision is not None:
+                return decision
+        return False
+
+
+# Default pool sizes: reads are I/O-bound, stripping is CPU-bound and runs in worker processes
+DEFAULT_READ_WORKERS = 8
+DEFAULT_STRIP_WORKERS = os.cpu_count() or 1
+# Below this much text, starting worker processes costs more than stripping on one core
+PARALLEL_STRIP_MIN_CHARS = 1024 * 1024
+
+
+class TextStripper:
+    """Single-pass stripping engine: removes copyright block comments, import lines and blank lines.
+
+    A hand-written scan over the text, line by line, so the cost stays linear in the length of the file
+    (regex passes such as ``/\*.*?copyright.*?\*/`` rescan to the end of the file from every ``/*`` that
+    is not a copyright block). Only a complete ``/* ... */`` block mentioning the marker is removed; other
+    comments and the code around them stay. Instances are small picklable callables, so worker processes
+    can run them; FileHandler picks one per file extension.
+    """
+
+    def __init__(self, strip_copyright_blocks: bool = True, strip_imports: bool = True,
+                 strip_blank_lines: bool = True, copyright_marker: str = 'copyright'):
+        self.strip_copyright_blocks = strip_copyright_blocks
+        self.strip_imports = strip_imports
+        self.strip_blank_lines = strip_blank_lines
+        self.copyright_marker = copyright_marker.lower()
+
+    def __repr__(self) -> str:
+        # Also serves as the cache signature of this configuration
+        return (f"{type(self).__name__}(strip_copyright_blocks={self.strip_copyright_blocks}, "
+                f"strip_imports={self.strip_imports}, strip_blank_lines={self.strip_blank_lines}, "
+                f"copyright_marker={self.copyright_marker!r})")
+
+    def __call__(self, text: str) -> str:
+        has_final_newline = text.endswith('\n')
+        lines: Iterable[str] = (text[:-1] if has_final_newline else text).split('\n')
+        if self.strip_copyright_blocks:
+            lines = self._without_copyright_comments(lines)
+
+        kept = []
+        for line in lines:
+            if self.strip_imports and self._is_import(line):
+                continue
+            if self.strip_blank_lines and not line.strip():
                 continue
+            kept.append(line)
 
-            if processed_pattern.startswith('/'):
-                anchor_pattern_segment = processed_pattern[1:]
-                if not anchor_pattern_segment:
-                    continue
+        if not kept:
+            return ''
+        return '\n'.join(kept) + ('\n' if has_final_newline else '')
 
-                if anchor_pattern_segment.endswith('/'):
-                    dir_name = anchor_pattern_segment[:-1]
-                    if not dir_name:
-                        continue
-                    if fnmatch.fnmatch(normalized_rel_path, dir_name) or \
-                            fnmatch.fnmatch(normalized_rel_path, dir_name + '/*'):
-                        return True
-                else:
-                    if fnmatch.fnmatch(normalized_rel_path, anchor_pattern_segment):
-                        return True
-            elif processed_pattern.endswith('/'):
-                dir_pattern_base = processed_pattern[:-1]
-                if not dir_pattern_base:
-                    continue
+    @staticmethod
+    def _is_import(line: str) -> bool:
+        stripped = line.lstrip()
+        return stripped.startswith('import') and (len(stripped) == 6 or stripped[6].isspace())
+
+    def _without_copyright_comments(self, lines: Iterable[str]) -> Iterator[str]:
+        """Yield the lines with every ``/* ... */`` block that mentions the copyright marker cut out."""
+        held: Optional[List[str]] = None  # comment text of an open block, one entry per line so far
+        held_prefix = ''  # code on the line where the open block started, before the ``/*``
+        for line in lines:
+            if held is None and '/*' not in line:
+                yield line
+                continue
 
-                # Check if the item itself is a directory and its name matches,
-                # or if the path starts with dir_pattern_base/
-                # or if dir_pattern_base is one of the directory components in the path.
-                is_item_a_dir = os.path.isdir(item_abs_path)
-
-                # Case 1: Pattern "foo/", path "foo" (and foo is a directory)
-                if normalized_rel_path == dir_pattern_base and is_item_a_dir:
-                    return True
-                # Case 2: Pattern "foo/", path "foo/bar.txt" or "a/foo/bar.txt"
-                if normalized_rel_path.startswith(dir_pattern_base + '/') or \
-                        any(p == dir_pattern_base and (
-                                i < len(path_parts) - 1 or (i == len(path_parts) - 1 and is_item_a_dir)) for i, p in
-                            enumerate(path_parts)):
-                    # If 'dir_pattern_base' is a component and it represents a directory in the path structure
-                    # This part ensures that if 'foo/' is the pattern, 'foo' must be a directory.
-                    # We check if 'item_abs_path' is a directory if 'dir_pattern_base' is the last part.
-                    # Or if 'dir_pattern_base' is an intermediate part, it's implicitly a directory.
-
-                    # A simpler interpretation for "dir/" is that it matches a directory "dir" anywhere.
-                    # If any part of the path matches 'dir_pattern_base' and that part represents a directory.
-                    # fnmatch can check against components.
-                    # If path is 'a/b/c' and pattern is 'b/', then 'b' component must be a dir.
-                    # The check `os.path.isdir(item_abs_path)` is crucial if `dir_pattern_base` is the last component of `normalized_rel_path`.
-
-                    # Refined logic for 'dir_pattern_base/'
-                    # It matches if 'dir_pattern_base' is a name of a directory in 'normalized_rel_path'.
-                    # 1. Path is exactly 'dir_pattern_base' and item_abs_path is a directory.
-                    if path_parts[-1] == dir_pattern_base and is_item_a_dir and len(
-                            path_parts) == 1:  # e.g. path "foo", pattern "foo/"
-                        if fnmatch.fnmatch(path_parts[-1],
-                                           dir_pattern_base):  # Redundant if path_parts[-1] == dir_pattern_base
-                            return True
-                    # 2. Path is '.../dir_pattern_base' and item_abs_path is a directory (matching the end)
-                    if path_parts[-1] == dir_pattern_base and is_item_a_dir:
-                        # Check if any segment matches, and if it's the last segment, ensure it's a dir
-                        if fnmatch.fnmatch(path_parts[-1], dir_pattern_base):
-                            return True
-                    # 3. Path is '.../dir_pattern_base/...' (matching an intermediate directory)
-                    #    or path starts with 'dir_pattern_base/...'
-                    if normalized_rel_path.startswith(dir_pattern_base + '/') or \
-                            any(p == dir_pattern_base for p in path_parts[:-1]):  # Check intermediate parts
-                        if fnmatch.fnmatch(normalized_rel_path, dir_pattern_base + '/*') or \
-                                fnmatch.fnmatch(normalized_rel_path, '*/' + dir_pattern_base + '/*'):
-                            return True
-                    # Fallback to original broader logic if specific checks didn't catch it,
-                    # ensuring 'dir_pattern_base' matches a directory component.
-                    if any(fnmatch.fnmatch(part, dir_pattern_base) for part in path_parts):
-                        # This is true if 'dir_pattern_base' matches any segment.
-                        # We need to ensure this segment corresponds to a directory.
-                        # If 'item_abs_path' is '.../dir_pattern_base/file.txt', then 'dir_pattern_base' is a dir.
-                        # If 'item_abs_path' is '.../dir_pattern_base' and it's a dir, it matches.
-                        # This check is complex to get 100% git-compatible.
-                        # A common behavior: "foo/" matches a directory "foo" and everything under it.
-                        # If `normalized_rel_path` is "foo" and `item_abs_path` is a dir, it matches.
-                        # If `normalized_rel_path` is "foo/bar", it matches.
-                        # If `normalized_rel_path` is "baz/foo/bar", it matches.
-                        if (normalized_rel_path == dir_pattern_base and os.path.isdir(item_abs_path)) or \
-                                normalized_rel_path.startswith(dir_pattern_base + '/') or \
-                                (('/' + dir_pattern_base + '/') in ('/' + normalized_rel_path + '/')):
-                            return True
-
-
-            elif '/' in processed_pattern:
-                if fnmatch.fnmatch(normalized_rel_path, processed_pattern):
-                    return True
+            out: Optional[str] = ''
+            pos = 0
+            comment_from = 0
+            while True:
+                if held is None:
+                    start = line.find('/*', pos)
+                    if start < 0:
+                        out += line[pos:]
+                        break
+                    out += line[pos:start]
+                    held_prefix, held = out, []
+                    comment_from, pos = start, start + 2
+
+                end = line.find('*/', pos)
+                if end < 0:
+                    held.append(line[comment_from:])
+                    out = None
+                    break
+                end += 2
+
+                comment = '\n'.join(held) + '\n' + line[comment_from:end] if held else line[comment_from:end]
+                if self.copyright_marker in comment.lower():
+                    out = held_prefix
+                elif held:
+                    # Not a copyright block: give back the lines it spanned untouched
+                    yield held_prefix + held[0]
+                    yield from held[1:]
+                    out = line[:end]
+                else:
+                    out = held_prefix + line[comment_from:end]
+                held = None
+                pos = end
+
+            if out is not None:
+                yield out
+
+        if held:
+            # Unterminated comment: keep it
+            yield held_prefix + held[0]
+            yield from held[1:]
+
+
+# Compaction passes, in the order they run (the base TextStripper runs between "json" and "whitespace")
+COMPACTION_PASSES = ('comments', 'docstrings', 'json', 'whitespace')
+# Languages the compaction passes understand; extensions not listed here only get the whitespace pass
+LANGUAGE_BY_EXTENSION = {
+    'py': 'python',
+    'c': 'c_family', 'h': 'c_family', 'cpp': 'c_family', 'hpp': 'c_family', 'cc': 'c_family', 'hh': 'c_family',
+    'cs': 'c_family', 'java': 'c_family', 'js': 'c_family', 'mjs': 'c_family', 'jsx': 'c_family',
+    'ts': 'c_family', 'tsx': 'c_family', 'idl': 'c_family', 'proto': 'c_family', 'thrift': 'c_family',
+    'css': 'css',
+    'html': 'markup', 'xml': 'markup',
+    'json': 'json',
+}
+# Languages whose structure is carried by braces or tags, so indentation can go as well
+_INDENTATION_FREE_LANGUAGES = ('c_family', 'css', 'markup', 'json')
+
+# Strings are matched so that comment markers inside them are left alone; verbatim strings are C#'s @"..."
+# A '/' after an operator, an opening bracket or a keyword like return starts a JS/TS regex literal, kept with
+# that prefix. Division read as a regex only keeps a comment; a regex read as a comment would delete code.
+_C_FAMILY_TOKENS = re.compile(r"""
+    (?P<string>@"(?:[^"]|"")*"|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)
+    |(?P<regex>(?:[(,=:\[!&|?{};~+\-*%<>^]|\b(?:return|typeof|instanceof|in|of|case|delete|void|throw|new|
+                                                 yield|await|do|else))
+               [ \t]*/(?![/*])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/)
+    |(?P<comment>//[^\n]*|/\*.*?\*/)
+""", re.VERBOSE | re.DOTALL)
+_CSS_TOKENS = re.compile(r"""
+    (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    |(?P<comment>/\*.*?\*/)
+""", re.VERBOSE | re.DOTALL)
+_MARKUP_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+_JSON_TOKENS = re.compile(r'(?P<string>"(?:\\.|[^"\\])*")|\s+')
+
+
+def _drop_comment_tokens(match) -> str:
+    comment = match.group('comment')
+    if comment is None:
+        return match.group()
+    # An inline block comment may separate two tokens; keep them apart
+    return ' ' if comment.startswith('/*') and '\n' not in comment else ''
+
+
+def _strip_python(text: str, comments: bool, docstrings: bool) -> str:
+    """Remove comments and/or bare string statements (docstrings) from Python source using tokenize.
+
+    A docstring that is the only statement of its block becomes ``...`` so the block stays valid.
+    Source that does not tokenize is returned unchanged.
+    """
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+    except (tokenize.TokenError, SyntaxError):
+        return text
+
+    line_offsets = [0]
+    newline = text.find('\n')
+    while newline >= 0:
+        line_offsets.append(newline + 1)
+        newline = text.find('\n', newline + 1)
+
+    def offset(position: Tuple[int, int]) -> int:
+        return line_offsets[position[0] - 1] + position[1]
+
+    def next_significant(index: int) -> int:
+        while tokens[index].type in (tokenize.NL, tokenize.COMMENT):
+            index += 1
+        return tokens[index].type
+
+    cuts: List[Tuple[int, int, str]] = []
+    previous_type = tokenize.NEWLINE
+    for index, token in enumerate(tokens):
+        if token.type == tokenize.COMMENT:
+            if comments:
+                cuts.append((offset(token.start), offset(token.end), ''))
+            continue
+        if token.type == tokenize.NL:
+            continue
+        if (docstrings and token.type == tokenize.STRING and
+                previous_type in (tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT) and
+                next_significant(index + 1) in (tokenize.NEWLINE, tokenize.ENDMARKER)):
+            # A string statement on its own: find what follows the statement to see if the block would empty
+            after = index + 1
+            while tokens[after].type != tokenize.NEWLINE and tokens[after].type != tokenize.ENDMARKER:
+                after += 1
+            only_statement = (previous_type == tokenize.INDENT and
+                              next_significant(min(after + 1, len(tokens) - 1)) in (tokenize.DEDENT,
+                                                                                    tokenize.ENDMARKER))
+            cuts.append((offset(token.start), offset(token.end), '...' if only_statement else ''))
+        previous_type = token.type
+
+    if not cuts:
+        return text
+    pieces = []
+    position = 0
+    for start, end, replacement in cuts:
+        pieces.append(text[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+
+def _strip_comments(language: str, text: str) -> str:
+    if language == 'python':
+        return _strip_python(text, comments=True, docstrings=False)
+    if language == 'c_family':
+        return _C_FAMILY_TOKENS.sub(_drop_comment_tokens, text)
+    if language == 'css':
+        return _CSS_TOKENS.sub(_drop_comment_tokens, text)
+    if language == 'markup':
+        return _MARKUP_COMMENT.sub('', text)
+    return text
+
+
+def _minify_json(text: str) -> str:
+    """Remove the whitespace between JSON tokens, keeping every token (duplicate keys, number spellings) as written.
+
+    Anything that does not parse (e.g. JSONC, whose comments need their line breaks) is left alone.
+    """
+    try:
+        json.loads(text)
+    except ValueError:
+        return text
+    return _JSON_TOKENS.sub(lambda match: match.group('string') or '', text) + '\n'
+
+
+def _collapse_whitespace(text: str, strip_indentation: bool) -> str:
+    if strip_indentation:
+        return '\n'.join(line.strip() for line in text.split('\n'))
+    return '\n'.join(line.rstrip() for line in text.split('\n'))
+
+
+def _utf8_size(text: str) -> int:
+    return len(text.encode('utf-8', 'surrogatepass'))
+
+
+class CompactingStripper(TextStripper):
+    """A TextStripper preceded and followed by language-aware compaction passes.
+
+    ``passes`` picks from COMPACTION_PASSES: comment removal (Python, C-family incl. TS/C#/C++, CSS,
+    HTML/XML), Python docstring removal, JSON minification and whitespace collapsing (trailing
+    whitespace everywhere, indentation too where braces or tags carry the structure). ``strip_with_stats``
+    also reports the UTF-8 bytes going in and out of every pass, the base strip included.
+    """
+
+    def __init__(self, language: str, passes: Iterable[str], **kwargs):
+        super().__init__(**kwargs)
+        self.language = language
+        passes = set(passes)
+        self.passes = tuple(name for name in COMPACTION_PASSES if name in passes)
+
+    def __repr__(self) -> str:
+        return f"{super().__repr__()[:-1]}, language={self.language!r}, passes={self.passes!r})"
+
+    def _pass_functions(self) -> List[Tuple[str, Callable[[str], str]]]:
+        functions: List[Tuple[str, Callable[[str], str]]] = []
+        if 'comments' in self.passes and self.language in ('python', 'c_family', 'css', 'markup'):
+            functions.append(('comments', lambda text: _strip_comments(self.language, text)))
+        if 'docstrings' in self.passes and self.language == 'python':
+            functions.append(('docstrings', lambda text: _strip_python(text, comments=False, docstrings=True)))
+        if 'json' in self.passes and self.language == 'json':
+            functions.append(('json', _minify_json))
+        functions.append(('strip', super().__call__))
+        if 'whitespace' in self.passes:
+            strip_indentation = self.language in _INDENTATION_FREE_LANGUAGES
+            functions.append(('whitespace', lambda text: _collapse_whitespace(text, strip_indentation)))
+        return functions
+
+    def strip_with_stats(self, text: str) -> Tuple[str, Dict[str, Tuple[int, int]]]:
+        stats = {}
+        size = _utf8_size(text)
+        for name, function in self._pass_functions():
+            text = function(text)
+            new_size = _utf8_size(text)
+            stats[name] = (size, new_size)
+            size = new_size
+        return text, stats
+
+    def __call__(self, text: str) -> str:
+        return self.strip_with_stats(text)[0]
+
+
+def build_compacting_strippers(passes: Iterable[str]) -> Tuple[CompactingStripper, Dict[str, CompactingStripper]]:
+    """Create the default stripper and the per-extension strippers for a set of compaction passes."""
+    passes = set(passes)
+    if 'all' in passes:
+        passes = set(COMPACTION_PASSES)
+    unknown = passes - set(COMPACTION_PASSES)
+    if unknown:
+        raise ValueError(f"Unknown compaction passes: {', '.join(sorted(unknown))}")
+    strippers_by_language = {language: CompactingStripper(language, passes)
+                             for language in set(LANGUAGE_BY_EXTENSION.values())}
+    return (CompactingStripper('text', passes),
+            {extension: strippers_by_language[language] for extension, language in LANGUAGE_BY_EXTENSION.items()})
+
+
+def run_stripper(stripper: Callable[[str], str], text: str) -> Tuple[str, Optional[Dict[str, Tuple[int, int]]]]:
+    """Strip one text, with per-pass byte counts when the stripper reports them (runs in worker processes)."""
+    strip_with_stats = getattr(stripper, 'strip_with_stats', None)
+    if strip_with_stats is None:
+        return stripper(text), None
+    return strip_with_stats(text)
+
+
+def report_compaction(stats: Dict[str, List[int]]):
+    """Print the bytes going in and out of every compaction pass."""
+    for name in COMPACTION_PASSES[:3] + ('strip',) + COMPACTION_PASSES[3:]:
+        if name not in stats:
+            continue
+        bytes_in, bytes_out = stats[name]
+        change = (bytes_out - bytes_in) / bytes_in * 100 if bytes_in else 0.0
+        logger.info("Compaction %s: %.1f KB -> %.1f KB (%+.1f%%)", name, bytes_in / 1024, bytes_out / 1024, change)
+
+
+def report_stage(stage: str, file_count: int, char_count: int, seconds: float):
+    """Print the throughput of one pipeline stage."""
+    seconds = max(seconds, 1e-6)
+    if not char_count:
+        logger.info("%s: %s files in %.2fs (%.0f files/s)", stage, file_count, seconds, file_count / seconds)
+        return
+    megabytes = char_count / (1024 * 1024)
+    logger.info("%s: %s files, %.2f MB in %.2fs (%.2f MB/s, %.0f files/s)",
+                stage, file_count, megabytes, seconds, megabytes / seconds, file_count / seconds)
+
+
+def ordered_map(executor: Executor, fn: Callable, items: Iterable, window: int) -> Iterator[Tuple[object, object]]:
+    """Yield ``(item, fn(item))`` in input order, keeping at most ``window`` calls in flight on ``executor``."""
+    in_flight: Deque[Tuple[object, Future]] = deque()
+    for item in items:
+        in_flight.append((item, executor.submit(fn, item)))
+        if len(in_flight) >= window:
+            done_item, future = in_flight.popleft()
+            yield done_item, future.result()
+    while in_flight:
+        done_item, future = in_flight.popleft()
+        yield done_item, future.result()
+
+
+class StageStats:
+    """File count, text volume and time of one stage of the streaming pipeline.
+
+    Stages pull from each other, so the time measured around a stage includes its upstream stages;
+    ``seconds`` subtracts the upstream stage to get the time spent in this stage alone.
+    """
+
+    def __init__(self, name: str, upstream: Optional['StageStats'] = None):
+        self.name = name
+        self.upstream = upstream
+        self.files = 0
+        self.chars = 0
+        self.inclusive_seconds = 0.0
+
+    def add(self, text: Optional[str] = None):
+        self.files += 1
+        if text is not None:
+            self.chars += len(text)
+
+    def track(self, items: Iterable, measure: Optional[Callable] = lambda item: item.text) -> Iterator:
+        """Pass ``items`` through, counting each one and timing how long producing it took."""
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.inclusive_seconds += time.perf_counter() - start
+                return
+            self.inclusive_seconds += time.perf_counter() - start
+            self.add(measure(item) if measure is not None else None)
+            yield item
+
+    @property
+    def seconds(self) -> float:
+        upstream_seconds = self.upstream.inclusive_seconds if self.upstream is not None else 0.0
+        return max(0.0, self.inclusive_seconds - upstream_seconds)
+
+
+class PipelineStats:
+    """The chain of stages of one run, each stage reading from the one created before it."""
+
+    def __init__(self):
+        self.stages: List[StageStats] = []
+
+    def stage(self, name: str) -> StageStats:
+        stage = StageStats(name, self.stages[-1] if self.stages else None)
+        self.stages.append(stage)
+        return stage
+
+    def find(self, name: str) -> Optional[StageStats]:
+        """The stage called ``name``, or None if the run did not get as far as creating it."""
+        return next((stage for stage in self.stages if stage.name == name), None)
+
+    def report(self):
+        for stage in self.stages:
+            report_stage(stage.name, stage.files, stage.chars, stage.seconds)
+
+
+class DirectoryProgress:
+    """Progress of a run over many directories: a line as each one finishes, then a summary with the slowest."""
+
+    def __init__(self, total: int):
+        self.total = total
+        # (directory, files written, characters written, seconds, output path, error)
+        self.rows: List[Tuple[str, int, int, float, Optional[str], Optional[str]]] = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def finish(self, directory: str, pipeline: PipelineStats, seconds: float, output_path: Optional[str],
+               error: Optional[BaseException] = None):
+        # A directory that failed early has no Write stage: nothing was written
+        written = pipeline.find("Write") or StageStats("Write")
+        with self._lock:
+            self.rows.append((directory, written.files, written.chars, seconds, output_path,
+                              str(error) if error is not None else None))
+            done = len(self.rows)
+        if error is not None:
+            logger.error("[%s/%s] %s failed after %.2fs: %s", done, self.total, directory, seconds, error)
+        else:
+            logger.info("[%s/%s] %s: %s files, %.2f MB in %.2fs", done, self.total, directory, written.files,
+                        written.chars / (1024 * 1024), seconds)
+
+    def report(self, slowest: int = 5):
+        wall_seconds = max(time.perf_counter() - self._start, 1e-6)
+        busy_seconds = sum(row[3] for row in self.rows)
+        failures = sum(1 for row in self.rows if row[5] is not None)
+        logger.info("Directories: %s done, %s with output, %s failed; %s files, %.2f MB in %.2fs "
+                    "(%.1f directories at a time on average)",
+                    len(self.rows), sum(1 for row in self.rows if row[4] is not None), failures,
+                    sum(row[1] for row in self.rows), sum(row[2] for row in self.rows) / (1024 * 1024),
+                    wall_seconds, busy_seconds / wall_seconds)
+        for directory, files, chars, seconds, _, _ in sorted(self.rows, key=lambda row: -row[3])[:slowest]:
+            logger.info("    %6.2fs  %6s files  %8.2f MB  %s", seconds, files, chars / (1024 * 1024), directory)
+
+
+class RunProfile:
+    """Optional instrumentation of a run: time per phase and event counters, shared by all roots and threads.
+
+    A phase is a stack of names such as ``('discover', 'ignore checks')``; its time includes its children.
+    ``to_dict`` gives every phase's total and self time plus the counters (and hit rates of counters named
+    "<x> hits"/"<x> misses"); ``to_folded`` gives self time in microseconds as folded stacks
+    ("discover;ignore checks 1234"), the input of flamegraph.pl, inferno and speedscope.
+    """
+
+    def __init__(self):
+        self.seconds: Dict[Tuple[str, ...], float] = {}
+        self.counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def add_time(self, phase: Tuple[str, ...], seconds: float):
+        with self._lock:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    def count(self, counters: Dict[str, int]):
+        """Add to counters."""
+        with self._lock:
+            self.counters.update(counters)
+
+    def set_counts(self, counters: Dict[str, int]):
+        """Overwrite counters with totals kept elsewhere (e.g. by a cache)."""
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] = value
+
+    def timed(self, phase: Tuple[str, ...], function: Callable) -> Callable:
+        """Wrap ``function`` so the time spent in it is added to ``phase``."""
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(phase, time.perf_counter() - start)
+        return timed_function
+
+    def self_seconds(self, phase: Tuple[str, ...]) -> float:
+        children = sum(seconds for other, seconds in self.seconds.items()
+                       if len(other) == len(phase) + 1 and other[:-1] == phase)
+        return max(0.0, self.seconds[phase] - children)
+
+    def to_dict(self) -> dict:
+        hit_rates = {}
+        for name, hits in self.counters.items():
+            if name.endswith(' hits'):
+                lookups = hits + self.counters.get(name[:-len(' hits')] + ' misses', 0)
+                hit_rates[name[:-len(' hits')]] = round(hits / lookups, 4) if lookups else None
+        return {'phases': [{'phase': list(phase), 'seconds': round(self.seconds[phase], 6),
+                            'self_seconds': round(self.self_seconds(phase), 6)} for phase in sorted(self.seconds)],
+                'counters': dict(sorted(self.counters.items())),
+                'hit_rates': hit_rates}
+
+    def to_folded(self) -> str:
+        return ''.join(f"{';'.join(phase)} {int(self.self_seconds(phase) * 1e6)}\n" for phase in sorted(self.seconds))
+
+    def write(self, path: str):
+        """Save the report: JSON when ``path`` ends in .json, folded stacks otherwise."""
+        with open(path, 'w', encoding='utf-8') as report_file:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), report_file, indent=1)
             else:
-                if any(fnmatch.fnmatch(part, processed_pattern) for part in path_parts):
-                    return True
-        return False
+                report_file.write(self.to_folded())
+        logger.info("Wrote profile to %s", path)
+
+
+# Ingestion: the first block of every file is sniffed for binary content and byte order marks before the rest
+# is read; binaries are skipped after that one block, and larger files are decoded straight from a memory map
+SNIFF_BYTES = 8192
+MMAP_MIN_BYTES = 1024 * 1024
+# Tried in order when a file is not valid UTF-8; latin-1 decodes any byte string, so it always ends the list
+FALLBACK_ENCODINGS = ('cp1252', 'latin-1')
+_BOM_ENCODINGS = ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'),
+                  (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+# Control bytes other than tab, newline, form feed and carriage return; text has almost none of them
+_CONTROL_BYTES = bytes(range(0, 9)) + bytes([11]) + bytes(range(14, 32))
+
+
+def sniff_encoding(head: bytes) -> Optional[str]:
+    """Guess the encoding of a file from its first block: a BOM's encoding, UTF-8 by default, or None for binary.
+
+    NUL bytes or more than 10% control characters mark a file as binary.
+    """
+    for bom, encoding in _BOM_ENCODINGS:
+        if head.startswith(bom):
+            return encoding
+    if b'\0' in head:
+        return None
+    if head and len(head) - len(head.translate(None, _CONTROL_BYTES)) > len(head) // 10:
+        return None
+    return 'utf-8'
+
+
+def decode_bytes(data, encoding: str, file_path: str, profile: Optional[RunProfile] = None) -> str:
+    """Decode ``data`` (any bytes-like object), falling back to FALLBACK_ENCODINGS when it is not ``encoding``.
+
+    Line endings are normalised to ``\\n``, as text-mode open() does.
+    """
+    try:
+        text = str(data, encoding)
+    except UnicodeDecodeError:
+        for fallback in FALLBACK_ENCODINGS:
+            try:
+                text = str(data, fallback)
+            except UnicodeDecodeError:
+                continue
+            logger.warning("Decoded %s as %s (not valid %s)", file_path, fallback, encoding)
+            if profile is not None:
+                profile.count({'decoded with fallback encoding': 1})
+            break
+        else:
+            raise
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+class FileContent:
+    """One file moving through the pipeline: its text, and whether that text has been stripped yet."""
+
+    __slots__ = ('path', 'text', 'stripped', 'stat', 'content_hash')
+
+    def __init__(self, path: str, text: str, stripped: bool = False,
+                 stat: Optional[os.stat_result] = None, content_hash: Optional[str] = None):
+        self.path = path
+        self.text = text
+        self.stripped = stripped
+        self.stat = stat
+        self.content_hash = content_hash
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+# Near-duplicate detection: texts are shingled into runs of SHINGLE_WORDS words and sketched by their
+# MINHASH_SIZE smallest shingle hashes (bottom-k MinHash); sketches estimate the Jaccard similarity of two texts
+SHINGLE_WORDS = 5
+MINHASH_SIZE = 64
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 0.8
+_WORD_PATTERN = re.compile(r'\S+')
+
+
+def minhash_sketch(text: str) -> Tuple[int, ...]:
+    words = _WORD_PATTERN.findall(text)
+    shingles = {' '.join(words[start:start + SHINGLE_WORDS])
+                for start in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    # crc32 rather than hash(), which is salted per process and would make the output differ between runs
+    return tuple(heapq.nsmallest(MINHASH_SIZE, {zlib.crc32(shingle.encode('utf-8', 'surrogatepass'))
+                                                for shingle in shingles}))
+
+
+def estimate_similarity(sketch: Tuple[int, ...], other: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two sketches."""
+    union = heapq.nsmallest(MINHASH_SIZE, set(sketch) | set(other))
+    if not union:
+        return 1.0
+    shared = set(sketch) & set(other)
+    return sum(1 for value in union if value in shared) / len(union)
+
+
+class Deduplicator:
+    """Replaces files whose stripped text was already written by a reference to the earlier copy.
+
+    Exact copies are found by hash. With ``near_threshold``, files at least that similar (estimated Jaccard
+    similarity of word shingles) to an earlier, fully written file become a unified diff against it, when the
+    diff is shorter than the file. Files are only compared with earlier ones, so the output stays deterministic.
+
+    Only the sketches of written files are kept, not their text: ``reload`` produces an earlier file's text
+    again from the ``source`` it was checked with, when a diff against it is needed. A reloaded text that no
+    longer matches what was written (the file changed meanwhile) is not diffed against.
+    """
+
+    def __init__(self, near_threshold: Optional[float] = None,
+                 reload: Optional[Callable[[str], Optional[str]]] = None):
+        self.near_threshold = near_threshold
+        self.reload = reload
+        self.first_by_hash: Dict[str, str] = {}
+        # Fully written files that near-duplicates may refer to: (rel_path, source, text hash, sketch), and an
+        # inverted index from sketch value to their positions in that list
+        self.written: List[Tuple[str, str, str, Tuple[int, ...]]] = []
+        self.written_by_value: Dict[int, List[int]] = {}
+        self.identical = 0
+        self.near = 0
+        self.saved_chars = 0
+
+    def _near_duplicate(self, sketch: Tuple[int, ...]) -> Optional[Tuple[str, str, float]]:
+        shared_values = Counter(position for value in sketch for position in self.written_by_value.get(value, ()))
+        # Two sketches with Jaccard similarity J share at least about J * k values; half of that is a safe filter
+        minimum_shared = max(1, int(self.near_threshold * len(sketch) / 2))
+        candidates = sorted((-count, position) for position, count in shared_values.items()
+                            if count >= minimum_shared)
+        for _, position in candidates[:5]:
+            rel_path, source, original_hash, original_sketch = self.written[position]
+            similarity = estimate_similarity(sketch, original_sketch)
+            if similarity < self.near_threshold:
+                continue
+            original = self.reload(source)
+            if original is not None and hash_text(original) == original_hash:
+                return rel_path, original, similarity
+        return None
+
+    def check(self, rel_path: str, text: str,
+              source: Optional[str] = None) -> Optional[Tuple[str, str, Optional[str]]]:
+        """Return ``(text, note, identical_to)`` to write instead of ``text``, or None to write it in full.
+
+        Only files given a ``source`` to reload them from can be diffed against by later ones.
+        """
+        text_hash = hash_text(text)
+        original_path = self.first_by_hash.get(text_hash)
+        if original_path is not None:
+            self.identical += 1
+            self.saved_chars += len(text)
+            return '', f"identical to {original_path}", original_path
+        if self.near_threshold is None or self.reload is None:
+            self.first_by_hash[text_hash] = rel_path
+            return None
+
+        sketch = minhash_sketch(text)
+        near = self._near_duplicate(sketch)
+        if near is not None:
+            original_path, original, similarity = near
+            diff = ''.join(difflib.unified_diff(original.splitlines(True), text.splitlines(True),
+                                                original_path, rel_path, n=1))
+            if len(diff) < len(text):
+                self.near += 1
+                self.saved_chars += len(text) - len(diff)
+                return diff, f"{similarity:.0%} similar to {original_path}, diff against it", None
+
+        # Only files written in full can be referred to: a near-duplicate's section is a diff, not its text
+        self.first_by_hash[text_hash] = rel_path
+        if source is not None:
+            for value in sketch:
+                self.written_by_value.setdefault(value, []).append(len(self.written))
+            self.written.append((rel_path, source, text_hash, sketch))
+        return None
+
+    def report(self):
+        if self.identical or self.near:
+            logger.info("Dedup: %s identical and %s near-duplicate files, %.1f KB saved",
+                        self.identical, self.near, self.saved_chars / 1024)
+
+
+# Words and numbers (long ones split every 8 characters) and single punctuation marks, roughly like a BPE tokenizer
+_TOKEN_PATTERN = re.compile(r'\w{1,8}|[^\w\s]')
+# Bump when estimate_tokens changes, so estimates cached by the previous version are not reused
+TOKEN_ESTIMATOR = 'regex-v1'
+BUDGET_UNITS = ('tokens', 'bytes')
+# Relative value of a file by extension when choosing what fits in a budget; unlisted extensions get the default
+EXTENSION_PRIORITY = {
+    'py': 1.0, 'ts': 1.0, 'tsx': 1.0, 'js': 1.0, 'jsx': 1.0, 'mjs': 1.0, 'cs': 1.0, 'c': 1.0, 'h': 1.0,
+    'cpp': 1.0, 'hpp': 1.0, 'java': 1.0, 'go': 1.0, 'rs': 1.0,
+    'md': 0.6, 'rst': 0.6, 'txt': 0.5,
+    'json': 0.4, 'xml': 0.4, 'yaml': 0.4, 'yml': 0.4, 'toml': 0.4, 'ini': 0.4, 'csv': 0.3,
+    'html': 0.5, 'css': 0.4,
+}
+DEFAULT_EXTENSION_PRIORITY = 0.7
+# Partial sections (outlines, truncated heads) smaller than this many budget units are not worth a header,
+# and none may take more than this share of the budget
+MIN_PARTIAL_SECTION = 64
+PARTIAL_SECTION_SHARE = 0.05
+# Share of the budget whole files may not use while other files still need a summary
+SUMMARY_BUDGET_SHARE = 0.25
+# Declarations and headings: what is left of a file that is summarised rather than included
+_OUTLINE_LINE = re.compile(
+    r'^[ \t]*(?:(?:export|public|private|protected|internal|static|abstract|async|default|declare)\s+)*'
+    r'(?:def|class|function|interface|enum|struct|namespace|type|record)\b.*$'
+    r'|^#{1,6}\s.*$', re.MULTILINE)
+
+
+# One output section under a budget: the file, the text that goes in, and a header note when it is partial
+BudgetSection = Tuple[FileContent, str, Optional[str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast, deterministic estimate of the number of LLM tokens in ``text`` (within ~20% for code)."""
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+def budget_measure(unit: str) -> Callable[[str], int]:
+    if unit == 'tokens':
+        return estimate_tokens
+    if unit == 'bytes':
+        return _utf8_size
+    raise ValueError(f"Unknown budget unit: {unit}")
+
+
+def outline_text(text: str) -> str:
+    """Summarise a file as its declaration lines and headings."""
+    return ''.join(line + '\n' for line in _OUTLINE_LINE.findall(text))
+
+
+def truncate_text(text: str, measure: Callable[[str], int], limit: int) -> str:
+    """The longest run of whole leading lines of ``text`` that measures at most ``limit``."""
+    used = 0
+    end = 0
+    while end < len(text):
+        newline = text.find('\n', end)
+        line_end = len(text) if newline < 0 else newline + 1
+        cost = measure(text[end:line_end])
+        if used + cost > limit:
+            break
+        used += cost
+        end = line_end
+    return text[:end]
+
+
+# Chunk export: a chunk is cut before a declaration or heading line (see _OUTLINE_LINE) when the text before it
+# fills at least this share of the chunk size; otherwise it is filled up to the size
+CHUNK_MIN_SHARE = 0.5
+CHUNK_EXPORT_VERSION = 1
+
+
+def split_long_line(line: str, measure: Callable[[str], int], size: int) -> Iterator[str]:
+    """Cut a line that is larger than ``size`` on its own (minified code, data) into pieces that fit."""
+    while line:
+        length = len(line)
+        while length > 1 and measure(line[:length]) > size:
+            length = max(1, min(length - 1, length * size // max(measure(line[:length]), 1)))
+        yield line[:length]
+        line = line[length:]
+
+
+def chunk_text(text: str, measure: Callable[[str], int], size: int,
+               overlap_lines: int = 0) -> Iterator[Tuple[int, int, str]]:
+    """Split ``text`` into chunks of at most ``size`` (by ``measure``), yielding (first line, last line, text) with
+    1-based line numbers.
+
+    Chunks end at line ends, preferably just before a declaration or heading; each repeats the last
+    ``overlap_lines`` lines of the one before. A line too large for any chunk is split into chunks of its own.
+    """
+    lines = text.splitlines(keepends=True)
+    costs = [measure(line) for line in lines]
+    start = 0
+    while start < len(lines):
+        if costs[start] > size:
+            for piece in split_long_line(lines[start], measure, size):
+                yield start + 1, start + 1, piece
+            start += 1
+            continue
+        end = start
+        total = 0
+        boundary = boundary_total = 0
+        while end < len(lines) and total + costs[end] <= size:
+            if end > start and _OUTLINE_LINE.match(lines[end]):
+                boundary, boundary_total = end, total
+            total += costs[end]
+            end += 1
+        if end < len(lines) and boundary and boundary_total >= size * CHUNK_MIN_SHARE:
+            end = boundary
+        yield start + 1, end, ''.join(lines[start:end])
+        start = max(end - overlap_lines, start + 1) if end < len(lines) else end
+
+
+class ChunkExporter:
+    """Streams files as chunks to a JSON Lines file, one object per line.
+
+    Each chunk record has ``id``, ``path``, ``start_line``/``end_line`` (in the text as exported, i.e. stripped),
+    ``hash`` (of its text), ``size`` (in the chunk unit) and ``text``. The id is derived from the path and the
+    text, so a chunk keeps it while its content is unchanged. ``exported`` maps the ids of a previous export to
+    their paths: those chunks are not written again (their line range may have moved), and ids no longer
+    produced are listed as ``{"deleted": id, "path": path}`` records at the end. The file is only created once
+    there is something to write.
+    """
+
+    def __init__(self, output_path: str, measure: Callable[[str], int], size: int, overlap_lines: int = 0,
+                 exported: Optional[Dict[str, str]] = None):
+        self.output_path = output_path
+        self.measure = measure
+        self.size = size
+        self.overlap_lines = overlap_lines
+        self.exported = exported or {}
+        # Every chunk id of this export -> path, to be remembered for the next one
+        self.produced: Dict[str, str] = {}
+        self.written = 0
+        self.skipped = 0
+        self.deleted = 0
+        self._stream = None
+
+    def _write(self, record: dict):
+        if self._stream is None:
+            self._stream = open(self.output_path, 'w', encoding='utf-8', newline='\n')
+        self._stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def add_file(self, rel_path: str, text: str):
+        for start_line, end_line, chunk in chunk_text(text, self.measure, self.size, self.overlap_lines):
+            content_hash = hash_text(chunk)
+            chunk_id = base_id = hash_text(f"{rel_path}\0{content_hash}")[:20]
+            repeat = 1
+            while chunk_id in self.produced:
+                # The same text twice in one file
+                repeat += 1
+                chunk_id = f"{base_id}-{repeat}"
+            self.produced[chunk_id] = rel_path
+            if chunk_id in self.exported:
+                self.skipped += 1
+                continue
+            self._write({'id': chunk_id, 'path': rel_path, 'start_line': start_line, 'end_line': end_line,
+                         'hash': content_hash, 'size': self.measure(chunk), 'text': chunk})
+            self.written += 1
+
+    def finish(self) -> Optional[str]:
+        """List the chunks of the previous export that are gone, and close; returns the path, or None if empty."""
+        for chunk_id, rel_path in self.exported.items():
+            if chunk_id not in self.produced:
+                self._write({'deleted': chunk_id, 'path': rel_path})
+                self.deleted += 1
+        return self.close()
+
+    def close(self) -> Optional[str]:
+        if self._stream is None:
+            return None
+        self._stream.close()
+        self._stream = None
+        return self.output_path
+
+
+def rank_files(contents: List[FileContent], costs: Dict[str, int], folder: str) -> List[FileContent]:
+    """Order files from most to least valuable: source before docs before data, recent before old,
+    shallow before deep, small before large. Ties break on the path, so the order is deterministic."""
+    def mtime(content: FileContent) -> float:
+        if content.stat is not None:
+            return content.stat.st_mtime
+        try:
+            return os.stat(content.path).st_mtime
+        except OSError:
+            return 0.0
+
+    mtimes = {content.path: mtime(content) for content in contents}
+    # Recency as a rank, so one very old or very new file does not squash everyone else's score
+    by_age = sorted(contents, key=lambda content: (mtimes[content.path], content.path))
+    recency = {content.path: index / max(1, len(by_age) - 1) for index, content in enumerate(by_age)}
+
+    def score(content: FileContent) -> float:
+        rel_path = os.path.relpath(content.path, folder).replace(os.sep, '/')
+        extension = os.path.splitext(rel_path)[1][1:].lower()
+        priority = EXTENSION_PRIORITY.get(extension, DEFAULT_EXTENSION_PRIORITY)
+        depth = rel_path.count('/')
+        size = math.log2(2 + costs[content.path] / 1000)
+        return priority * (0.5 + recency[content.path]) / (1 + 0.2 * depth) / size
+
+    return sorted(contents, key=lambda content: (-score(content), content.path))
+
+
+def plan_budget(contents: List[FileContent], folder: str, budget: int, measure: Callable[[str], int],
+                costs: Dict[str, int]) -> Tuple[List[BudgetSection], List[FileContent], int]:
+    """Choose what of each file goes into an output of at most ``budget`` units.
+
+    Files are visited in rank order and taken whole while they fit in the budget less SUMMARY_BUDGET_SHARE,
+    which is kept for the files after them. Those are then summarised, in rank order, as their outline (or,
+    without declarations, their leading lines): each gets an even share of what is left, at least enough for
+    a useful summary and at most PARTIAL_SECTION_SHARE of the budget, so a single large file cannot crowd out
+    the smaller ones ranked after it. Whatever the summaries leave over upgrades files to whole, again in rank
+    order. Returns the sections as ``(content, text, note)`` in input order, the files left out entirely and
+    the number of units used.
+    """
+    remaining = budget - measure(OUTPUT_HEADER)
+    partial_limit = max(MIN_PARTIAL_SECTION, int(budget * PARTIAL_SECTION_SHARE))
+    reserve = int(budget * SUMMARY_BUDGET_SHARE)
+    chosen: Dict[str, Tuple[str, Optional[str]]] = {}
+    whole_costs = {}
+    rest = []
+    for content in rank_files(contents, costs, folder):
+        rel_path = os.path.relpath(content.path, folder)
+        cost = whole_costs[content.path] = costs[content.path] + measure(format_file_section(rel_path, ''))
+        if cost <= remaining - reserve:
+            chosen[content.path] = (content.text, None)
+            remaining -= cost
+        else:
+            rest.append(content)
+
+    partial_costs = {}
+    for position, content in enumerate(rest):
+        rel_path = os.path.relpath(content.path, folder)
+        total_lines = content.text.count('\n') or 1
+        outline = outline_text(content.text)
+        kind = "outline," if outline else "truncated, first"
+        # The longest note this file can get, so the final one never costs more than was reserved for it
+        note_cost = measure(format_file_section(rel_path, '', f"{kind} {total_lines} of {total_lines} lines"))
+        share = remaining // (len(rest) - position)
+        limit = min(remaining, partial_limit, max(share, MIN_PARTIAL_SECTION + note_cost))
+        if whole_costs[content.path] <= limit:
+            chosen[content.path] = (content.text, None)
+            remaining -= whole_costs[content.path]
+            continue
+        partial = truncate_text(outline or content.text, measure, limit - note_cost)
+        if not partial.strip() or measure(partial) < MIN_PARTIAL_SECTION:
+            continue
+        note = f"{kind} {partial.count(chr(10)) or 1} of {total_lines} lines"
+        chosen[content.path] = (partial, note)
+        partial_costs[content.path] = measure(format_file_section(rel_path, partial, note))
+        remaining -= partial_costs[content.path]
+
+    # Budget the summaries left over goes to whole files, in rank order
+    for content in rest:
+        if content.path in chosen and content.path not in partial_costs:
+            continue
+        freed = partial_costs.get(content.path, 0)
+        if whole_costs[content.path] <= remaining + freed:
+            chosen[content.path] = (content.text, None)
+            remaining += freed - whole_costs[content.path]
+
+    omitted = [content for content in rest if content.path not in chosen]
+    sections = [(content, *chosen[content.path]) for content in contents if content.path in chosen]
+    return sections, omitted, budget - remaining
 
 
 class FileHandler:
     def __init__(self, default_directory: str, default_file_extensions: List[str],
-                 extra_ignores: str = "", respect_gitignore: bool = True):
+                 extra_ignores: str = "", respect_gitignore: bool = True,
+                 read_workers: int = DEFAULT_READ_WORKERS, strip_workers: int = 1,
+                 cache_path: Optional[str] = None, budget: Optional[int] = None, budget_unit: str = 'tokens',
+                 shard_mb: Optional[float] = None, compression: Optional[str] = None, manifest: bool = False,
+                 dedup: bool = False, near_duplicates: Optional[float] = None, ignore_index: bool = False,
+                 git_index: Optional[str] = None, stat_workers: int = 1, symbol_index: bool = False,
+                 chunk_size: Optional[int] = None, chunk_overlap: int = 0):
         self.default_directory = default_directory
         self.default_extensions = default_file_extensions
         self.additional_ignore_patterns = self.parse_additional_ignore(extra_ignores)
+        self.additional_ignore_set = GitIgnorePatternSet(self.additional_ignore_patterns)
         self.gitignore_manager = None  # Will be initialized after getting directory
         self.respect_gitignore = respect_gitignore
-
-        # Pattern for generated files: directory_name_YYYYMMDD_HHMMSS.txt
-        self.generated_file_pattern = r'^[^_]+_\d{8}_\d{6}\.txt$'
+        # Thread pool size for reading files, process pool size for stripping them (1: strip in-process)
+        self.read_workers = read_workers
+        self.strip_workers = strip_workers
+        # Threads stat'ing files during the walk (1: stat in the walking thread); more only help on slow file systems
+        self.stat_workers = stat_workers
+        # Read and strip pools shared by every directory consolidated between open_shared_pools and
+        # close_shared_pools; otherwise each directory starts its own
+        self._shared_pools_open = False
+        self._shared_read_executor: Optional[ThreadPoolExecutor] = None
+        self._shared_strip_executor: Optional[ProcessPoolExecutor] = None
+        self._shared_pools_lock = threading.Lock()
+        # Stats taken by the walk, handed to the read stage so each file is only stat'ed once per run.
+        # Shared by every root processed through this handler; entries are consumed when read.
+        self.stat_cache: Dict[str, os.stat_result] = {}
+        # Persistent stripped-text cache; opened on first use so it sees the final strip configuration
+        self.cache_path = cache_path
+        self._strip_cache: Optional[StripCache] = None
+        self._strip_cache_lock = threading.Lock()
+        # Keep each directory's ignore decisions in the cache too, so walks of an unchanged tree skip
+        # loading .gitignore files and matching patterns
+        self.ignore_index = ignore_index
+        # List files from the git index where the folder is in a git work tree (see GIT_INDEX_MODES)
+        self.git_index = git_index
+        # Optional size limit for each output, in BUDGET_UNITS; files are then ranked, and the least valuable
+        # are summarised, truncated or left out
+        self.budget = budget
+        self.budget_unit = budget_unit
+        # Output layout: shards of at most shard_mb, compression (see COMPRESSION_SUFFIXES) and a JSON manifest
+        # of where each file's text is; sharded or compressed output always gets a manifest
+        self.shard_bytes = int(shard_mb * 1024 * 1024) if shard_mb else None
+        self.compression = compression
+        self.write_manifest = manifest or self.shard_bytes is not None or compression is not None
+        # Write a SymbolIndex next to each output, for query_symbol_index / consolidate_query.py
+        self.symbol_index = symbol_index
+        # Export chunks of at most chunk_size (in budget_unit) as JSON Lines instead of the text output, each
+        # repeating chunk_overlap lines of the previous one (see ChunkExporter)
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        # Optional instrumentation (see RunProfile), shared by every root processed through this handler
+        self.profile: Optional[RunProfile] = None
+        # Replace repeated files by references to their first copy; near_duplicates (a similarity threshold)
+        # also turns similar files into diffs, and implies dedup
+        self.dedup = dedup or near_duplicates is not None
+        self.near_duplicates = near_duplicates
+
+        # Pattern for generated files: directory_name_YYYYMMDD_HHMMSS.txt, its shards (.part001.txt.gz, ...),
+        # its manifest (.manifest.json), its symbol index (.index.sqlite3) and chunk exports (.chunks.jsonl)
+        self.generated_file_pattern = (r'^[^_]+_\d{8}_\d{6}(?:\.part\d{3})?\.'
+                                       r'(?:txt(?:\.gz|\.zst)?|manifest\.json|index\.sqlite3|chunks\.jsonl)$')
         self.ignored_folders = [".git", ".venv", "build", "Cesium", ".run", ".github", ".yalc",
                                 ".yarn", ".pnpm", ".turbo", ".nx", ".idea", ".vscode",
                                 "spec", "specs", "node_modules", "__pycache__", ".DS_Store",
@@ -276,9 +1503,29 @@ class FileHandler:
                               ".eslintrc.cjs", ".eslintrc.ts", ".eslintrc.yaml", ".eslintrc.yml",
                               ".eslintignore", ".stylelintignore", "package-lock.json",
                               "pnpm-lock.yaml", "yarn.lock", "index.d.ts", "index.ts"]
-        self.strip_regex = [(r'/\*.*?copyright.*?\*/', re.DOTALL | re.IGNORECASE),
-                            (r'^\s*import\s.*;?\s*$', re.MULTILINE),
-                            (r'\n\s*\n+', re.MULTILINE)]
+        # Stripping engine per file extension (without the dot); files of other extensions use the default
+        self.default_stripper: Callable[[str], str] = TextStripper()
+        self.strippers_by_extension: Dict[str, Callable[[str], str]] = {}
+
+    def enable_compaction(self, passes: Iterable[str]):
+        """Switch every extension to language-aware compaction with the given COMPACTION_PASSES (or 'all')."""
+        self.default_stripper, strippers = build_compacting_strippers(passes)
+        self.strippers_by_extension.update(strippers)
+
+    def record_profile_counters(self):
+        """Copy the hit counts of the strip cache so far into ``profile``.
+
+        The walk counts its own ignore index hits and misses (see ``iter_hierarchy_files``).
+        """
+        counters = {}
+        if self._strip_cache is not None:
+            counters['strip cache hits'] = self._strip_cache.stat_hits + self._strip_cache.hash_hits
+            counters['strip cache misses'] = self._strip_cache.misses
+        self.profile.set_counts(counters)
+
+    def get_stripper(self, file_path: str) -> Callable[[str], str]:
+        extension = os.path.splitext(file_path)[1][1:].lower()
+        return self.strippers_by_extension.get(extension, self.default_stripper)
 
     def initialize_gitignore_manager(self, directory: str):
         """Initialize the GitIgnoreManager with the target directory."""
@@ -311,102 +1558,388 @@ class FileHandler:
             return self.default_extensions
         return extensions.split()
 
-    def should_ignore_additional(self, path: str) -> bool:
-        """Check if path matches additional ignore patterns."""
-        rel_path = os.path.relpath(path, self.default_directory)
-        path_parts = rel_path.split(os.sep)
-
-        for pattern in self.additional_ignore_patterns:
-            # Handle patterns ending with '/'
-            if pattern.endswith('/'):
-                if any(fnmatch.fnmatch(part, pattern[:-1]) for part in path_parts):
-                    return True
-            # Handle patterns with '/'
-            elif '/' in pattern:
-                if fnmatch.fnmatch(rel_path, pattern):
-                    return True
-            # Handle simple patterns
-            else:
-                if any(fnmatch.fnmatch(part, pattern) for part in path_parts):
-                    return True
-                # Also check just the filename
-                if fnmatch.fnmatch(os.path.basename(path), pattern):
-                    return True
-        return False
+    @staticmethod
+    def chain_ignore_fingerprint(fingerprint: Optional[str], directory: str) -> Optional[str]:
+        """Extend a parent directory's ignore-index fingerprint with the stat of ``directory``'s .gitignore."""
+        if fingerprint is None:
+            return None
+        try:
+            gitignore_stat = os.stat(os.path.join(directory, '.gitignore'))
+        except OSError:
+            return fingerprint
+        if time.time() - gitignore_stat.st_mtime <= RACY_MTIME_SECONDS:
+            return None
+        return hash_text(f"{fingerprint}:{directory}:{gitignore_stat.st_mtime_ns}:{gitignore_stat.st_size}")
 
     def get_all_hierarchy_files(self, folder: str, extensions: List[str], max_size_kb: int = 128) -> List[str]:
         """Get all files in the directory hierarchy with specified extensions and below a certain size (in KB)."""
-        all_files = []
+        return list(self.iter_hierarchy_files(folder, extensions, max_size_kb))
+
+    def iter_hierarchy_files(self, folder: str, extensions: List[str], max_size_kb: int = 128,
+                             visited_directories: Optional[List[str]] = None,
+                             gitignore_root: Optional[str] = None,
+                             exclude_paths: Optional[Set[str]] = None) -> Iterator[str]:
+        """Yield the files of ``get_all_hierarchy_files`` as the walk finds them.
+
+        A single os.scandir pass: .gitignore files are discovered as their directories are listed, ignore
+        patterns are carried down the walk as layers so every entry is checked exactly once against the
+        .gitignore files above it (and the additional patterns, rooted at ``folder``), and ignored
+        directories are never entered. Every directory scanned is appended to ``visited_directories``.
+
+        .gitignore files between ``gitignore_root`` (default: the manager's root) and ``folder`` apply too.
+        Each file's stat comes from its DirEntry (one stat call, none for directories, whose type the listing
+        gives) and is kept in ``stat_cache`` for the read stage; with ``stat_workers`` above 1, each directory's
+        files are stat'ed on a thread pool. Files and directories in ``exclude_paths`` (absolute paths) are
+        passed over.
+
+        With ``ignore_index``, each directory's decisions are stored in the cache under a fingerprint of the
+        .gitignore files above it. While those are unchanged, later walks take the decisions from there and
+        only load patterns for entries that are new; the layers are then built on demand.
+        """
         if not os.path.exists(folder) or not os.access(folder, os.R_OK):
-            print(f"Directory {folder} is not accessible.")
-            return all_files
-
-        for root, dirs, file_list in os.walk(folder):
-            # Filter directories
-            filtered_dirs = []
-            for d in dirs:
-                dir_path = os.path.join(root, d)
-                # Check gitignore
-                if self.gitignore_manager and self.gitignore_manager.should_ignore(dir_path):
-                    print(f"Skipping gitignored directory: {os.path.relpath(dir_path, folder)}")
-                    continue
-                # Check additional patterns
-                if self.should_ignore_additional(dir_path):
-                    print(f"Skipping additionally ignored directory: {os.path.relpath(dir_path, folder)}")
-                    continue
-                # Check hardcoded ignored folders
-                if d in self.ignored_folders:
-                    continue
-                filtered_dirs.append(d)
-
-            dirs[:] = filtered_dirs
+            logger.warning("Directory %s is not accessible.", folder)
+            return
 
-            for file_name in file_list:
-                # Skip generated files
-                if self.is_generated_file(file_name):
+        folder = os.path.abspath(folder)
+        ignored_folders = set(self.ignored_folders)
+        ignored_files = set(self.ignored_files)
+        extension_suffixes = tuple(extensions)
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # Entries seen and skipped, by reason; handed to the profile (if any) when the walk ends
+        counts: Counter = Counter()
+
+        # Without a manager only the additional patterns apply. They are checked on their own, before the
+        # .gitignore layers, so no '!' pattern in a .gitignore can re-include what they exclude.
+        manager = self.gitignore_manager or GitIgnoreManager(folder, respect_gitignore=False)
+        additional_ignore_set = self.additional_ignore_set or None
+        start_layers: IgnoreLayers = ()
+        top_directory = os.path.abspath(gitignore_root) if gitignore_root else manager.root_directory
+        if manager.respect_gitignore and folder.startswith(top_directory + os.sep):
+            # .gitignore files between the top directory and the folder (the folder's own one is found by the scan)
+            start_layers += manager.shift_layers(manager.layers_for_directory(os.path.dirname(folder), top_directory),
+                                                 os.path.basename(folder))
+
+        def list_directory(directory: str) -> List[os.DirEntry]:
+            with os.scandir(directory) as it:
+                return list(it)
+
+        def directory_layers(directory: str, inherited_layers: Optional[IgnoreLayers],
+                             has_gitignore: bool) -> IgnoreLayers:
+            if inherited_layers is not None:
+                return add_directory_layer(inherited_layers, directory, has_gitignore)
+            # The parents' decisions came from the index: build the layers the walk would have carried down
+            layers = add_directory_layer(start_layers, folder, None)
+            current = folder
+            for name in os.path.relpath(directory, folder).split(os.sep) if directory != folder else ():
+                current = os.path.join(current, name)
+                layers = add_directory_layer(manager.shift_layers(layers, name), current, None)
+            return layers
+
+        # The fingerprint of a directory chains those of its parents with the stat of its own .gitignore;
+        # None when a .gitignore above is too recent to trust (see RACY_MTIME_SECONDS), which disables the index
+        index = self.get_strip_cache() if self.ignore_index else None
+        index_context: Optional[str] = None
+        fingerprint: Optional[str] = None
+        if index is not None:
+            index_context = hash_text(repr((IGNORE_INDEX_VERSION, manager.respect_gitignore, top_directory, folder,
+                                            self.additional_ignore_patterns)))
+            fingerprint = index_context
+            if manager.respect_gitignore and folder.startswith(top_directory + os.sep):
+                ancestors = [top_directory]
+                for name in os.path.relpath(os.path.dirname(folder), top_directory).split(os.sep):
+                    if name != '.':
+                        ancestors.append(os.path.join(ancestors[-1], name))
+                for directory in ancestors:
+                    fingerprint = self.chain_ignore_fingerprint(fingerprint, directory)
+
+        def stat_entry(entry: os.DirEntry) -> Optional[os.stat_result]:
+            # DirEntry caches its stat (and on Windows already has it from the listing)
+            try:
+                return entry.stat()
+            except OSError:
+                return None
+
+        add_directory_layer = manager.add_directory_layer
+        matches_layers = manager.matches_layers
+        if self.profile is not None:
+            list_directory = self.profile.timed(('discover', 'scandir'), list_directory)
+            add_directory_layer = self.profile.timed(('discover', 'gitignore load'), add_directory_layer)
+            matches_layers = self.profile.timed(('discover', 'ignore checks'), matches_layers)
+            stat_entry = self.profile.timed(('discover', 'stat'), stat_entry)
+        stat_pool = ThreadPoolExecutor(max_workers=self.stat_workers) if self.stat_workers > 1 else None
+
+        # Depth-first scan in os.walk's top-down order; each entry holds a directory, the layers inherited
+        # from its parent (None when the parent's decisions came from the index) and its parent's fingerprint.
+        # The directory's own .gitignore is picked up from its listing.
+        pending: List[Tuple[str, Optional[IgnoreLayers], Optional[str]]] = [(folder, start_layers, fingerprint)]
+        try:
+            while pending:
+                root, inherited_layers, fingerprint = pending.pop()
+                try:
+                    entries = list_directory(root)
+                except OSError:
                     continue
+                counts['directories scanned'] += 1
+                if visited_directories is not None:
+                    visited_directories.append(root)
+
+                has_gitignore = any(entry.name == '.gitignore' for entry in entries)
+                # This directory relative to the folder, for the additional patterns
+                rel_directory = '' if root == folder else os.path.relpath(root, folder).replace(os.sep, '/') + '/'
+
+                # Indexed decisions (entry name, '/' appended for directories -> ignored) and those made now
+                indexed: Optional[Dict[str, bool]] = None
+                decided: Dict[str, bool] = {}
+                if fingerprint is not None:
+                    if has_gitignore:
+                        fingerprint = self.chain_ignore_fingerprint(fingerprint, root)
+                    if fingerprint is not None:
+                        indexed = index.lookup_ignore_decisions(root, index_context, fingerprint)
+                known = indexed or {}
+                layers = None
+                if indexed is None:
+                    layers = directory_layers(root, inherited_layers, has_gitignore)
+
+                subdirectories = []
+                # Files that passed the name and ignore checks, waiting for their stat
+                candidates: List[os.DirEntry] = []
+                # Ignore decisions looked up; those not taken from the index end up in ``decided``
+                lookups = 0
+                for entry in entries:
+                    name = entry.name
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        continue
 
-                # Skip extra ignored files
-                if file_name in self.ignored_files:
-                    continue
+                    if is_dir:
+                        # Like os.walk, never follow directory symlinks; check hardcoded ignored folders first
+                        if name in ignored_folders or entry.is_symlink():
+                            counts['skipped: hardcoded or symlinked directory'] += 1
+                            continue
+                        if exclude_paths is not None and entry.path in exclude_paths:
+                            counts['skipped: excluded'] += 1
+                            continue
+                        # Check additional patterns, then gitignore
+                        if additional_ignore_set is not None and additional_ignore_set.matches(
+                                rel_directory + name, True):
+                            counts['skipped: ignored directory'] += 1
+                            continue
+                        lookups += 1
+                        ignored = known.get(name + '/')
+                        if ignored is None:
+                            if layers is None:
+                                layers = directory_layers(root, inherited_layers, has_gitignore)
+                            ignored = decided[name + '/'] = matches_layers(layers, name, True)
+                        if ignored:
+                            counts['skipped: ignored directory'] += 1
+                            if debug:
+                                logger.debug("Skipping ignored directory: %s", os.path.relpath(entry.path, folder))
+                            continue
+                        subdirectories.append((entry.path, manager.shift_layers(layers, name)
+                                               if layers is not None else None, fingerprint))
+                        continue
 
-                full_path = os.path.join(root, file_name)
+                    counts['files considered'] += 1
+                    # Skip generated files
+                    if self.is_generated_file(name):
+                        counts['skipped: generated output'] += 1
+                        continue
 
-                # Check extension
-                if not file_name.endswith(tuple(extensions)):
-                    continue
+                    # Skip extra ignored files
+                    if name in ignored_files:
+                        counts['skipped: hardcoded file'] += 1
+                        continue
 
-                # Check gitignore
-                if self.gitignore_manager and self.gitignore_manager.should_ignore(full_path):
-                    print(f"Skipping gitignored file: {os.path.relpath(full_path, folder)}")
-                    continue
+                    # Check extension
+                    if not name.endswith(extension_suffixes):
+                        counts['skipped: extension'] += 1
+                        continue
 
-                # Check additional patterns
-                if self.should_ignore_additional(full_path):
-                    print(f"Skipping additionally ignored file: {os.path.relpath(full_path, folder)}")
-                    continue
+                    full_path = entry.path
+                    if exclude_paths is not None and full_path in exclude_paths:
+                        counts['skipped: excluded'] += 1
+                        continue
+
+                    # Check additional patterns, then gitignore
+                    if additional_ignore_set is not None and additional_ignore_set.matches(rel_directory + name,
+                                                                                            False):
+                        counts['skipped: ignored file'] += 1
+                        continue
+                    lookups += 1
+                    ignored = known.get(name)
+                    if ignored is None:
+                        if layers is None:
+                            layers = directory_layers(root, inherited_layers, has_gitignore)
+                        ignored = decided[name] = matches_layers(layers, name, False)
+                    if ignored:
+                        counts['skipped: ignored file'] += 1
+                        if debug:
+                            logger.debug("Skipping ignored file: %s", os.path.relpath(full_path, folder))
+                        continue
+                    candidates.append(entry)
 
-                if os.access(full_path, os.R_OK):
-                    file_size = os.path.getsize(full_path)  # bytes
+                # Size checks need a stat per file; a pool overlaps them where each one is slow (network mounts)
+                if stat_pool is not None and len(candidates) > 1:
+                    file_stats = stat_pool.map(stat_entry, candidates)
+                else:
+                    file_stats = map(stat_entry, candidates)
+                for entry, file_stat in zip(candidates, file_stats):
+                    full_path = entry.path
+                    if file_stat is None:
+                        # Broken symlinks and files removed since the listing; unreadable files are reported by
+                        # the read stage
+                        counts['skipped: unreadable'] += 1
+                        logger.warning("File %s is not readable.", full_path)
+                        continue
+                    file_size = file_stat.st_size  # bytes
                     file_size_kb = file_size / 1024.0
 
                     # Skip files larger than our cutoff
                     if file_size_kb > max_size_kb:
-                        print(f"Skipping large file: {full_path} ({file_size_kb:.2f} KB)")
+                        counts['skipped: too large'] += 1
+                        logger.debug("Skipping large file: %s (%.2f KB)", full_path, file_size_kb)
                         continue
 
                     # Skip empty files
                     if file_size == 0:
-                        print(f"Skipping empty file: {full_path}")
+                        counts['skipped: empty'] += 1
+                        logger.debug("Skipping empty file: %s", full_path)
                         continue
 
-                    # Everything passed checks, add to our list
-                    all_files.append(full_path)
-                else:
-                    print(f"File {full_path} is not readable.")
-
-        # Exclude this script from the returned list
-        return [f for f in all_files if "consolidate.py" not in f]
+                    # Everything passed checks; exclude this script itself
+                    if "consolidate.py" not in full_path:
+                        counts['files found'] += 1
+                        # Only files that are yielded: the read stage pops their stat again
+                        self.stat_cache[full_path] = file_stat
+                        yield full_path
+
+                if fingerprint is not None:
+                    counts['ignore index: directories from index' if indexed is not None and not decided
+                           else 'ignore index: directories matched'] += 1
+                    counts['ignore index hits'] += lookups - len(decided)
+                    counts['ignore index misses'] += len(decided)
+                    # Keep the decisions of entries that still exist, so runs with other extensions share them
+                    names = {entry.name for entry in entries}
+                    updated = {key: value for key, value in known.items() if key.rstrip('/') in names}
+                    updated.update(decided)
+                    if updated != indexed:
+                        index.store_ignore_decisions(root, index_context, fingerprint, updated)
+
+                pending.extend(reversed(subdirectories))
+        finally:
+            if stat_pool is not None:
+                stat_pool.shutdown()
+            if index is not None:
+                index.flush()
+            if self.profile is not None:
+                self.profile.count(counts)
+
+    def iter_git_index_files(self, folder: str, extensions: List[str], max_size_kb: int = 128,
+                             gitignore_root: Optional[str] = None,
+                             untracked: bool = True) -> Optional[Iterator[str]]:
+        """List ``folder``'s files from the index of the git work tree it is in, instead of walking it.
+
+        Tracked files are taken as git lists them (even where a .gitignore matches them) and go through the same
+        name, extension, additional-pattern and size checks as walked files. With ``untracked``, a walk that
+        passes over tracked files and submodules adds the files git would report as untracked.
+        Returns None when ``folder`` is not in a git work tree or its index cannot be read, so the caller can walk.
+        """
+        folder = os.path.abspath(folder)
+        location = find_git_work_tree(folder)
+        if location is None:
+            return None
+        work_tree, git_dir = location
+        index_path = os.path.join(git_dir, 'index')
+        try:
+            tracked, submodules = read_git_index(index_path, git_hash_size(git_dir))
+        except FileNotFoundError:
+            # A new repository has no index until something is added: every file is untracked
+            tracked, submodules = [], []
+        except (OSError, ValueError) as e:
+            logger.warning("Cannot use the git index %s, walking %s instead: %s", index_path, folder, e)
+            return None
+        logger.debug("Listing %s from the git index %s", folder, index_path)
+        return self._iter_git_index_files(folder, work_tree, tracked, submodules if untracked else None,
+                                          extensions, max_size_kb, gitignore_root)
+
+    def _iter_git_index_files(self, folder: str, work_tree: str, tracked: List[str], submodules: Optional[List[str]],
+                              extensions: List[str], max_size_kb: int, gitignore_root: Optional[str]
+                              ) -> Iterator[str]:
+        """Yield the tracked files of ``iter_git_index_files``, then (unless ``submodules`` is None) the untracked
+        ones."""
+        prefix = os.path.relpath(folder, work_tree).replace(os.sep, '/') + '/'
+        if prefix == './':
+            prefix = ''
+        ignored_folders = set(self.ignored_folders)
+        ignored_files = set(self.ignored_files)
+        extension_suffixes = tuple(extensions)
+        counts: Counter = Counter()
+        tracked_paths: Set[str] = set()
+        try:
+            for path in tracked:
+                if not path.startswith(prefix):
+                    continue
+                full_path = os.path.join(work_tree, path.replace('/', os.sep))
+                tracked_paths.add(full_path)
+                counts['files considered'] += 1
+                parts = path[len(prefix):].split('/')
+                name = parts[-1]
+                if any(part in ignored_folders for part in parts[:-1]):
+                    counts['skipped: hardcoded or symlinked directory'] += 1
+                    continue
+                if self.is_generated_file(name):
+                    counts['skipped: generated output'] += 1
+                    continue
+                if name in ignored_files:
+                    counts['skipped: hardcoded file'] += 1
+                    continue
+                if not name.endswith(extension_suffixes):
+                    counts['skipped: extension'] += 1
+                    continue
+                if self.additional_ignore_set and any(
+                        self.additional_ignore_set.matches('/'.join(parts[:depth]), depth < len(parts))
+                        for depth in range(1, len(parts) + 1)):
+                    counts['skipped: ignored file'] += 1
+                    continue
+                try:
+                    file_stat = os.stat(full_path)
+                except OSError:
+                    # Deleted from the work tree but still in the index
+                    counts['skipped: missing'] += 1
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                if file_stat.st_size / 1024.0 > max_size_kb:
+                    counts['skipped: too large'] += 1
+                    logger.debug("Skipping large file: %s (%.2f KB)", full_path, file_stat.st_size / 1024.0)
+                    continue
+                if file_stat.st_size == 0:
+                    counts['skipped: empty'] += 1
+                    logger.debug("Skipping empty file: %s", full_path)
+                    continue
+                if "consolidate.py" not in full_path:
+                    counts['files found'] += 1
+                    counts['git index: tracked files found'] += 1
+                    # Only files that are yielded: the read stage pops their stat again
+                    self.stat_cache[full_path] = file_stat
+                    yield full_path
+        finally:
+            if self.profile is not None:
+                self.profile.count(counts)
+
+        if submodules is not None:
+            # Submodules have their own index; like git, the untracked walk does not look inside them
+            tracked_paths.update(os.path.join(work_tree, path.replace('/', os.sep)) for path in submodules)
+            untracked_count = 0
+            try:
+                for full_path in self.iter_hierarchy_files(folder, extensions, max_size_kb,
+                                                           gitignore_root=gitignore_root, exclude_paths=tracked_paths):
+                    untracked_count += 1
+                    yield full_path
+            finally:
+                if self.profile is not None:
+                    self.profile.count({'git index: untracked files found': untracked_count})
 
     @staticmethod
     def get_child_directories(folder: str) -> List[str]:
@@ -419,9 +1952,260 @@ class FileHandler:
                          "[y/n] (default: n): ")
         return response.lower() in ["y", "yes"]
 
-    def combine_files_with_path_headers(self, folder: str, files_by_path: Dict[str, str],
-                                        write_up_a_level: bool = True):
-        # Determine output file name with timestamp
+    @staticmethod
+    def read_file(file_path: str, profile: Optional[RunProfile] = None) -> Optional[str]:
+        """Read one text file, returning None (and reporting why) for binaries and files that cannot be read.
+
+        The first SNIFF_BYTES decide between binary and text and pick the encoding; binaries are never read
+        further. Files of MMAP_MIN_BYTES or more are decoded from a memory map instead of a copy of their bytes.
+        """
+        try:
+            with open(file_path, 'rb') as file:
+                head = file.read(SNIFF_BYTES)
+                encoding = sniff_encoding(head)
+                if encoding is None:
+                    logger.debug("Skipping binary file: %s", file_path)
+                    if profile is not None:
+                        profile.count({'skipped: binary': 1})
+                    return None
+                if len(head) < SNIFF_BYTES:
+                    return decode_bytes(head, encoding, file_path, profile)
+                if os.fstat(file.fileno()).st_size < MMAP_MIN_BYTES:
+                    return decode_bytes(head + file.read(), encoding, file_path, profile)
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if profile is not None:
+                        profile.count({'memory-mapped reads': 1})
+                    return decode_bytes(mapped, encoding, file_path, profile)
+        except Exception as e:
+            logger.error("Error reading file %s: %s", file_path, e)
+            if profile is not None:
+                profile.count({'read errors': 1})
+            return None
+
+    def strip_signature(self) -> str:
+        """Identify the current strip configuration, so cached text produced under another one is not reused."""
+        return hash_text(repr((CACHE_FORMAT_VERSION, self.default_stripper,
+                               sorted(self.strippers_by_extension.items()))))
+
+    def get_strip_cache(self) -> Optional[StripCache]:
+        """Open the persistent cache at ``cache_path`` on first use; None when caching is off or unavailable."""
+        with self._strip_cache_lock:
+            if self._strip_cache is None and self.cache_path:
+                try:
+                    self._strip_cache = StripCache(self.cache_path, self.strip_signature())
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning("Could not open cache %s, continuing without it: %s", self.cache_path, e)
+                    self.cache_path = None
+        return self._strip_cache
+
+    def load_file(self, file_path: str) -> Optional[FileContent]:
+        """Produce a file's pipeline entry, taking its stripped text from the cache when the file is unchanged."""
+        cache = self.get_strip_cache()
+        stat = self.stat_cache.pop(file_path, None)
+        if cache is not None:
+            if stat is None:
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    stat = None
+            if stat is not None:
+                cached = cache.lookup(file_path, stat)
+                if cached is not None:
+                    return FileContent(file_path, cached, stripped=True, stat=stat)
+
+        text = self.read_file(file_path, self.profile)
+        if text is None:
+            return None
+        content = FileContent(file_path, text, stat=stat)
+        if cache is not None:
+            content.content_hash = hash_text(text)
+            cached = cache.lookup_by_hash(file_path, stat, content.content_hash)
+            if cached is not None:
+                content.text, content.stripped = cached, True
+        return content
+
+    def load_stripped_text(self, file_path: str) -> Optional[str]:
+        """Read and strip one file again, from the cache when it is unchanged (e.g. as a near-duplicate's base)."""
+        content = self.load_file(file_path)
+        if content is None:
+            return None
+        if content.stripped:
+            return content.text
+        return run_stripper(self.get_stripper(file_path), content.text)[0]
+
+    def measure_text(self, text: str) -> int:
+        """Size of stripped text in ``budget_unit``; token estimates are kept in the persistent cache."""
+        if self.budget_unit != 'tokens':
+            return budget_measure(self.budget_unit)(text)
+        cache = self.get_strip_cache()
+        if cache is None:
+            return estimate_tokens(text)
+        text_hash = hash_text(text)
+        estimate = cache.lookup_estimate(text_hash, TOKEN_ESTIMATOR)
+        if estimate is None:
+            estimate = estimate_tokens(text)
+            cache.store_estimate(text_hash, TOKEN_ESTIMATOR, estimate)
+        return estimate
+
+    def fit_to_budget(self, folder: str, contents: Iterable[FileContent]) -> List[BudgetSection]:
+        """Collect stripped files and choose the sections that fit in ``budget`` (see plan_budget)."""
+        contents = list(contents)
+        costs = {content.path: self.measure_text(content.text) for content in contents}
+        if self._strip_cache is not None:
+            self._strip_cache.flush()
+        plan = plan_budget if self.profile is None else self.profile.timed(('write', 'budget'), plan_budget)
+        sections, omitted, used = plan(contents, folder, self.budget, budget_measure(self.budget_unit), costs)
+
+        notes = [note.split(',')[0] for _, _, note in sections if note]
+        logger.info("Budget: %s of %s %s used; %s files whole, %s outlined, %s truncated, %s left out",
+                    used, self.budget, self.budget_unit, len(sections) - len(notes), notes.count('outline'),
+                    notes.count('truncated'), len(omitted))
+        for content in omitted:
+            logger.debug("Left out: %s (%s %s)",
+                         os.path.relpath(content.path, folder), costs[content.path], self.budget_unit)
+        return sections
+
+    def open_shared_pools(self):
+        """Use one read thread pool and (with ``strip_workers`` > 1) one strip process pool for every directory
+        consolidated until ``close_shared_pools``.
+
+        Directories consolidated at the same time then queue their files on the same workers, so idle workers
+        take whichever directory's files are waiting, and a large directory is spread over every worker instead
+        of holding up the ones behind it. The process pool is started by the first directory that needs it.
+        """
+        self._shared_read_executor = ThreadPoolExecutor(max_workers=max(1, self.read_workers))
+        self._shared_pools_open = True
+
+    def shared_strip_executor(self) -> Optional[ProcessPoolExecutor]:
+        """The shared strip pool, started on first use; None unless shared pools are open."""
+        with self._shared_pools_lock:
+            if self._shared_pools_open and self._shared_strip_executor is None and self.strip_workers > 1:
+                self._shared_strip_executor = ProcessPoolExecutor(max_workers=self.strip_workers)
+            return self._shared_strip_executor
+
+    def close_shared_pools(self):
+        with self._shared_pools_lock:
+            self._shared_pools_open = False
+            for executor in (self._shared_read_executor, self._shared_strip_executor):
+                if executor is not None:
+                    executor.shutdown()
+            self._shared_read_executor = self._shared_strip_executor = None
+
+    def iter_file_contents(self, file_paths: Iterable[str]) -> Iterator[FileContent]:
+        """Read files on a thread pool (the shared one, if open), yielding them in input order as soon as each
+        is ready.
+
+        At most a few reads per worker are in flight, so memory stays bounded however many paths come in.
+        Files found unchanged in the cache come out already stripped and are never read.
+        """
+        executor = self._shared_read_executor or ThreadPoolExecutor(max_workers=max(1, self.read_workers))
+        try:
+            window = max(1, self.read_workers) * 4
+            for _, content in ordered_map(executor, self.load_file, file_paths, window):
+                if content is not None:
+                    yield content
+        finally:
+            if executor is not self._shared_read_executor:
+                executor.shutdown()
+
+    def iter_stripped_files(self, files: Iterable[Union[FileContent, Tuple[str, str]]],
+                            compaction_stats: Optional[Dict[str, List[int]]] = None) -> Iterator[FileContent]:
+        """Strip files as they arrive, yielding them in input order.
+
+        Byte counts of compaction passes are added to ``compaction_stats`` (pass name -> [bytes in, bytes out]).
+
+        Accepts pipeline entries or plain ``(path, text)`` pairs; entries that are already stripped pass
+        straight through, freshly stripped ones are stored in the cache. Files are stripped in-process until
+        PARALLEL_STRIP_MIN_CHARS of text has gone by; only then is a process pool (``strip_workers`` > 1)
+        started (or the shared one, see open_shared_pools), with a bounded number of files in flight; a shared
+        pool that another directory already started is used from the start.
+        """
+        cache = self.get_strip_cache()
+        shared_executor = self._shared_strip_executor
+        executor = shared_executor
+        in_flight: Deque[Tuple[FileContent, Optional[Future]]] = deque()
+        window = max(1, self.strip_workers) * 4
+        seen_chars = 0
+
+        def finish(content: FileContent, result: Tuple[str, Optional[Dict[str, Tuple[int, int]]]]) -> FileContent:
+            stripped_text, stats = result
+            if stats and compaction_stats is not None:
+                for name, (bytes_in, bytes_out) in stats.items():
+                    totals = compaction_stats.setdefault(name, [0, 0])
+                    totals[0] += bytes_in
+                    totals[1] += bytes_out
+            if cache is not None:
+                cache.store(content.path, content.stat, content.content_hash or hash_text(content.text), stripped_text)
+            content.text, content.stripped = stripped_text, True
+            return content
+
+        try:
+            for content in files:
+                if not isinstance(content, FileContent):
+                    content = FileContent(*content)
+                if content.stripped:
+                    if in_flight:
+                        in_flight.append((content, None))
+                    else:
+                        yield content
+                    continue
+
+                if executor is None and self.strip_workers > 1 and seen_chars >= PARALLEL_STRIP_MIN_CHARS:
+                    shared_executor = self.shared_strip_executor()
+                    executor = shared_executor or ProcessPoolExecutor(max_workers=self.strip_workers)
+                seen_chars += len(content.text)
+
+                stripper = self.get_stripper(content.path)
+                if executor is None:
+                    yield finish(content, run_stripper(stripper, content.text))
+                    continue
+
+                in_flight.append((content, executor.submit(run_stripper, stripper, content.text)))
+                while len(in_flight) >= window or (in_flight and in_flight[0][1] is None):
+                    done, future = in_flight.popleft()
+                    yield finish(done, future.result()) if future is not None else done
+
+            while in_flight:
+                done, future = in_flight.popleft()
+                yield finish(done, future.result()) if future is not None else done
+        finally:
+            if executor is not None:
+                for _, future in in_flight:
+                    if future is not None:
+                        future.cancel()
+                if executor is not shared_executor:
+                    executor.shutdown()
+            if cache is not None:
+                cache.flush()
+
+    def consolidate_directory(self, folder: str, extensions: List[str], max_size_kb: int = 128,
+                              write_up_a_level: bool = True, gitignore_root: Optional[str] = None,
+                              pipeline: Optional[PipelineStats] = None) -> Optional[str]:
+        """Run the streaming discover -> read -> strip -> write pipeline over one folder.
+
+        Returns the output path, or None when there was nothing to write. Pass ``pipeline`` to see the
+        counts and timings of each stage afterwards.
+        """
+        if pipeline is None:
+            pipeline = PipelineStats()
+        discovered = None
+        if self.git_index is not None:
+            discovered = self.iter_git_index_files(folder, extensions, max_size_kb, gitignore_root,
+                                                   untracked=self.git_index == 'all')
+        if discovered is None:
+            discovered = self.iter_hierarchy_files(folder, extensions, max_size_kb, gitignore_root=gitignore_root)
+        paths = pipeline.stage("Discover").track(discovered, measure=None)
+        contents = pipeline.stage("Read").track(self.iter_file_contents(paths))
+        output_path = self.combine_files_with_path_headers(folder, contents, write_up_a_level, pipeline)
+        logger.info("Found %s files in %s.", pipeline.stages[0].files, os.path.basename(folder))
+        if self.profile is not None:
+            for stage in pipeline.stages:
+                self.profile.add_time((stage.name.lower(),), stage.seconds)
+        return output_path
+
+    @staticmethod
+    def get_output_path(folder: str, write_up_a_level: bool = True) -> str:
+        """Name the output file after the folder, with a timestamp so earlier outputs are never overwritten."""
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         base_dir_name = os.path.basename(folder)
         safe_dir_name = base_dir_name.replace(os.sep, "_").replace(":", "").strip("_")
@@ -430,31 +2214,117 @@ class FileHandler:
             output_folder = os.path.dirname(folder)
         else:
             output_folder = folder
-        output_path = os.path.join(output_folder, filename)
-
-        print(f"\nWriting to {output_path}")
-
-        non_empty_files = {path: content for path, content in files_by_path.items() if content.strip()}
-
-        if not non_empty_files:
-            print("No non-empty files to write. Skipping output file creation.")
-            return
-
-        with open(output_path, 'w', encoding='utf-8') as combined_file:
-            # Write header with settings information
-            combined_file.write(f"# Files Consolidation Output\n")
-            combined_file.write(f"# {'=' * 20}\n\n")
-
-            for path, text in non_empty_files.items():
-                # Apply regex stripping
-                for pattern, flags in self.strip_regex:
-                    text = re.sub(pattern, '', text, flags=flags)
-
-                # Write relative path for better readability
-                rel_path = os.path.relpath(path, folder)
-                combined_file.write(f"\n# File: {rel_path}\n\n{text}")
-
-        print(f"Successfully wrote {len(non_empty_files)} non-empty files to {output_path}")
+        return os.path.join(output_folder, filename)
+
+    def combine_files_with_path_headers(self, folder: str,
+                                        files_by_path: Union[Dict[str, str], Iterable[FileContent],
+                                                             Iterable[Tuple[str, str]]],
+                                        write_up_a_level: bool = True,
+                                        pipeline: Optional[PipelineStats] = None) -> Optional[str]:
+        """Strip and write files to the consolidated output, one at a time as they arrive.
+
+        ``files_by_path`` is a dict, or any iterable of pipeline entries or ``(path, text)`` pairs; the output
+        file is only created once the first non-empty file is ready. Returns the output path (the manifest's, when
+        one is written), or None if nothing was written.
+        """
+        output_path = self.get_output_path(folder, write_up_a_level)
+        logger.info("Writing to %s", output_path)
+
+        if pipeline is None:
+            pipeline = PipelineStats()
+        files = files_by_path.items() if isinstance(files_by_path, dict) else files_by_path
+        contents = (content if isinstance(content, FileContent) else FileContent(*content) for content in files)
+        non_empty_files = (content for content in contents if content.stripped or content.text.strip())
+        compaction_stats: Dict[str, List[int]] = {}
+        stripped_files = pipeline.stage("Strip").track(self.iter_stripped_files(non_empty_files, compaction_stats))
+        write_stage = pipeline.stage("Write")
+        if self.chunk_size is not None:
+            return self.export_chunks(folder, os.path.splitext(output_path)[0] + '.chunks.jsonl', stripped_files,
+                                      pipeline, write_stage, compaction_stats)
+
+        manifest_path = os.path.splitext(output_path)[0] + '.manifest.json' if self.write_manifest else None
+        symbol_index = SymbolIndex(symbol_index_path(output_path)) if self.symbol_index else None
+        writer = OutputWriter(output_path, self.shard_bytes, self.compression, manifest_path, symbol_index)
+        deduplicator = Deduplicator(self.near_duplicates, self.load_stripped_text) if self.dedup else None
+        start = time.perf_counter()
+        try:
+            if self.budget is None:
+                sections = ((content, content.text, None) for content in stripped_files)
+            else:
+                # Ranking needs every file, so a budgeted run collects the stripped files before writing
+                sections = self.fit_to_budget(folder, stripped_files)
+            for content, text, note in sections:
+                rel_path = os.path.relpath(content.path, folder)
+                # Files written whole can be reloaded as the base of a later near-duplicate's diff
+                duplicate = (deduplicator.check(rel_path, text, content.path if note is None else None)
+                             if deduplicator is not None else None)
+                if duplicate is not None:
+                    text, note, identical_to = duplicate
+                    writer.write_section(rel_path, text, note, identical_to)
+                else:
+                    writer.write_section(rel_path, text, note)
+                write_stage.add(text)
+        finally:
+            result_path = writer.close()
+        write_stage.inclusive_seconds = time.perf_counter() - start
+        pipeline.report()
+        report_compaction(compaction_stats)
+        if deduplicator is not None:
+            deduplicator.report()
+        if self._strip_cache is not None:
+            self._strip_cache.report()
+
+        if result_path is None:
+            logger.info("No non-empty files to write. Skipping output file creation.")
+            return None
+
+        if len(writer.shards) > 1:
+            logger.info("Successfully wrote %s non-empty files to %s shards, indexed in %s",
+                        write_stage.files, len(writer.shards), result_path)
+        else:
+            logger.info("Successfully wrote %s non-empty files to %s", write_stage.files, result_path)
+        if symbol_index is not None:
+            logger.info("Indexed %s identifier occurrences in %s", symbol_index.occurrence_count,
+                        symbol_index.index_path)
+        return result_path
+
+    def export_chunks(self, folder: str, output_path: str, stripped_files: Iterable[FileContent],
+                      pipeline: PipelineStats, write_stage: StageStats,
+                      compaction_stats: Dict[str, List[int]]) -> Optional[str]:
+        """Write ``stripped_files`` as chunks (see ChunkExporter) as they arrive.
+
+        With the cache, only chunks that ``folder``'s previous export did not have are written, followed by the
+        ids of those it had that are gone; the cache then remembers this export. Returns the output path, or
+        None when nothing changed.
+        """
+        cache = self.get_strip_cache()
+        folder_key = os.path.abspath(folder)
+        exported = cache.exported_chunks(folder_key) if cache is not None else None
+        exporter = ChunkExporter(output_path, budget_measure(self.budget_unit), self.chunk_size, self.chunk_overlap,
+                                 exported)
+        start = time.perf_counter()
+        try:
+            for content in stripped_files:
+                exporter.add_file(os.path.relpath(content.path, folder).replace(os.sep, '/'), content.text)
+                write_stage.add(content.text)
+            result_path = exporter.finish()
+        finally:
+            exporter.close()
+        if cache is not None:
+            cache.replace_exported_chunks(folder_key, exporter.produced)
+        write_stage.inclusive_seconds = time.perf_counter() - start
+        pipeline.report()
+        report_compaction(compaction_stats)
+        if self._strip_cache is not None:
+            self._strip_cache.report()
+
+        logger.info("Chunks: %s written, %s unchanged since the last export, %s deleted", exporter.written,
+                    exporter.skipped, exporter.deleted)
+        if result_path is None:
+            logger.info("No new or changed chunks. Skipping output file creation.")
+            return None
+        logger.info("Successfully wrote chunks of %s files to %s", write_stage.files, result_path)
+        return result_path
 
 
 additional_ignore = """
@@ -466,63 +2336,272 @@ dist/
 build/
 """
 
-if __name__ == "__main__":
-    default_extensions = [
-        "c", "h", "cpp", "hpp", "txt", "md",
-        "py", "java", "js", "html", "css", "json", "xml", "yaml",
-        "cs", "sh", "bat", "mjs", "json",
-        "razor", "cshtml", "vbhtml",
-        "js", "ts", "tsx", "jsx",
-        "idl",
-        # FACE-specific additions
-        "face", "acfg", "stg",
-        # Ada
-        "adb", "ads",
-        # Build/config
-        "cmake", "mak", "cfg", "ini", "properties", "def",
-        # Documentation
-        "adoc", "rst",
-        # Testing
-        "gold", "javagold",
-        # Generated
-        "hh", "cc",
-        # Scripts
-        "ps1", "psm1",
-        # Protocol definitions
-        "proto", "thrift"
-    ]
-
-    file_handler = FileHandler(".", default_extensions, additional_ignore)
-
-    # Get user inputs
-    directory = file_handler.get_directory()
-    respect_gitignore = file_handler.ask_respect_gitignore()
-    file_handler.respect_gitignore = respect_gitignore
-
-    # Initialize gitignore manager after getting directory
-    file_handler.initialize_gitignore_manager(directory)
-
-    extension_list = file_handler.get_extension_list()
-    process_child_dirs = file_handler.ask_process_child_dirs()
-
-    if process_child_dirs:
-        child_directories = file_handler.get_child_directories(directory)
-        directories_to_process = child_directories
+DEFAULT_EXTENSIONS = [
+    "c", "h", "cpp", "hpp", "txt", "md",
+    "py", "java", "js", "html", "css", "json", "xml", "yaml",
+    "cs", "sh", "bat", "mjs", "json",
+    "razor", "cshtml", "vbhtml",
+    "js", "ts", "tsx", "jsx",
+    "idl",
+    # FACE-specific additions
+    "face", "acfg", "stg",
+    # Ada
+    "adb", "ads",
+    # Build/config
+    "cmake", "mak", "cfg", "ini", "properties", "def",
+    # Documentation
+    "adoc", "rst",
+    # Testing
+    "gold", "javagold",
+    # Generated
+    "hh", "cc",
+    # Scripts
+    "ps1", "psm1",
+    # Protocol definitions
+    "proto", "thrift"
+]
+
+
+def consolidate(roots: Union[str, Iterable[str]], extensions: Optional[List[str]] = None,
+                respect_gitignore: bool = True, extra_ignores: str = additional_ignore,
+                child_dirs: bool = False, max_size_kb: int = 64, write_up_a_level: bool = True,
+                parallel_roots: Optional[int] = None, read_workers: int = DEFAULT_READ_WORKERS,
+                strip_workers: int = DEFAULT_STRIP_WORKERS, stat_workers: int = 1,
+                cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                compact: Iterable[str] = (), budget: Optional[int] = None, budget_unit: str = 'tokens',
+                shard_mb: Optional[float] = None, compression: Optional[str] = None, manifest: bool = False,
+                dedup: bool = False, near_duplicates: Optional[float] = None, ignore_index: bool = False,
+                git_index: Optional[str] = None, symbol_index: bool = False, chunk_size: Optional[int] = None,
+                chunk_overlap: int = 0, profile: Optional[RunProfile] = None,
+                file_handler: Optional[FileHandler] = None) -> Dict[str, Optional[str]]:
+    """Consolidate one or more directories without prompting.
+
+    Every root (or, with ``child_dirs``, every child directory of every root) is processed concurrently,
+    up to ``parallel_roots`` at a time, through one shared FileHandler: a single GitIgnoreManager, stat
+    cache and strip cache serve all of them, and their files are read and stripped on one shared pool of
+    workers (see FileHandler.open_shared_pools). Progress is logged as each directory finishes, and a directory
+    that fails is reported without stopping the others. ``compact`` selects COMPACTION_PASSES (or 'all') to shrink the
+    output, and ``budget`` caps each output at that many ``budget_unit`` (tokens or bytes). ``shard_mb``,
+    ``compression`` ('gzip' or 'zstd') and ``manifest`` choose the output layout (see OutputWriter); ``dedup``
+    and ``near_duplicates`` collapse repeated files (see Deduplicator); ``ignore_index`` keeps ignore decisions
+    in the cache for later runs; ``git_index`` ('all' or 'tracked') lists files of git work trees from their
+    index instead of walking them; ``symbol_index`` writes a SymbolIndex next to each output; ``chunk_size`` and
+    ``chunk_overlap`` export JSON Lines chunks instead (see ChunkExporter); ``profile`` collects timings and counters.
+    Pass ``file_handler`` to reuse one that is already warm; the other handler settings are then ignored.
+
+    Returns the output path of each processed directory (None where nothing was written).
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+    roots = [os.path.abspath(root) for root in roots]
+    if not roots:
+        return {}
+
+    if file_handler is None:
+        file_handler = FileHandler(os.getcwd(), extensions or DEFAULT_EXTENSIONS, extra_ignores, respect_gitignore,
+                                   read_workers=read_workers, strip_workers=strip_workers,
+                                   stat_workers=stat_workers, cache_path=cache_path,
+                                   budget=budget, budget_unit=budget_unit,
+                                   shard_mb=shard_mb, compression=compression, manifest=manifest,
+                                   dedup=dedup, near_duplicates=near_duplicates, ignore_index=ignore_index,
+                                   git_index=git_index, symbol_index=symbol_index,
+                                   chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        if compact:
+            file_handler.enable_compaction(compact)
+        file_handler.profile = profile
+    if file_handler.gitignore_manager is None:
+        file_handler.initialize_gitignore_manager(os.path.commonpath(roots))
+    extensions = extensions or file_handler.default_extensions
+
+    # (directory to consolidate, directory whose .gitignore files down to it apply)
+    tasks: List[Tuple[str, str]] = []
+    for root in roots:
+        if child_dirs:
+            tasks.extend((child, root) for child in file_handler.get_child_directories(root))
+        else:
+            tasks.append((root, root))
+
+    def run(task: Tuple[str, str]) -> Optional[str]:
+        directory, gitignore_root = task
+        logger.info("Processing directory: %s", directory)
+        return file_handler.consolidate_directory(directory, extensions, max_size_kb, write_up_a_level,
+                                                  gitignore_root)
+
+    def run_with_progress(task: Tuple[str, str]) -> Optional[str]:
+        # One directory failing does not stop the others; it is reported and gets no output
+        directory, gitignore_root = task
+        logger.info("Processing directory: %s", directory)
+        pipeline = PipelineStats()
+        start = time.perf_counter()
+        try:
+            output_path = file_handler.consolidate_directory(directory, extensions, max_size_kb, write_up_a_level,
+                                                             gitignore_root, pipeline)
+        except Exception as e:
+            progress.finish(directory, pipeline, time.perf_counter() - start, None, e)
+            return None
+        progress.finish(directory, pipeline, time.perf_counter() - start, output_path)
+        return output_path
+
+    if len(tasks) == 1:
+        results = {tasks[0][0]: run(tasks[0])}
+    else:
+        progress = DirectoryProgress(len(tasks))
+        file_handler.open_shared_pools()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, parallel_roots or min(len(tasks), 4))) as executor:
+                results = dict(zip((directory for directory, _ in tasks), executor.map(run_with_progress, tasks)))
+        finally:
+            file_handler.close_shared_pools()
+        progress.report()
+    if file_handler.profile is not None:
+        file_handler.record_profile_counters()
+    return results
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Consolidate a directory's files into a single text file. "
+                    "Without directories, the script asks for its settings interactively.")
+    parser.add_argument("roots", nargs="*", metavar="DIRECTORY",
+                        help="directories to consolidate without prompting (each gets its own output)")
+    parser.add_argument("-e", "--extensions", nargs="+", metavar="EXT",
+                        help="file extensions to include (default: common code file extensions)")
+    parser.add_argument("--no-gitignore", action="store_true", help="do not respect .gitignore files")
+    parser.add_argument("--child-dirs", action="store_true",
+                        help="consolidate each child directory of the given directories separately")
+    parser.add_argument("--max-size-kb", type=int, default=64, help="skip files larger than this (default: 64)")
+    parser.add_argument("--write-inside", action="store_true",
+                        help="write the output inside the directory instead of next to it")
+    parser.add_argument("--parallel-roots", type=int, default=None,
+                        help="directories consolidated at the same time (default: up to 4)")
+    parser.add_argument("--read-workers", type=int, default=DEFAULT_READ_WORKERS,
+                        help=f"threads reading files (default: {DEFAULT_READ_WORKERS})")
+    parser.add_argument("--strip-workers", type=int, default=DEFAULT_STRIP_WORKERS,
+                        help=f"processes stripping files, 1 to strip in-process (default: {DEFAULT_STRIP_WORKERS})")
+    parser.add_argument("--stat-workers", type=int, default=1,
+                        help="threads stat'ing files during discovery; raise on network file systems (default: 1)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, metavar="PATH",
+                        help=f"stripped-text cache file (default: {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the stripped-text cache")
+    parser.add_argument("--ignore-index", action="store_true",
+                        help="also keep each directory's ignore decisions in the cache, so runs over an unchanged "
+                             "tree skip .gitignore matching (redone where a .gitignore above changed)")
+    parser.add_argument("--git-index", nargs="?", choices=GIT_INDEX_MODES, const='all', default=None,
+                        help="in git work trees, list tracked files from .git/index instead of walking the tree; "
+                             "untracked files are still found by a walk unless 'tracked' is given "
+                             "(directories outside git are walked as usual)")
+    parser.add_argument("--compact", nargs="+", metavar="PASS", choices=COMPACTION_PASSES + ('all',), default=[],
+                        help="language-aware compaction passes to shrink the output: "
+                             f"{', '.join(COMPACTION_PASSES)} or all")
+    parser.add_argument("--budget", type=int, default=None,
+                        help="cap each output at this many tokens (or bytes, see --budget-unit); the most valuable "
+                             "files are kept whole and the rest are outlined, truncated or left out")
+    parser.add_argument("--budget-unit", choices=BUDGET_UNITS, default='tokens',
+                        help="unit of --budget and --chunk-size: estimated tokens or UTF-8 bytes (default: tokens)")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="write JSON Lines chunks of at most this size instead of the text output, cut before "
+                             "declarations and headings where possible; with the cache, later runs only write "
+                             "chunks that changed, plus the ids of those that are gone")
+    parser.add_argument("--chunk-overlap", type=int, default=0, metavar="LINES",
+                        help="lines each chunk repeats from the end of the previous one (default: 0)")
+    parser.add_argument("--shard-mb", type=float, default=None,
+                        help="split each output into shards of at most this many MB (uncompressed)")
+    parser.add_argument("--compress", choices=[name for name in COMPRESSION_SUFFIXES if name], default=None,
+                        help="compress the output while writing it (zstd needs the zstandard package)")
+    parser.add_argument("--manifest", action="store_true",
+                        help="write a JSON manifest of each file's shard and byte offset "
+                             "(always written with --shard-mb or --compress)")
+    parser.add_argument("--symbol-index", action="store_true",
+                        help="write a searchable index of identifiers next to each output "
+                             "(<output>.index.sqlite3; query it with consolidate_query.py)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="write files with identical stripped text once; later copies refer to the first")
+    parser.add_argument("--near-duplicates", type=float, nargs="?", const=DEFAULT_NEAR_DUPLICATE_THRESHOLD,
+                        default=None, metavar="SIMILARITY",
+                        help="also write files at least this similar to an earlier one as a diff against it "
+                             f"(implies --dedup; default similarity: {DEFAULT_NEAR_DUPLICATE_THRESHOLD})")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        type=str.upper, help="DEBUG also lists every skipped file (default: INFO)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="save phase timings and counters: JSON if PATH ends in .json, "
+                             "otherwise folded stacks for flamegraph tools")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and rewrite the output whenever files change")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="seconds between checks when inotify is unavailable (default: 2)")
+    parser.add_argument("--debounce", type=float, default=0.5,
+                        help="quiet period in seconds that ends a batch of changes (default: 0.5)")
+    args = parser.parse_args(argv)
+    if args.watch and (len(args.roots) > 1 or args.child_dirs):
+        parser.error("--watch takes a single directory and cannot be combined with --child-dirs")
+    if args.watch and (args.budget is not None or args.shard_mb or args.compress or args.manifest or
+                       args.dedup or args.near_duplicates is not None or args.git_index or args.symbol_index):
+        parser.error("--budget, --shard-mb, --compress, --manifest, --dedup, --near-duplicates, --git-index and "
+                     "--symbol-index cannot be combined with --watch")
+    if args.chunk_size is not None and (args.budget is not None or args.shard_mb or args.compress or args.manifest or
+                                        args.dedup or args.near_duplicates is not None or args.symbol_index or
+                                        args.watch):
+        parser.error("--chunk-size cannot be combined with --budget, --shard-mb, --compress, --manifest, --dedup, "
+                     "--near-duplicates, --symbol-index or --watch")
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error("--chunk-size must be positive")
+    if args.near_duplicates is not None and not 0 < args.near_duplicates <= 1:
+        parser.error("--near-duplicates takes a similarity between 0 and 1")
+    if args.ignore_index and args.no_cache:
+        parser.error("--ignore-index keeps its decisions in the cache and cannot be combined with --no-cache")
+    if args.compress == 'zstd' and zstandard is None:
+        parser.error("--compress zstd needs the zstandard package (pip install zstandard)")
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_arguments(argv)
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    file_handler = FileHandler(".", DEFAULT_EXTENSIONS, additional_ignore,
+                               respect_gitignore=not args.no_gitignore,
+                               read_workers=args.read_workers, strip_workers=args.strip_workers,
+                               stat_workers=args.stat_workers,
+                               cache_path=None if args.no_cache else args.cache,
+                               budget=args.budget, budget_unit=args.budget_unit,
+                               shard_mb=args.shard_mb, compression=args.compress, manifest=args.manifest,
+                               dedup=args.dedup, near_duplicates=args.near_duplicates,
+                               ignore_index=args.ignore_index, git_index=args.git_index,
+                               symbol_index=args.symbol_index,
+                               chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    if args.compact:
+        file_handler.enable_compaction(args.compact)
+    if args.profile:
+        file_handler.profile = RunProfile()
+
+    if args.roots:
+        roots = args.roots
+        extension_list = args.extensions or DEFAULT_EXTENSIONS
+        process_child_dirs = args.child_dirs
+        file_handler.initialize_gitignore_manager(os.path.commonpath([os.path.abspath(root) for root in roots]))
     else:
-        directories_to_process = [directory]
+        # Get user inputs
+        directory = file_handler.get_directory()
+        roots = [directory]
+        file_handler.respect_gitignore = file_handler.ask_respect_gitignore()
 
-    for current_directory in directories_to_process:
-        print(f"\nProcessing directory: {current_directory}")
-        files = file_handler.get_all_hierarchy_files(current_directory, extension_list, 64)
+        # Initialize gitignore manager after getting directory
+        file_handler.initialize_gitignore_manager(directory)
 
-        file_text_contents_by_full_path = {}
-        for file_path in files:
-            try:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    file_text_contents_by_full_path[file_path] = file.read()
-            except Exception as e:
-                print(f"Error reading file {file_path}: {e}")
+        extension_list = file_handler.get_extension_list()
+        process_child_dirs = False if args.watch else file_handler.ask_process_child_dirs()
+
+    if args.watch:
+        ConsolidationWatcher(file_handler, roots[0], extension_list, args.max_size_kb,
+                             write_up_a_level=not args.write_inside,
+                             poll_interval=args.poll_interval, debounce=args.debounce).run()
+        return
 
-        print(f"Found {len(files)} files in {os.path.basename(current_directory)}.")
+    consolidate(roots, extension_list, child_dirs=process_child_dirs, max_size_kb=args.max_size_kb,
+                write_up_a_level=not args.write_inside, parallel_roots=args.parallel_roots,
+                file_handler=file_handler)
+    if file_handler.profile is not None:
+        file_handler.profile.write(args.profile)
 
-        file_handler.combine_files_with_path_headers(current_directory, file_text_contents_by_full_path)
+
+if __name__ == "__main__":
+    main()
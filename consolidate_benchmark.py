@@ -0,0 +1,422 @@
+"""
+Consolidate Benchmarks
+======================
+
+Reproducible benchmarks for consolidate.py. Inputs are generated from a fixed seed, so runs on the
+same machine are comparable before and after a change.
+
+Usage:
+python consolidate_benchmark.py strip [--sizes 1 2 4 8] [--legacy-sizes 0.025 0.05 0.1]
+    Times the stripping engine on synthetic sources of growing size. Linear engines show a flat
+    seconds-per-MB column; the legacy regex passes are timed on smaller inputs for comparison.
+
+python consolidate_benchmark.py tree [--depth 4] [--fanout 4] [--files 6] [--gitignores 24] [--mix ...]
+    Generates a synthetic repository with nested .gitignore files and times GitIgnoreManager.should_ignore,
+    FileHandler.get_all_hierarchy_files and a full consolidation over it. When git is installed, every
+    path is also checked against `git check-ignore` and the walk against `git ls-files --others
+    --exclude-standard`; any disagreement is listed and the exit status is 1.
+
+python consolidate_benchmark.py syscalls [--depth 4] [--fanout 4] [--files 6] [--stat-workers 1 8]
+    Counts the file system calls (directory listings, stats, access checks) file discovery makes on a synthetic
+    tree, for the os.walk loop consolidate.py used to run and for the current scandir walk, and times both.
+"""
+import argparse
+import contextlib
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import consolidate
+
+# The regex passes consolidate.py used before TextStripper, kept here as the comparison baseline
+LEGACY_STRIP_REGEX = [(r'/\*.*?copyright.*?\*/', re.DOTALL | re.IGNORECASE),
+                      (r'^\s*import\s.*;?\s*$', re.MULTILINE),
+                      (r'\n\s*\n+', re.MULTILINE)]
+
+
+def legacy_strip(text: str) -> str:
+    for pattern, flags in LEGACY_STRIP_REGEX:
+        text = re.sub(pattern, '', text, flags=flags)
+    return text
+
+
+def generate_source(size_bytes: int, seed: int = 0) -> str:
+    """Build TypeScript-like source of about ``size_bytes``: one copyright header, then imports, code,
+    blank lines and many ordinary block comments (the worst case for the legacy copyright regex)."""
+    rng = random.Random(seed)
+    parts = ["/*\n * Copyright (c) 2024 Example Corp. All rights reserved.\n */\n"]
+    size = len(parts[0])
+    counter = 0
+    while size < size_bytes:
+        counter += 1
+        kind = rng.random()
+        if kind < 0.15:
+            chunk = f"import {{ Thing{counter} }} from './module{counter}';\n"
+        elif kind < 0.35:
+            chunk = f"/* Helper number {counter}\n   explains what comes next. */\n"
+        elif kind < 0.45:
+            chunk = "\n\n   \n"
+        else:
+            chunk = (f"export function helper{counter}(value: number): number {{\n"
+                     f"    return value * {counter} /* scale */ + {rng.randint(0, 99)};\n}}\n")
+        parts.append(chunk)
+        size += len(chunk)
+    return ''.join(parts)
+
+
+def best_time(fn: Callable, *args, repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_strip(sizes_mb: List[float], legacy_sizes_mb: List[float]):
+    """Print time and seconds per MB for each input size; linear engines keep seconds per MB flat."""
+    engines = [("TextStripper", consolidate.TextStripper(), sizes_mb),
+               ("legacy regex", legacy_strip, legacy_sizes_mb)]
+    print(f"{'engine':<14}{'size MB':>10}{'seconds':>12}{'s per MB':>12}{'MB/s':>10}")
+    for name, engine, sizes in engines:
+        for size_mb in sizes:
+            text = generate_source(int(size_mb * 1024 * 1024))
+            seconds = best_time(engine, text)
+            megabytes = len(text) / (1024 * 1024)
+            print(f"{name:<14}{megabytes:>10.3f}{seconds:>12.4f}{seconds / megabytes:>12.4f}"
+                  f"{megabytes / max(seconds, 1e-9):>10.1f}")
+
+
+# Extensions of generated files; the consolidation run includes all of them
+TREE_EXTENSIONS = ['py', 'ts', 'md', 'json', 'log', 'tmp']
+TREE_DIRECTORY_NAMES = ['src', 'lib', 'build', 'docs', 'cache', 'test', 'logs', 'vendor', 'dist', 'gen']
+# Pattern kinds a synthetic .gitignore can draw from; each makes a pattern valid in the file's directory
+PATTERN_KINDS: Dict[str, Callable[[random.Random, List[str], List[str]], str]] = {
+    'name': lambda rng, dirs, files: rng.choice(files),
+    'anchored': lambda rng, dirs, files: '/' + rng.choice(dirs + files),
+    'dir': lambda rng, dirs, files: rng.choice(TREE_DIRECTORY_NAMES) + '/',
+    'glob': lambda rng, dirs, files: rng.choice(['*.', 'file_1*.', '*_[0-4].']) + rng.choice(TREE_EXTENSIONS),
+    'path': lambda rng, dirs, files: f"{rng.choice(dirs)}/{rng.choice(['*.log', 'file_0.py', 'cache/'])}"
+    if dirs else '*.tmp',
+    'doublestar': lambda rng, dirs, files: rng.choice(['**/', '**/cache/', 'src/**/', '**/logs/**/']) +
+    rng.choice(['*.log', 'file_2.*', 'gen', 'test/']),
+    'negation': lambda rng, dirs, files: '!' + rng.choice(files + [f"{name}/" for name in TREE_DIRECTORY_NAMES] +
+                                                          ['*.py', 'file_[0-2].*', '**/keep_*']),
+    'escaped': lambda rng, dirs, files: rng.choice(['\\#file_0.md', '\\!file_1.ts', 'file_?.tmp\\ ',
+                                                    'file_[!0-2].json', '# comment', '']),
+}
+
+
+def generate_tree(root: str, depth: int, fanout: int, files_per_directory: int, gitignore_count: int,
+                  patterns_per_gitignore: int, mix: List[str], seed: int = 0) -> Tuple[List[str], List[str]]:
+    """Create a random directory tree under ``root`` and return its relative directory and file paths.
+
+    ``gitignore_count`` directories (the root always among them) get a .gitignore of patterns drawn from
+    the PATTERN_KINDS in ``mix``, built from names that exist below that directory so they actually match.
+    """
+    rng = random.Random(seed)
+    directories = ['']
+    files = []
+    children: Dict[str, List[str]] = {'': []}
+    for index, directory in enumerate(directories):
+        level = directory.count('/') + 1 if directory else 0
+        for number in range(files_per_directory):
+            extension = rng.choice(TREE_EXTENSIONS)
+            name = f"file_{number}.{extension}"
+            files.append(f"{directory}/{name}" if directory else name)
+        if level < depth:
+            for name in rng.sample(TREE_DIRECTORY_NAMES, min(fanout, len(TREE_DIRECTORY_NAMES))):
+                child = f"{directory}/{name}" if directory else name
+                directories.append(child)
+                children[child] = []
+                children[directory].append(name)
+
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    for rel_path in files:
+        with open(os.path.join(root, rel_path), 'w', encoding='utf-8') as file:
+            file.write(f"// {rel_path}\nexport const value = {rng.randint(0, 1000)};\n")
+
+    # File names found anywhere below each directory
+    names_below: Dict[str, Set[str]] = {directory: set() for directory in directories}
+    for rel_path in files:
+        directory, _, name = rel_path.rpartition('/')
+        while True:
+            names_below[directory].add(name)
+            if not directory:
+                break
+            directory = directory.rpartition('/')[0]
+
+    gitignore_directories = [''] + rng.sample(directories[1:], min(gitignore_count - 1, len(directories) - 1))
+    for directory in gitignore_directories:
+        file_names = sorted(names_below[directory])
+        patterns = [PATTERN_KINDS[rng.choice(mix)](rng, children[directory], file_names)
+                    for _ in range(patterns_per_gitignore)]
+        with open(os.path.join(root, directory, '.gitignore'), 'w', encoding='utf-8') as gitignore:
+            gitignore.write('\n'.join(patterns) + '\n')
+    return directories[1:], files
+
+
+def git_oracle(root: str, paths: List[str]) -> Optional[Tuple[Set[str], Set[str]]]:
+    """Ask git which of ``paths`` are ignored, and which files it would list as untracked; None without git."""
+    if shutil.which('git') is None:
+        return None
+    subprocess.run(['git', 'init', '-q', root], check=True)
+    check = subprocess.run(['git', 'check-ignore', '--no-index', '--stdin', '-z'], cwd=root, check=False,
+                           input='\0'.join(paths).encode('utf-8'), stdout=subprocess.PIPE)
+    ignored = set(filter(None, check.stdout.decode('utf-8').split('\0')))
+    listing = subprocess.run(['git', 'ls-files', '--others', '--exclude-standard', '-z'], cwd=root, check=True,
+                             stdout=subprocess.PIPE)
+    untracked = set(filter(None, listing.stdout.decode('utf-8').split('\0')))
+    return ignored, untracked
+
+
+def make_file_handler(root: str) -> consolidate.FileHandler:
+    """A FileHandler that applies .gitignore files only, so its results are comparable with git's."""
+    handler = consolidate.FileHandler(root, TREE_EXTENSIONS, respect_gitignore=True, strip_workers=1)
+    handler.ignored_folders = ['.git']
+    handler.ignored_files = ['.gitignore']
+    handler.initialize_gitignore_manager(root)
+    return handler
+
+
+def report_mismatches(title: str, paths: Set[str]) -> int:
+    if paths:
+        print(f"{title}: {len(paths)}")
+        for path in sorted(paths)[:20]:
+            print(f"    {path}")
+    return len(paths)
+
+
+def benchmark_tree(depth: int, fanout: int, files_per_directory: int, gitignore_count: int,
+                   patterns_per_gitignore: int, mix: List[str], seed: int, keep: Optional[str]) -> int:
+    """Time the ignore and discovery machinery on a synthetic tree; returns the number of disagreements with git."""
+    workspace = keep or tempfile.mkdtemp(prefix='consolidate_benchmark_')
+    root = os.path.join(workspace, 'repo')
+    shutil.rmtree(root, ignore_errors=True)
+    try:
+        start = time.perf_counter()
+        directories, files = generate_tree(root, depth, fanout, files_per_directory, gitignore_count,
+                                           patterns_per_gitignore, mix, seed)
+        print(f"Generated {len(directories)} directories, {len(files)} files, {gitignore_count} .gitignore files "
+              f"in {time.perf_counter() - start:.2f}s ({root})")
+        paths = directories + files
+        oracle = git_oracle(root, paths)
+
+        manager = consolidate.GitIgnoreManager(root)
+        cold = best_time(lambda: [manager.should_ignore(os.path.join(root, path)) for path in paths], repeat=1)
+        warm = best_time(lambda: [manager.should_ignore(os.path.join(root, path)) for path in paths])
+        walked = []
+        walk = best_time(lambda: walked.append(make_file_handler(root).get_all_hierarchy_files(
+            root, TREE_EXTENSIONS, max_size_kb=1024)))
+        end_to_end = best_time(lambda: make_file_handler(root).consolidate_directory(
+            root, TREE_EXTENSIONS, max_size_kb=1024, write_up_a_level=True))
+
+        print(f"{'benchmark':<34}{'seconds':>10}{'per path us':>14}")
+        for name, seconds, count in [("should_ignore (cold)", cold, len(paths)),
+                                     ("should_ignore (warm match cache)", warm, len(paths)),
+                                     ("get_all_hierarchy_files", walk, len(paths)),
+                                     ("consolidate_directory", end_to_end, len(paths))]:
+            print(f"{name:<34}{seconds:>10.4f}{seconds / max(count, 1) * 1e6:>14.2f}")
+
+        if oracle is None:
+            print("git not found; skipping the correctness check")
+            return 0
+        ignored, untracked = oracle
+        found = {os.path.relpath(path, root).replace(os.sep, '/') for path in walked[-1]}
+        expected = {path for path in untracked
+                    if path.endswith(tuple(TREE_EXTENSIONS)) and os.path.basename(path) != '.gitignore'}
+        ours = {path for path in paths if manager.should_ignore(os.path.join(root, path))}
+        mismatches = (report_mismatches("should_ignore says ignored, git does not", ours - ignored) +
+                      report_mismatches("git says ignored, should_ignore does not", ignored - ours) +
+                      report_mismatches("walked but not listed by git", found - expected) +
+                      report_mismatches("listed by git but not walked", expected - found))
+        print(f"git check-ignore agrees on {len(paths) - len(ours ^ ignored)} of {len(paths)} paths; "
+              f"walk {'matches' if found == expected else 'differs from'} git ls-files ({len(found)} files)")
+        return mismatches
+    finally:
+        if keep is None:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+class CountingDirEntry:
+    """Wraps an os.DirEntry to count the stat calls it makes; its type checks come from the listing."""
+
+    def __init__(self, entry: os.DirEntry, counts: Counter):
+        self._entry = entry
+        self._counts = counts
+        self._stat = None
+
+    def __getattr__(self, name: str):
+        return getattr(self._entry, name)
+
+    def __fspath__(self) -> str:
+        return self._entry.path
+
+    def stat(self, *, follow_symlinks: bool = True) -> os.stat_result:
+        if not follow_symlinks:
+            return self._entry.stat(follow_symlinks=False)
+        if self._stat is None:
+            self._counts['stat'] += 1
+            self._stat = self._entry.stat()
+        return self._stat
+
+
+class CountingScandir:
+    """An os.scandir iterator whose entries count their stat calls."""
+
+    def __init__(self, iterator, counts: Counter):
+        self._iterator = iterator
+        self._counts = counts
+
+    def __iter__(self) -> 'CountingScandir':
+        return self
+
+    def __next__(self) -> CountingDirEntry:
+        return CountingDirEntry(next(self._iterator), self._counts)
+
+    def __enter__(self) -> 'CountingScandir':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._iterator.close()
+
+
+@contextlib.contextmanager
+def count_file_system_calls() -> Iterator[Counter]:
+    """Count calls of os.scandir, os.stat, os.lstat and os.access (which os.path.isdir, getsize and exists use)
+    and stats through DirEntry, while the block runs."""
+    counts: Counter = Counter()
+    originals = {name: getattr(os, name) for name in ('scandir', 'stat', 'lstat', 'access')}
+
+    def counting(name: str) -> Callable:
+        def call(*args, **kwargs):
+            counts[name] += 1
+            return originals[name](*args, **kwargs)
+        return call
+
+    def scandir(path='.') -> CountingScandir:
+        counts['scandir'] += 1
+        return CountingScandir(originals['scandir'](path), counts)
+
+    os.scandir = scandir
+    os.stat, os.lstat, os.access = counting('stat'), counting('lstat'), counting('access')
+    try:
+        yield counts
+    finally:
+        for name, function in originals.items():
+            setattr(os, name, function)
+
+
+def legacy_discover(handler: consolidate.FileHandler, folder: str, extensions: List[str],
+                    max_size_kb: int) -> List[str]:
+    """File discovery as consolidate.py did it before the scandir walk: os.walk, then per path should_ignore
+    (which stats to tell directories from files), os.access and os.path.getsize."""
+    found = []
+    manager = handler.gitignore_manager
+    for root, dirs, file_list in os.walk(folder):
+        dirs[:] = [name for name in dirs if name not in handler.ignored_folders and
+                   not manager.should_ignore(os.path.join(root, name))]
+        for name in file_list:
+            full_path = os.path.join(root, name)
+            if (handler.is_generated_file(name) or name in handler.ignored_files or
+                    not name.endswith(tuple(extensions)) or manager.should_ignore(full_path)):
+                continue
+            if os.access(full_path, os.R_OK) and 0 < os.path.getsize(full_path) <= max_size_kb * 1024:
+                found.append(full_path)
+    return found
+
+
+def benchmark_syscalls(depth: int, fanout: int, files_per_directory: int, stat_workers: List[int], seed: int):
+    """Print file system calls and time per discovery method; every method must find the same files."""
+    workspace = tempfile.mkdtemp(prefix='consolidate_benchmark_')
+    root = os.path.join(workspace, 'repo')
+    try:
+        directories, files = generate_tree(root, depth, fanout, files_per_directory, 1, 4, ['glob', 'dir'], seed)
+        print(f"Generated {len(directories)} directories, {len(files)} files ({root})")
+
+        def scandir_walk(workers: int) -> Callable[[], List[str]]:
+            def discover():
+                handler = make_file_handler(root)
+                handler.stat_workers = workers
+                return handler.get_all_hierarchy_files(root, TREE_EXTENSIONS, max_size_kb=1024)
+            return discover
+
+        methods = [("os.walk + access/getsize/isdir",
+                    lambda: legacy_discover(make_file_handler(root), root, TREE_EXTENSIONS, 1024))]
+        methods += [(f"scandir walk, {workers} stat thread{'s' if workers > 1 else ''}", scandir_walk(workers))
+                    for workers in stat_workers]
+
+        print(f"{'method':<34}{'seconds':>10}{'calls':>9}{'per file':>10}{'scandir':>9}{'stat':>8}{'lstat':>7}"
+              f"{'access':>8}")
+        expected = None
+        for name, discover in methods:
+            with count_file_system_calls() as counts:
+                found = sorted(discover())
+            if expected is None:
+                expected = found
+            elif found != expected:
+                print(f"{name} found {len(found)} files instead of {len(expected)}")
+            seconds = best_time(discover)
+            total = sum(counts.values())
+            print(f"{name:<34}{seconds:>10.4f}{total:>9}{total / max(len(files), 1):>10.2f}{counts['scandir']:>9}"
+                  f"{counts['stat']:>8}{counts['lstat']:>7}{counts['access']:>8}")
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for consolidate.py")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    strip_parser = subparsers.add_parser("strip", help="time the stripping engine on growing inputs")
+    strip_parser.add_argument("--sizes", type=float, nargs="+", default=[1, 2, 4, 8],
+                              help="input sizes in MB for TextStripper (default: 1 2 4 8)")
+    strip_parser.add_argument("--legacy-sizes", type=float, nargs="*", default=[0.025, 0.05, 0.1],
+                              help="input sizes in MB for the legacy regexes, which grow quadratically "
+                                   "(default: 0.025 0.05 0.1)")
+    tree_parser = subparsers.add_parser("tree", help="time ignore checks and discovery on a synthetic repository, "
+                                                     "checked against git")
+    tree_parser.add_argument("--depth", type=int, default=4, help="directory levels below the root (default: 4)")
+    tree_parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory (default: 4)")
+    tree_parser.add_argument("--files", type=int, default=6, help="files per directory (default: 6)")
+    tree_parser.add_argument("--gitignores", type=int, default=24, help=".gitignore files (default: 24)")
+    tree_parser.add_argument("--patterns", type=int, default=6, help="patterns per .gitignore (default: 6)")
+    tree_parser.add_argument("--mix", nargs="+", choices=sorted(PATTERN_KINDS), default=sorted(PATTERN_KINDS),
+                             help="pattern kinds to draw from (default: all)")
+    tree_parser.add_argument("--seed", type=int, default=0)
+    tree_parser.add_argument("--keep", metavar="DIR", help="generate the tree in DIR and keep it")
+    syscalls_parser = subparsers.add_parser("syscalls", help="count and time the file system calls of file discovery")
+    syscalls_parser.add_argument("--depth", type=int, default=4, help="directory levels below the root (default: 4)")
+    syscalls_parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory (default: 4)")
+    syscalls_parser.add_argument("--files", type=int, default=6, help="files per directory (default: 6)")
+    syscalls_parser.add_argument("--stat-workers", type=int, nargs="+", default=[1, 8],
+                                 help="stat thread counts to run the scandir walk with (default: 1 8)")
+    syscalls_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if args.benchmark == "strip":
+        benchmark_strip(args.sizes, args.legacy_sizes)
+    elif args.benchmark == "tree":
+        mismatches = benchmark_tree(args.depth, args.fanout, args.files, args.gitignores, args.patterns,
+                                    args.mix, args.seed, args.keep)
+        sys.exit(1 if mismatches else 0)
+    elif args.benchmark == "syscalls":
+        benchmark_syscalls(args.depth, args.fanout, args.files, args.stat_workers, args.seed)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Strip Cache
+===========
+
+The SQLite cache consolidate.py keeps between runs: stripped file text, token estimates and ignore decisions,
+each reused while the file (or .gitignore) it came from is unchanged.
+"""
+import json
+import logging
+import os
+import sqlite3
+import stat
+import threading
+import time
+from typing import Dict, Optional
+
+# Logs through consolidate.py's logger, so its --log-level applies here too
+logger = logging.getLogger("consolidate")
+
+# Shared by all runs of all roots, so warmed entries are reused whichever directory is consolidated
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "consolidate", "strip_cache.sqlite3")
+# Bump when the stripping code changes in a way the strip patterns alone don't capture
+CACHE_FORMAT_VERSION = 3
+# Bump when the cache tables change; a cache file with another schema is emptied and recreated
+CACHE_SCHEMA_VERSION = 2
+# Cached text, token estimates and ignore decisions not used for this long are pruned when the cache is opened, so
+# entries of deleted files, old revisions and repositories no longer consolidated do not pile up
+CACHE_MAX_AGE_SECONDS = 30 * 24 * 3600
+# An entry's last-used time is only rewritten once it is this old, so cache hits rarely cost a write
+CACHE_TOUCH_SECONDS = 24 * 3600
+# Files modified this recently may change again within the same mtime tick, so their stat is not trusted
+RACY_MTIME_SECONDS = 2.0
+# Bump when the ignore rules change meaning, so decisions indexed by the previous version are not reused
+IGNORE_INDEX_VERSION = 2
+
+
+class StripCache:
+    """Persistent cache of stripped file text, keyed by path + mtime + size with a content-hash fallback.
+
+    Backed by SQLite so lookups never load the whole cache into memory. Entries are only valid for the
+    strip configuration (``signature``) that produced them. Safe to share between threads.
+
+    Each entry records when it was last used; opening the cache deletes those unused for ``max_age_seconds``.
+    """
+
+    def __init__(self, cache_path: str, signature: str, max_age_seconds: float = CACHE_MAX_AGE_SECONDS):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.cache_path = cache_path
+        self.signature = signature
+        self.stat_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+            for table in ('stripped_files', 'token_estimates', 'ignore_decisions', 'exported_chunks'):
+                self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self._connection.execute(f"PRAGMA user_version = {CACHE_SCHEMA_VERSION}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS stripped_files ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "content_hash TEXT NOT NULL, signature TEXT NOT NULL, stripped TEXT NOT NULL, used INTEGER NOT NULL)")
+        # Token estimates of stripped text, keyed by its hash so they survive renames and re-strips
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_estimates ("
+            "text_hash TEXT NOT NULL, estimator TEXT NOT NULL, estimate INTEGER NOT NULL, used INTEGER NOT NULL, "
+            "PRIMARY KEY (text_hash, estimator))")
+        # Ignore decisions for the entries of each directory, valid while the .gitignore files above it
+        # are unchanged (``fingerprint``); ``context`` identifies the walk settings they were made under
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS ignore_decisions ("
+            "directory TEXT NOT NULL, context TEXT NOT NULL, fingerprint TEXT NOT NULL, decisions TEXT NOT NULL, "
+            "used INTEGER NOT NULL, PRIMARY KEY (directory, context))")
+        # Chunk ids of the last chunk export of each folder, so the next one only writes what changed
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS exported_chunks ("
+            "folder TEXT NOT NULL, id TEXT NOT NULL, path TEXT NOT NULL, "
+            "PRIMARY KEY (folder, id))")
+        self.prune(max_age_seconds)
+
+    def prune(self, max_age_seconds: float):
+        """Delete the cached text, token estimates and ignore decisions not used for ``max_age_seconds``."""
+        cutoff = int(time.time() - max_age_seconds)
+        with self._lock:
+            removed = sum(self._connection.execute(f"DELETE FROM {table} WHERE used < ?", (cutoff,)).rowcount
+                          for table in ('stripped_files', 'token_estimates', 'ignore_decisions'))
+            self._connection.commit()
+            self._uncommitted = 0
+        if removed:
+            logger.debug("Cache: pruned %s entries unused for %.0f days", removed, max_age_seconds / 86400)
+
+    def _touch(self, table: str, key_columns: str, key: tuple, used: int):
+        """Record that an entry was used, unless that was already recorded recently (call with the lock held)."""
+        now = int(time.time())
+        if used < now - CACHE_TOUCH_SECONDS:
+            self._connection.execute(f"UPDATE {table} SET used = ? WHERE {key_columns}", (now, *key))
+            self._uncommitted += 1
+
+    def lookup(self, path: str, stat: os.stat_result) -> Optional[str]:
+        """Return the stripped text of an unchanged file, judged by its mtime and size alone."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT stripped, used FROM stripped_files "
+                "WHERE path = ? AND mtime_ns = ? AND size = ? AND signature = ?",
+                (path, stat.st_mtime_ns, stat.st_size, self.signature)).fetchone()
+            if row is not None:
+                self.stat_hits += 1
+                self._touch('stripped_files', "path = ?", (path,), row[1])
+        return row[0] if row is not None else None
+
+    def lookup_by_hash(self, path: str, stat: Optional[os.stat_result], content_hash: str) -> Optional[str]:
+        """Return the stripped text of a file whose stat changed but whose content did not, refreshing its stat."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT stripped FROM stripped_files WHERE path = ? AND content_hash = ? AND signature = ?",
+                (path, content_hash, self.signature)).fetchone()
+            if row is None:
+                return None
+            self.hash_hits += 1
+            self._write(path, stat, content_hash, row[0])
+        return row[0]
+
+    def store(self, path: str, stat: Optional[os.stat_result], content_hash: str, stripped: str):
+        with self._lock:
+            self.misses += 1
+            self._write(path, stat, content_hash, stripped)
+
+    def _write(self, path: str, stat: Optional[os.stat_result], content_hash: str, stripped: str):
+        # A racy or missing stat is stored as -1 so the next run verifies the content hash instead
+        trusted_stat = stat is not None and time.time() - stat.st_mtime > RACY_MTIME_SECONDS
+        self._connection.execute(
+            "INSERT OR REPLACE INTO stripped_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (path, stat.st_mtime_ns if trusted_stat else -1, stat.st_size if stat is not None else -1,
+             content_hash, self.signature, stripped, int(time.time())))
+        self._uncommitted += 1
+        if self._uncommitted >= 500:
+            self._connection.commit()
+            self._uncommitted = 0
+
+    def lookup_estimate(self, text_hash: str, estimator: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT estimate, used FROM token_estimates WHERE text_hash = ? AND estimator = ?",
+                (text_hash, estimator)).fetchone()
+            if row is not None:
+                self._touch('token_estimates', "text_hash = ? AND estimator = ?", (text_hash, estimator), row[1])
+        return row[0] if row is not None else None
+
+    def store_estimate(self, text_hash: str, estimator: str, estimate: int):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO token_estimates VALUES (?, ?, ?, ?)",
+                                     (text_hash, estimator, estimate, int(time.time())))
+            self._uncommitted += 1
+
+    def lookup_ignore_decisions(self, directory: str, context: str, fingerprint: str) -> Optional[Dict[str, bool]]:
+        """Return the indexed decisions (entry name, with a trailing '/' for directories -> ignored) of
+        ``directory``, or None if there are none for this fingerprint."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT decisions, used FROM ignore_decisions WHERE directory = ? AND context = ? AND fingerprint = ?",
+                (directory, context, fingerprint)).fetchone()
+            if row is not None:
+                self._touch('ignore_decisions', "directory = ? AND context = ?", (directory, context), row[1])
+        return json.loads(row[0]) if row is not None else None
+
+    def store_ignore_decisions(self, directory: str, context: str, fingerprint: str, decisions: Dict[str, bool]):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO ignore_decisions VALUES (?, ?, ?, ?, ?)",
+                                     (directory, context, fingerprint, json.dumps(decisions, sort_keys=True),
+                                      int(time.time())))
+            self._uncommitted += 1
+
+    def exported_chunks(self, folder: str) -> Dict[str, str]:
+        """The chunk ids (-> path) of the last chunk export of ``folder``."""
+        with self._lock:
+            return dict(self._connection.execute("SELECT id, path FROM exported_chunks WHERE folder = ?", (folder,)))
+
+    def replace_exported_chunks(self, folder: str, chunks: Dict[str, str]):
+        with self._lock:
+            self._connection.execute("DELETE FROM exported_chunks WHERE folder = ?", (folder,))
+            self._connection.executemany("INSERT INTO exported_chunks VALUES (?, ?, ?)",
+                                         ((folder, chunk_id, path) for chunk_id, path in chunks.items()))
+            self._connection.commit()
+            self._uncommitted = 0
+
+    def flush(self):
+        with self._lock:
+            self._connection.commit()
+            self._uncommitted = 0
+
+    def report(self):
+        logger.info("Cache: %s unchanged, %s matched by content, %s stripped (%s)",
+                    self.stat_hits, self.hash_hits, self.misses, self.cache_path)
+
+    def close(self):
+        self.flush()
+        self._connection.close()
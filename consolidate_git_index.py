@@ -0,0 +1,134 @@
+"""
+Git Index
+=========
+
+Lists a git work tree's files straight from .git/index (index versions 2 to 4, sparse indexes included), so
+consolidate.py --git-index can skip walking tracked directories. No git executable is needed.
+"""
+import os
+import struct
+from typing import List, Optional, Tuple
+
+# Git index files, read directly so a work tree's files can be listed without walking it (see read_git_index)
+GIT_INDEX_SIGNATURE = b'DIRC'
+GIT_INDEX_VERSIONS = (2, 3, 4)
+# What --git-index lists: tracked and untracked files (untracked ones are found by a walk), or tracked files only
+GIT_INDEX_MODES = ('all', 'tracked')
+# Per entry: ctime, mtime (seconds and nanoseconds each), dev, ino, mode, uid, gid, size; then the object hash
+_GIT_INDEX_ENTRY = struct.Struct('>10I')
+_GIT_INDEX_EXTENDED = 0x4000
+_GIT_INDEX_SKIP_WORKTREE = 0x4000
+
+
+def find_git_work_tree(directory: str) -> Optional[Tuple[str, str]]:
+    """Return the work tree containing ``directory`` and its git directory, or None outside of git.
+
+    Follows ``.git`` files (``gitdir: ...``), as used by linked worktrees and submodules.
+    """
+    current = os.path.abspath(directory)
+    while True:
+        dot_git = os.path.join(current, '.git')
+        if os.path.isdir(dot_git):
+            return current, dot_git
+        if os.path.isfile(dot_git):
+            try:
+                with open(dot_git, 'r', encoding='utf-8') as file:
+                    line = file.readline().strip()
+            except OSError:
+                return None
+            if not line.startswith('gitdir:'):
+                return None
+            return current, os.path.normpath(os.path.join(current, line[len('gitdir:'):].strip()))
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
+def git_hash_size(git_dir: str) -> int:
+    """Size in bytes of the object hashes in ``git_dir``'s index: 20 (SHA-1), or 32 for SHA-256 repositories."""
+    config_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir'), 'r', encoding='utf-8') as file:
+            config_dir = os.path.join(git_dir, file.read().strip())
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(config_dir, 'config'), 'r', encoding='utf-8', errors='replace') as file:
+            for line in file:
+                key, _, value = line.partition('=')
+                if key.strip().lower() == 'objectformat' and value.strip().lower() == 'sha256':
+                    return 32
+    except OSError:
+        pass
+    return 20
+
+
+def read_git_index(index_path: str, hash_size: int = 20) -> Tuple[List[str], List[str]]:
+    """Return the paths ('/'-separated, relative to the work tree) of the files and of the submodules recorded
+    in a git index.
+
+    Understands index versions 2 to 4 (version 4 prefix-compresses paths). Sparse-checkout entries that are
+    not in the work tree and sparse directory entries are left out; conflicted paths are listed once. Raises
+    ValueError for files it cannot read, including split indexes, whose entries live partly in a shared index.
+    """
+    with open(index_path, 'rb') as file:
+        data = file.read()
+    if len(data) < 12 or data[:4] != GIT_INDEX_SIGNATURE:
+        raise ValueError(f"{index_path} is not a git index")
+    version, count = struct.unpack_from('>II', data, 4)
+    if version not in GIT_INDEX_VERSIONS:
+        raise ValueError(f"{index_path}: unsupported index version {version}")
+
+    paths: List[str] = []
+    submodules: List[str] = []
+    offset = 12
+    previous = b''
+    try:
+        for _ in range(count):
+            mode = _GIT_INDEX_ENTRY.unpack_from(data, offset)[6]
+            flags_offset = offset + _GIT_INDEX_ENTRY.size + hash_size
+            flags, = struct.unpack_from('>H', data, flags_offset)
+            position = flags_offset + 2
+            extended_flags = 0
+            if flags & _GIT_INDEX_EXTENDED:
+                extended_flags, = struct.unpack_from('>H', data, position)
+                position += 2
+            if version == 4:
+                # The path replaces the last ``strip`` bytes of the previous one (an offset varint) with its own
+                byte = data[position]
+                position += 1
+                strip = byte & 0x7f
+                while byte & 0x80:
+                    byte = data[position]
+                    position += 1
+                    strip = ((strip + 1) << 7) | (byte & 0x7f)
+                end = data.index(b'\0', position)
+                name = previous[:len(previous) - strip] + data[position:end]
+                offset = end + 1
+            else:
+                end = data.index(b'\0', position)
+                name = data[position:end]
+                # Entries are NUL-padded to a multiple of 8 bytes
+                offset += (end - offset + 8) & ~7
+            previous = name
+
+            file_type = mode & 0o170000
+            if extended_flags & _GIT_INDEX_SKIP_WORKTREE:
+                continue
+            path = name.decode('utf-8', 'surrogateescape')
+            if file_type == 0o160000:
+                submodules.append(path)
+            elif file_type in (0o100000, 0o120000) and (not paths or paths[-1] != path):
+                paths.append(path)
+
+        # Extensions follow the entries: a 4-byte signature and a 4-byte size each, then the checksum
+        while offset + 8 <= len(data) - hash_size:
+            signature = data[offset:offset + 4]
+            size, = struct.unpack_from('>I', data, offset + 4)
+            if signature == b'link':
+                raise ValueError(f"{index_path} is a split index")
+            offset += 8 + size
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"{index_path} is truncated or corrupt: {e}")
+    return paths, submodules
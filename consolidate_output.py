@@ -0,0 +1,180 @@
+"""
+Consolidated Output
+===================
+
+Writes consolidate.py's output: the header, one section per file, optional sharding and gzip/zstd compression,
+and the JSON manifest of where each file's text lands. Also reads lines back from shards by byte offset.
+"""
+import gzip
+import json
+import os
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+
+try:
+    import zstandard  # Optional: only needed for zstd-compressed output
+except ImportError:
+    zstandard = None
+
+from consolidate_symbols import SymbolIndex
+
+# Written once at the top of every consolidated output
+OUTPUT_HEADER = f"# Files Consolidation Output\n# {'=' * 20}\n\n"
+
+
+def format_file_section(rel_path: str, text: str, note: Optional[str] = None) -> str:
+    """One file's section of the output; the relative path keeps headers readable."""
+    if note:
+        return f"\n# File: {rel_path} ({note})\n\n{text}"
+    return f"\n# File: {rel_path}\n\n{text}"
+
+
+# Output compression: file suffix per codec (None writes plain text)
+COMPRESSION_SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+MANIFEST_VERSION = 1
+
+
+class OutputWriter:
+    """Writes output sections to one or more shards, optionally compressed, recording where each file lands.
+
+    With ``shard_bytes`` a new shard is started whenever the next section would take the current one past
+    that size (a section is never split, so one large file can exceed it). Every shard starts with
+    OUTPUT_HEADER. ``manifest_path`` gets a JSON map from relative path to shard and byte offset/length of the
+    file's text; offsets are in the uncompressed shard, so they stay valid whatever the compression.
+    ``symbol_index`` is fed every section as it is written. Shards are only created once there is something
+    to write. Line ends are written as ``newline`` (by default the platform's, as a text-mode file would),
+    and offsets count the bytes as written.
+    """
+
+    def __init__(self, output_path: str, shard_bytes: Optional[int] = None, compression: Optional[str] = None,
+                 manifest_path: Optional[str] = None, symbol_index: Optional[SymbolIndex] = None,
+                 newline: str = os.linesep):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+        self.output_path = output_path
+        self.shard_bytes = shard_bytes
+        self.compression = compression
+        self.manifest_path = manifest_path
+        self.symbol_index = symbol_index
+        self.shards: List[Dict[str, Union[str, int]]] = []
+        self.files: Dict[str, Dict[str, Union[int, str]]] = {}
+        self._stream: Optional[BinaryIO] = None
+        self._raw_stream: Optional[BinaryIO] = None
+        self.newline = newline
+        self._header = self._encode(OUTPUT_HEADER)
+
+    def _encode(self, text: str) -> bytes:
+        if self.newline != '\n':
+            text = text.replace('\n', self.newline)
+        return text.encode('utf-8')
+
+    def shard_path(self, index: int) -> str:
+        base, extension = os.path.splitext(self.output_path)
+        if self.shard_bytes is not None:
+            base += f".part{index + 1:03d}"
+        return base + extension + COMPRESSION_SUFFIXES[self.compression]
+
+    def _open_shard(self):
+        self._close_shard()
+        path = self.shard_path(len(self.shards))
+        if self.compression == 'gzip':
+            # Level 6 is gzip's usual default: most of the ratio of 9 at a fraction of the time
+            self._stream = gzip.open(path, 'wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            self._raw_stream = open(path, 'wb')
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._raw_stream)
+        else:
+            self._stream = open(path, 'wb')
+        self._stream.write(self._header)
+        self.shards.append({'path': os.path.basename(path), 'bytes': len(self._header), 'files': 0})
+        if self.symbol_index is not None:
+            self.symbol_index.add_shard(len(self.shards) - 1, path, self.compression)
+
+    def _close_shard(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self._raw_stream is not None:
+            self._raw_stream.close()
+            self._raw_stream = None
+
+    def write_section(self, rel_path: str, text: str, note: Optional[str] = None, identical_to: Optional[str] = None):
+        """Append one file's section; with ``identical_to``, the manifest points at that file's text instead."""
+        section = self._encode(format_file_section(rel_path, text, note))
+        encoded_text = self._encode(text)
+        text_bytes = len(encoded_text)
+        if self._stream is None or (self.shard_bytes is not None and self.shards[-1]['files'] and
+                                    self.shards[-1]['bytes'] + len(section) > self.shard_bytes):
+            self._open_shard()
+        shard = self.shards[-1]
+        self._stream.write(section)
+        original = self.files.get(identical_to.replace(os.sep, '/')) if identical_to is not None else None
+        if original is not None:
+            self.files[rel_path.replace(os.sep, '/')] = dict(original, identical_to=identical_to.replace(os.sep, '/'))
+        else:
+            self.files[rel_path.replace(os.sep, '/')] = {'shard': len(self.shards) - 1,
+                                                         'offset': shard['bytes'] + len(section) - text_bytes,
+                                                         'length': text_bytes}
+            if note:
+                # Partial sections (outlines, truncated heads, diffs) say so, as their header does
+                self.files[rel_path.replace(os.sep, '/')]['note'] = note
+        if self.symbol_index is not None:
+            self.symbol_index.add_section(rel_path.replace(os.sep, '/'), len(self.shards) - 1,
+                                          shard['bytes'] + len(section) - text_bytes, encoded_text)
+        shard['bytes'] += len(section)
+        shard['files'] += 1
+
+    def close(self) -> Optional[str]:
+        """Finish the last shard and write the manifest; returns the manifest path, or the only shard's path."""
+        self._close_shard()
+        if self.symbol_index is not None:
+            self.symbol_index.close()
+            if not self.shards:
+                os.remove(self.symbol_index.index_path)
+        if not self.shards:
+            return None
+        if self.manifest_path is None:
+            return self.shard_path(0)
+        manifest = {'version': MANIFEST_VERSION, 'compression': self.compression, 'shards': self.shards,
+                    'files': self.files}
+        with open(self.manifest_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+        return self.manifest_path
+
+
+def open_output_shard(path: str, compression: Optional[str]) -> BinaryIO:
+    """Open a shard for reading; compressed shards are decompressed as they are read (seeking reads forward)."""
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("Reading zstd output needs the zstandard package (pip install zstandard)")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def read_output_lines(directory: str,
+                      locations: Iterable[Tuple[str, Optional[str], int]]) -> Dict[Tuple[str, int], str]:
+    """Read the output line around each (shard file name, compression, byte offset); shards in ``directory`` are
+    read once each, front to back, so compressed ones are only decompressed once."""
+    by_shard: Dict[Tuple[str, Optional[str]], List[int]] = {}
+    for shard, compression, offset in locations:
+        by_shard.setdefault((shard, compression), []).append(offset)
+    lines = {}
+    for (shard, compression), offsets in by_shard.items():
+        with open_output_shard(os.path.join(directory, shard), compression) as stream:
+            block = b''
+            block_start = 0
+            for offset in sorted(set(offsets)):
+                if not block_start <= offset < block_start + len(block):
+                    # Lines are cut at 4 KB either side, which is plenty for a source line
+                    block_start = max(offset - 4096, block_start)
+                    stream.seek(block_start)
+                    block = stream.read(8192)
+                relative = offset - block_start
+                line_start = block.rfind(b'\n', 0, relative) + 1
+                line_end = block.find(b'\n', relative)
+                line = block[line_start:line_end if line_end >= 0 else len(block)]
+                lines[(shard, offset)] = line.decode('utf-8', 'replace').rstrip('\r')
+    return lines
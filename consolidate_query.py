@@ -0,0 +1,71 @@
+"""
+Consolidate Query
+=================
+
+Looks identifiers up in the symbol index consolidate.py writes next to an output with --symbol-index, so a
+name can be found in a snapshot of hundreds of MB without scanning it.
+
+Usage:
+python consolidate_query.py OUTPUT NAME [NAME ...] [--defined] [--prefix] [--limit 50] [--no-lines]
+    OUTPUT is the index (<output>.index.sqlite3) or any file of the output it belongs to (the .txt, a shard or
+    the manifest). Prints path:line for every occurrence, definitions first, with the line read back from the
+    output (compressed shards are decompressed once, front to back).
+"""
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from consolidate_output import read_output_lines
+from consolidate_symbols import query_symbol_index, symbol_index_path
+
+# Output file names, whose symbol index is found by replacing this suffix
+OUTPUT_SUFFIX = re.compile(r'(?:\.part\d{3})?\.(?:txt(?:\.gz|\.zst)?|manifest\.json)$')
+
+
+def resolve_index_path(path: str) -> str:
+    if path.endswith('.index.sqlite3'):
+        return path
+    return symbol_index_path(OUTPUT_SUFFIX.sub('', path) + '.txt')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find identifiers in a consolidated output through its symbol index")
+    parser.add_argument("output", help="the symbol index, or a file of the output it was written for")
+    parser.add_argument("names", nargs="+", metavar="NAME", help="identifiers to look up")
+    parser.add_argument("--defined", action="store_true", help="only list where the names look defined")
+    parser.add_argument("--prefix", action="store_true", help="match every identifier starting with NAME")
+    parser.add_argument("--limit", type=int, default=50, help="occurrences listed per name (default: 50)")
+    parser.add_argument("--no-lines", action="store_true", help="list locations without reading the output")
+    args = parser.parse_args()
+
+    index_path = resolve_index_path(args.output)
+    if not os.path.isfile(index_path):
+        parser.error(f"no symbol index at {index_path} (write one with consolidate.py --symbol-index)")
+
+    for name in args.names:
+        start = time.perf_counter()
+        try:
+            hits = query_symbol_index(index_path, name, args.defined, args.prefix, args.limit)
+        except sqlite3.Error as e:
+            sys.exit(f"Cannot read {index_path}: {e}")
+        seconds = time.perf_counter() - start
+        lines = {}
+        if hits and not args.no_lines:
+            lines = read_output_lines(os.path.dirname(os.path.abspath(index_path)),
+                                      [(shard, compression, offset) for _, _, offset, shard, compression, _, _ in hits])
+        definitions = sum(1 for hit in hits if hit[5])
+        print(f"{name}: {len(hits)}{'+' if len(hits) == args.limit else ''} occurrences, {definitions} definitions "
+              f"({seconds * 1000:.1f} ms)")
+        for identifier, line, offset, shard, _, definition, path in hits:
+            label = f"{path}:{line}"
+            if args.prefix:
+                label += f" {identifier}"
+            text = lines.get((shard, offset))
+            print(f"    {label}{' [definition]' if definition else ''}" + (f"  {text.strip()}" if text else ''))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Symbol Index
+============
+
+The SQLite sidecar consolidate.py --symbol-index writes next to an output: every identifier with the files,
+lines and byte offsets where it occurs. consolidate_query.py looks names up in it.
+"""
+import os
+import re
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+# Symbol index sidecar: identifiers are found in the UTF-8 bytes of each section (ASCII identifiers only), so
+# their offsets are byte offsets into the uncompressed shard, like the manifest's
+_IDENTIFIER_BYTES = re.compile(rb'[A-Za-z_$][A-Za-z0-9_$]*')
+# A name that follows one of these keywords is taken as defined there (Python, JS/TS, C-family, Go, Rust, shell)
+_DEFINITION_BYTES = re.compile(
+    rb'\b(?:def|class|function|interface|enum|type|struct|union|namespace|module|trait|impl|fn|func|'
+    rb'const|let|var|val|macro|typedef)\s+\*?([A-Za-z_$][A-Za-z0-9_$]*)')
+# Keywords too common to be worth indexing
+INDEX_STOP_WORDS = frozenset(
+    b'and as async await break case catch class const continue def default del do elif else enum except export '
+    b'extends false finally for from function if implements import in instanceof interface is let new none not '
+    b'null or pass private protected public raise return self static super switch this throw true try type '
+    b'typeof undefined var void while with yield'.split())
+SYMBOL_INDEX_VERSION = 2
+
+
+class SymbolIndex:
+    """Sidecar index of an output, written as its sections are: identifier -> file, line and byte offset.
+
+    A SQLite database next to the output (``<output>.index.sqlite3``) holds the shards, each file's section
+    (shard, byte offset and length of its text) and every occurrence of every identifier, marking those that
+    look like definitions. Lines are counted within the file's section, i.e. in the text as written (stripped).
+    ``query_symbol_index`` answers lookups from it without reading the output.
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self._connection = sqlite3.connect(index_path)
+        # A derived file that is rebuilt whole: no journal needed
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.executescript(
+            "CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE shards (id INTEGER PRIMARY KEY, path TEXT NOT NULL, compression TEXT);"
+            "CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT NOT NULL, shard INTEGER NOT NULL, "
+            "offset INTEGER NOT NULL, length INTEGER NOT NULL);"
+            "CREATE TABLE identifiers (id INTEGER PRIMARY KEY, name TEXT NOT NULL);"
+            "CREATE TABLE occurrences (identifier INTEGER NOT NULL, file INTEGER NOT NULL, line INTEGER NOT NULL, "
+            "offset INTEGER NOT NULL, definition INTEGER NOT NULL);")
+        self._connection.execute("INSERT INTO metadata VALUES ('version', ?)", (str(SYMBOL_INDEX_VERSION),))
+        # Identifiers are numbered as they are first seen, and written once at the end
+        self._identifier_ids: Dict[bytes, int] = {}
+        self.occurrence_count = 0
+
+    def add_shard(self, index: int, path: str, compression: Optional[str]):
+        self._connection.execute("INSERT INTO shards VALUES (?, ?, ?)", (index, os.path.basename(path), compression))
+
+    def add_section(self, rel_path: str, shard: int, offset: int, text: bytes):
+        """Index the identifiers of one file's text, which starts at byte ``offset`` of ``shard``."""
+        file_id = self._connection.execute("INSERT INTO files (path, shard, offset, length) VALUES (?, ?, ?, ?)",
+                                           (rel_path, shard, offset, len(text))).lastrowid
+        definitions = {match.start(1) for match in _DEFINITION_BYTES.finditer(text)}
+        identifier_ids = self._identifier_ids
+        occurrences = []
+        line = 1
+        line_start = 0
+        for match in _IDENTIFIER_BYTES.finditer(text):
+            identifier = match.group()
+            if identifier in INDEX_STOP_WORDS:
+                continue
+            identifier_id = identifier_ids.get(identifier)
+            if identifier_id is None:
+                identifier_id = identifier_ids[identifier] = len(identifier_ids)
+            start = match.start()
+            line += text.count(b'\n', line_start, start)
+            line_start = start
+            occurrences.append((identifier_id, file_id, line, offset + start, start in definitions))
+        self._connection.executemany("INSERT INTO occurrences VALUES (?, ?, ?, ?, ?)", occurrences)
+        self.occurrence_count += len(occurrences)
+
+    def close(self):
+        self._connection.executemany("INSERT INTO identifiers VALUES (?, ?)",
+                                     ((identifier_id, identifier.decode('ascii'))
+                                      for identifier, identifier_id in self._identifier_ids.items()))
+        # Building the lookup indexes once, after the inserts, is much faster than maintaining them during them
+        self._connection.execute("CREATE UNIQUE INDEX identifiers_by_name ON identifiers (name)")
+        self._connection.execute("CREATE INDEX occurrences_by_identifier ON occurrences (identifier, definition)")
+        self._connection.commit()
+        self._connection.close()
+
+
+def symbol_index_path(output_path: str) -> str:
+    return os.path.splitext(output_path)[0] + '.index.sqlite3'
+
+
+def query_symbol_index(index_path: str, name: str, definitions_only: bool = False, prefix: bool = False,
+                       limit: Optional[int] = None) -> List[Tuple[str, int, int, str, Optional[str], bool, str]]:
+    """Find ``name`` (or, with ``prefix``, every identifier starting with it) in a SymbolIndex.
+
+    Returns (identifier, line, byte offset in the shard, shard file name, shard compression, definition, path)
+    tuples, definitions first, then in output order.
+    """
+    connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        if prefix:
+            condition, arguments = "i.name >= ? AND i.name < ?", [name, name + '\U0010ffff']
+        else:
+            condition, arguments = "i.name = ?", [name]
+        if definitions_only:
+            condition += " AND o.definition = 1"
+        query = (f"SELECT i.name, o.line, o.offset, s.path, s.compression, o.definition, f.path "
+                 f"FROM identifiers i JOIN occurrences o ON o.identifier = i.id JOIN files f ON f.id = o.file "
+                 f"JOIN shards s ON s.id = f.shard WHERE {condition} ORDER BY o.definition DESC, f.shard, o.offset")
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return [(identifier, line, offset, shard, compression, bool(definition), path)
+                for identifier, line, offset, shard, compression, definition, path
+                in connection.execute(query, arguments)]
+    finally:
+        connection.close()
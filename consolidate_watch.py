@@ -0,0 +1,291 @@
+"""
+Watch Mode
+==========
+
+Keeps a consolidated output up to date as files change (consolidate.py --watch): inotify on Linux, polling
+elsewhere, and only changed files are re-read and re-stripped.
+"""
+import ctypes
+import ctypes.util
+import datetime
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from consolidate_output import OUTPUT_HEADER, format_file_section
+
+if TYPE_CHECKING:
+    from consolidate import FileHandler
+
+# Logs through consolidate.py's logger, so its --log-level applies here too
+logger = logging.getLogger("consolidate")
+
+
+class InotifyWatcher:
+    """Reports changed paths under a set of directories using Linux inotify (through ctypes, no dependencies)."""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root_directory: str):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self.root_directory = root_directory
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        self._directories_by_wd: Dict[int, str] = {}
+        self._wds_by_directory: Dict[str, int] = {}
+
+    def watch_directories(self, directories: Iterable[str]):
+        for directory in directories:
+            if directory in self._wds_by_directory:
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                logger.warning("Cannot watch %s: %s", directory, os.strerror(error))
+                continue
+            self._directories_by_wd[wd] = directory
+            self._wds_by_directory[directory] = wd
+
+    def wait(self, timeout: float) -> Set[str]:
+        """Block for up to ``timeout`` seconds and return the paths changed meanwhile (empty on timeout)."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost; report the root so everything is rescanned
+                changed.add(self.root_directory)
+                continue
+            directory = self._directories_by_wd.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self._directories_by_wd[wd]
+                self._wds_by_directory.pop(directory, None)
+            changed.add(os.path.join(directory, os.fsdecode(name)) if name else directory)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """Fallback for platforms without inotify: re-walks the tree every interval and diffs stat snapshots."""
+
+    def __init__(self, snapshot: Callable[[], Dict[str, Tuple[int, int]]], interval: float):
+        self._snapshot = snapshot
+        self._interval = interval
+        self._previous = snapshot()
+
+    def watch_directories(self, directories: Iterable[str]):
+        # Every poll walks the whole tree, so new directories are picked up without registration
+        pass
+
+    def wait(self, timeout: float) -> Set[str]:
+        time.sleep(max(timeout, self._interval))
+        current = self._snapshot()
+        changed = {path for path, stat_key in current.items() if self._previous.get(path) != stat_key}
+        changed.update(path for path in self._previous if path not in current)
+        self._previous = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class ConsolidationWatcher:
+    """Keeps one consolidated output up to date while files under a folder change.
+
+    The ignore state (in the FileHandler's GitIgnoreManager) and the stripped text of every included file
+    stay in memory. A batch of changes only re-reads and re-strips the affected files before the output
+    is rewritten from memory; .gitignore changes and added or removed files trigger a re-walk, which
+    reuses the in-memory text of every file whose stat did not change.
+    """
+
+    def __init__(self, file_handler: 'FileHandler', folder: str, extensions: List[str], max_size_kb: int = 128,
+                 write_up_a_level: bool = True, poll_interval: float = 2.0, debounce: float = 0.5):
+        self.file_handler = file_handler
+        self.folder = os.path.abspath(folder)
+        self.extensions = extensions
+        self.max_size_kb = max_size_kb
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        # One stable output path for the whole session, replaced atomically on every rewrite
+        self.output_path = file_handler.get_output_path(self.folder, write_up_a_level)
+        self.segments: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        self.directories: Set[str] = set()
+
+    @staticmethod
+    def _stat_key(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _discover(self) -> List[str]:
+        visited: List[str] = []
+        paths = list(self.file_handler.iter_hierarchy_files(self.folder, self.extensions, self.max_size_kb, visited))
+        self.directories = set(visited)
+        return paths
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        """Stat every included file plus every directory (new entries) and .gitignore (rule changes)."""
+        snapshot = {}
+        for path in self._discover():
+            snapshot[path] = self._stat_key(path)
+        for directory in self.directories:
+            snapshot[directory] = self._stat_key(directory)
+            snapshot[os.path.join(directory, '.gitignore')] = self._stat_key(os.path.join(directory, '.gitignore'))
+        return snapshot
+
+    def _process(self, stat_keys: Dict[str, Tuple[int, int]]) -> Dict[str, Tuple[Tuple[int, int], str]]:
+        """Load and strip files through the FileHandler's pipeline stages.
+
+        ``stat_keys`` must be taken before reading, so an edit racing the read shows up as a later change.
+        """
+        contents = self.file_handler.iter_file_contents(list(stat_keys))
+        non_empty = (content for content in contents if content.stripped or content.text.strip())
+        return {content.path: (stat_keys[content.path], content.text)
+                for content in self.file_handler.iter_stripped_files(non_empty)}
+
+    def rebuild(self):
+        """Re-walk the tree, keeping the in-memory text of files whose stat has not changed."""
+        stat_keys = {path: self._stat_key(path) for path in self._discover()}
+        stale = {path: stat_key for path, stat_key in stat_keys.items()
+                 if path not in self.segments or self.segments[path][0] != stat_key}
+        processed = self._process(stale)
+        segments = {}
+        for path in stat_keys:
+            if path in processed:
+                segments[path] = processed[path]
+            elif path not in stale:
+                segments[path] = self.segments[path]
+        self.segments = segments
+        logger.info("Re-scanned %s: %s files, %s re-processed", self.folder, len(self.segments), len(processed))
+
+    def update_files(self, paths: Set[str]):
+        """Re-process files already in the output; drop those that vanished or fell outside the size limits."""
+        refresh = {}
+        removed = 0
+        for path in sorted(paths):
+            stat_key = self._stat_key(path)
+            if stat_key is None or stat_key[1] == 0 or stat_key[1] > self.max_size_kb * 1024:
+                self.segments.pop(path, None)
+                removed += 1
+            elif stat_key != self.segments[path][0]:
+                refresh[path] = stat_key
+                # Drop the stat recorded by the last walk so the read stage takes a fresh one
+                self.file_handler.stat_cache.pop(path, None)
+        processed = self._process(refresh)
+        for path in refresh:
+            if path in processed:
+                self.segments[path] = processed[path]
+            else:
+                self.segments.pop(path, None)
+                removed += 1
+        logger.info("Updated %s changed files, removed %s", len(refresh), removed)
+
+    def _needs_rescan(self, path: str) -> bool:
+        """Whether a change can add or remove files or alter ignore rules, rather than just edit a known file."""
+        name = os.path.basename(path)
+        if name == '.gitignore' or path in self.directories or os.path.isdir(path):
+            return True
+        return path not in self.segments and name.endswith(tuple(self.extensions))
+
+    def apply_changes(self, changed: Set[str]):
+        changed = {path for path in changed if path not in (self.output_path, self.output_path + '.tmp') and
+                   not self.file_handler.is_generated_file(path)}
+        if not changed:
+            return
+        manager = self.file_handler.gitignore_manager
+        rescan = False
+        for path in changed:
+            if self._needs_rescan(path):
+                rescan = True
+                if manager is not None and os.path.basename(path) == '.gitignore':
+                    manager.forget_directory(os.path.dirname(path))
+        if rescan:
+            self.rebuild()
+        else:
+            self.update_files({path for path in changed if path in self.segments})
+        self.write_output()
+
+    def write_output(self):
+        """Rewrite the output from the in-memory segments, replacing the previous version atomically."""
+        if not self.segments:
+            logger.info("No non-empty files to write.")
+            return
+        temp_path = self.output_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as combined_file:
+            combined_file.write(OUTPUT_HEADER)
+            for path, (_, text) in self.segments.items():
+                combined_file.write(format_file_section(os.path.relpath(path, self.folder), text))
+        os.replace(temp_path, self.output_path)
+        logger.info("[%s] Wrote %s files to %s", datetime.datetime.now().strftime("%H:%M:%S"), len(self.segments),
+                    self.output_path)
+
+    def _create_watcher(self):
+        try:
+            watcher = InotifyWatcher(self.folder)
+            logger.info("Watching for changes with inotify")
+            return watcher
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable (%s); polling every %ss", e, self.poll_interval)
+            return PollingWatcher(self._snapshot, self.poll_interval)
+
+    def run(self):
+        """Build the output once, then keep it current until interrupted (Ctrl+C)."""
+        self.rebuild()
+        self.write_output()
+        watcher = self._create_watcher()
+        try:
+            while True:
+                watcher.watch_directories(self.directories)
+                changed = watcher.wait(self.poll_interval)
+                if not changed:
+                    continue
+                # Debounce: keep collecting until the tree has been quiet for a moment
+                while True:
+                    more = watcher.wait(self.debounce)
+                    if not more:
+                        break
+                    changed |= more
+                self.apply_changes(changed)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching.")
+        finally:
+            watcher.close()
+            cache = self.file_handler.get_strip_cache()
+            if cache is not None:
+                cache.close()
@@ -1,43 +1,141 @@
+import hashlib
+import json
+import os
 import re
+import time
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 NUMBER_OF_HEADER_LINES_TO_SEARCH = 21
 PATH_TO_SEARCH = "../../../../libs"
 OUTPUT_PATH = "./gathered_imports.js"
+# Parse results of every scanned file, reused while a file's mtime and size (or failing that, its hash) are unchanged
+CACHE_PATH = "./.gathered_imports_cache.json"
+# Directories never scanned, pruned by name during the walk
+EXCLUDED_DIRECTORIES = {"node_modules", "dist"}
+# Bump when the patterns below change, so results cached by an older version are not reused
+CACHE_VERSION = 1
+# Files modified this recently may change again within the same mtime tick, so their mtime is not trusted
+RACY_MTIME_SECONDS = 2.0
 
 
 class TypeScriptImportAnalyzer:
-    def __init__(self, root_path: str = PATH_TO_SEARCH):
+    def __init__(self, root_path: str = PATH_TO_SEARCH, cache_path: Optional[str] = CACHE_PATH):
         self.root_path = Path(root_path)
         self.export_map: Dict[str, str] = {}
+        self.cache_path = cache_path
+        self.cache: Dict[str, dict] = self.load_cache() if cache_path else {}
+        self.seen_files: Set[str] = set()
+        self.rescanned_files: Set[str] = set()
+
+    def load_cache(self) -> Dict[str, dict]:
+        """Load the per-file parse results of the previous run; a missing or outdated cache starts empty."""
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+            return {}
+        return cache.get('files', {})
+
+    def save_cache(self):
+        """Write the parse results of the files seen this run, dropping files that no longer exist."""
+        if not self.cache_path:
+            return
+        files = {key: entry for key, entry in self.cache.items() if key in self.seen_files}
+        temp_path = f"{self.cache_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'files': files}, f)
+        os.replace(temp_path, self.cache_path)
+
+    def scan_file(self, file_path: Path, kind: str, scan: Callable[[str], object]):
+        """Return ``scan(content)`` for a file, read and scanned only if it changed since it was cached.
+
+        A file whose mtime and size match its cache entry is not opened at all; one whose content hash still
+        matches (e.g. after a checkout that only touched timestamps) is read but not rescanned. The mtime of a
+        file modified within RACY_MTIME_SECONDS is not recorded, so it is hashed again next run.
+        """
+        key = os.path.abspath(file_path)
+        self.seen_files.add(key)
+        stat = os.stat(key)
+        entry = self.cache.get(key)
+        if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            if kind in entry['results']:
+                return entry['results'][kind]
+
+        with open(key, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if entry is None or entry['sha1'] != digest:
+            entry = {'sha1': digest, 'results': {}}
+        entry['mtime_ns'] = stat.st_mtime_ns if time.time() - stat.st_mtime > RACY_MTIME_SECONDS else -1
+        entry['size'] = stat.st_size
+        self.cache[key] = entry
+        if kind not in entry['results']:
+            # Same text as reading in text mode: universal newlines
+            content = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            entry['results'][kind] = scan(content)
+            self.rescanned_files.add(key)
+        return entry['results'][kind]
+
+    @staticmethod
+    def scan_barrelsby_header(content: str) -> bool:
+        lines = content.split('\n')[:NUMBER_OF_HEADER_LINES_TO_SEARCH]  # Limit search
+        return any("@file Automatically generated by barrelsby" in line for line in lines)
+
+    @staticmethod
+    def scan_barrel_exports(content: str) -> List[str]:
+        # Match barrelsby export pattern
+        pattern = r'export \* from "(.*?)";'
+        return [match.group(1) for match in re.finditer(pattern, content)]
 
-    def find_index_files(self) -> List[Path]:
-        """Find all barrelsby-generated index.ts files in the project structure."""
+    @staticmethod
+    def scan_source_exports(content: str) -> List[str]:
+        # Match export patterns (interface, type, class, etc.)
+        pattern = r'export\s+(?:interface|type|class|const|let|var|function|enum)\s+([^\s<({]+)'
+        return sorted({match.group(1) for match in re.finditer(pattern, content)})
+
+    def scan_project(self) -> Tuple[List[Path], List[Path]]:
+        """Walk the project once, returning its barrelsby-generated index.ts files and all its .ts files.
+
+        Excluded directories are pruned without being listed. Directories are visited depth first and entries
+        in listing order, the same order as ``Path.rglob``, so the export map is built in the same order.
+        """
         index_files = []
-        for path in self.root_path.rglob("index.ts"):
-            path_str = str(path)
-            if "node_modules" not in path_str and "dist" not in path_str:
-                # Verify it's a barrelsby file by checking first few lines
-                with open(path, 'r', encoding='utf-8') as f:
-                    first_lines = [f.readline().strip() for _ in
-                                   range(NUMBER_OF_HEADER_LINES_TO_SEARCH)]  # Limit search
-                    if any("@file Automatically generated by barrelsby" in line for line in first_lines):
+        ts_files = []
+        pending = [self.root_path]
+        while pending:
+            directory = pending.pop()
+            # Only an unreadable directory is skipped; errors reading the files in it still propagate
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            subdirectories = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in EXCLUDED_DIRECTORIES:
+                        subdirectories.append(directory / entry.name)
+                elif entry.name.endswith('.ts') and entry.is_file():
+                    path = directory / entry.name
+                    ts_files.append(path)
+                    # Verify it's a barrelsby file by checking first few lines
+                    if entry.name == 'index.ts' and self.scan_file(path, 'barrelsby', self.scan_barrelsby_header):
                         index_files.append(path)
-        return index_files
+            pending.extend(reversed(subdirectories))
+        return index_files, ts_files
+
+    def find_index_files(self) -> List[Path]:
+        """Find all barrelsby-generated index.ts files in the project structure."""
+        return self.scan_project()[0]
 
     def parse_barrel_exports(self, file_path: Path) -> List[Tuple[str, Path]]:
         """Extract exports from a barrelsby-generated index.ts file."""
         exports = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # Match barrelsby export pattern
-        pattern = r'export \* from "(.*?)";'
-        matches = re.finditer(pattern, content)
-
-        for match in matches:
-            relative_path = match.group(1)
+        # Only the export paths are cached: whether they exist depends on other files
+        for relative_path in self.scan_file(file_path, 'barrel', self.scan_barrel_exports):
             full_path = (file_path.parent / Path(relative_path)).resolve().with_suffix('.ts')
             if full_path.exists():
                 exports.append((relative_path, full_path))
@@ -46,18 +144,7 @@ class TypeScriptImportAnalyzer:
 
     def parse_source_exports(self, file_path: Path) -> Set[str]:
         """Extract named exports from a TypeScript source file."""
-        exports = set()
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        # Match export patterns (interface, type, class, etc.)
-        pattern = r'export\s+(?:interface|type|class|const|let|var|function|enum)\s+([^\s<({]+)'
-        matches = re.finditer(pattern, content)
-
-        for match in matches:
-            exports.add(match.group(1))
-
-        return exports
+        return set(self.scan_file(file_path, 'source', self.scan_source_exports))
 
     def parse_named_exports(self, file_path: Path) -> List[Tuple[str, str]]:
         """Extract named exports with their package sources from a TypeScript file.
@@ -68,14 +155,17 @@ class TypeScriptImportAnalyzer:
         Returns:
             List[Tuple[str, str]]: List of tuples containing (export_name, package_name)
         """
+        return [tuple(named_export)
+                for named_export in self.scan_file(file_path, 'named', self.scan_named_exports)]
+
+    @staticmethod
+    def scan_named_exports(content: str) -> List[Tuple[str, str]]:
         named_exports = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.readlines()
 
         # Match pattern: export { Name1, Name2 } from '@package/name';
         pattern = r"export\s*{([^}]+)}\s*from\s*'([^']+)'"
 
-        for line in content:
+        for line in content.split('\n'):
             match = re.search(pattern, line)
             if match:
                 # Get the exports and package
@@ -97,8 +187,10 @@ class TypeScriptImportAnalyzer:
 
     def analyze_project(self) -> Dict[str, str]:
         """Analyze the entire project and create an export map."""
+        # One walk finds both the barrel files and the files to scan for named exports
+        index_files, ts_files = self.scan_project()
+
         # First, process barrel files as before
-        index_files = self.find_index_files()
 
         for index_file in index_files:
             project_path = index_file.relative_to(self.root_path).parent.parent
@@ -113,11 +205,10 @@ class TypeScriptImportAnalyzer:
                     self.export_map[export_name] = package_name
 
         # Now, scan all TypeScript files for named exports
-        for ts_file in self.root_path.rglob("*.ts"):
-            if "node_modules" not in str(ts_file) and "dist" not in str(ts_file):
-                named_exports = self.parse_named_exports(ts_file)
-                for export_name, package_name in named_exports:
-                    self.export_map.setdefault(export_name, package_name)
+        for ts_file in ts_files:
+            named_exports = self.parse_named_exports(ts_file)
+            for export_name, package_name in named_exports:
+                self.export_map.setdefault(export_name, package_name)
 
         return self.export_map
 
@@ -159,7 +250,9 @@ def main():
     analyzer = TypeScriptImportAnalyzer()
     export_map = analyzer.analyze_project()
     analyzer.save_export_map()
-    print(f"Found {len(export_map)} exports across all projects")
+    analyzer.save_cache()
+    print(f"Found {len(export_map)} exports across all projects "
+          f"({len(analyzer.rescanned_files)} of {len(analyzer.seen_files)} files rescanned)")
 
 
 if __name__ == "__main__":
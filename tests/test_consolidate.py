@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+Unit tests for consolidate.py
+"""
+
+import json
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from consolidate import (ChunkExporter, CompactingStripper, Deduplicator, FileContent, FileHandler,
+                         GitIgnorePatternSet, budget_measure, chunk_text, hash_text, parse_gitignore_line, plan_budget)
+from consolidate_cache import StripCache
+from consolidate_git_index import read_git_index
+from consolidate_output import OUTPUT_HEADER, OutputWriter, open_output_shard
+
+
+class TestPlanBudget(unittest.TestCase):
+
+    def plan(self, contents, budget):
+        measure = budget_measure('bytes')
+        costs = {content.path: measure(content.text) for content in contents}
+        return plan_budget(contents, '/project', budget, measure, costs)
+
+    def test_summarises_the_rest_before_filling_the_budget_with_whole_files(self):
+        """Files that do not fit whole are outlined or truncated, not all left out"""
+        declarations = ''.join(f"def function_{i}(value):\n    return value * {i}\n" for i in range(40))
+        prose = ''.join(f"Line {i} of a long text without any declarations in it.\n" for i in range(40))
+        contents = [FileContent(f'/project/src/module_{i:02}.py', declarations) for i in range(12)]
+        contents += [FileContent(f'/project/notes_{i:02}.txt', prose) for i in range(4)]
+        budget = 4 * len(declarations)
+
+        sections, omitted, used = self.plan(contents, budget)
+
+        self.assertLessEqual(used, budget)
+        notes = [note.split(',')[0] for _, _, note in sections if note]
+        whole = len(sections) - len(notes)
+        self.assertEqual(whole, 2)
+        self.assertEqual(notes.count('outline'), 10)
+        self.assertEqual(notes.count('truncated'), 4)
+        self.assertEqual(omitted, [])
+
+    def test_everything_whole_when_it_fits(self):
+        """A budget that holds every file takes them all whole"""
+        text = ''.join(f"def function_{i}():\n    pass\n" for i in range(20))
+        contents = [FileContent(f'/project/module_{i}.py', text) for i in range(5)]
+
+        sections, omitted, used = self.plan(contents, 5 * len(text) + 500)
+
+        self.assertEqual([note for _, _, note in sections], [None] * 5)
+        self.assertEqual(omitted, [])
+
+
+class TestCompaction(unittest.TestCase):
+
+    @staticmethod
+    def without_whitespace(text):
+        return ''.join(text.split())
+
+    def test_c_family_only_drops_comments_and_whitespace(self):
+        """Regex literals and strings that contain comment markers are kept"""
+        source = (
+            "const pattern = /a\\/*/g; foo(); /* block */ bar();\n"
+            "if (/[/*]/.test(s)) { return /x\\//i; } // trailing\n"
+            "const url = \"http://example.com\" + `/* not a comment */`;\n"
+            "const ratio = total / count / 2; // division\n"
+        )
+        expected = (
+            "const pattern = /a\\/*/g; foo(); bar();\n"
+            "if (/[/*]/.test(s)) { return /x\\//i; }\n"
+            "const url = \"http://example.com\" + `/* not a comment */`;\n"
+            "const ratio = total / count / 2;\n"
+        )
+        stripper = CompactingStripper('c_family', ['comments', 'whitespace'])
+
+        self.assertEqual(self.without_whitespace(stripper(source)), self.without_whitespace(expected))
+
+    def test_json_minification_keeps_every_token(self):
+        """Duplicate keys and number spellings survive; only whitespace outside strings goes"""
+        source = '{\n  "a": 1,\n  "a": 2,\n  "n": [1.0e5, -0.50],\n  "s": "two  spaces \\" quoted"\n}\n'
+        stripper = CompactingStripper('json', ['json'])
+
+        self.assertEqual(stripper(source), '{"a":1,"a":2,"n":[1.0e5,-0.50],"s":"two  spaces \\" quoted"}\n')
+
+
+class TestGitIgnorePatterns(unittest.TestCase):
+
+    def assert_matches(self, cases):
+        """Check (patterns, path, is_dir, ignored) rows against GitIgnorePatternSet"""
+        for patterns, path, is_dir, ignored in cases:
+            with self.subTest(patterns=patterns, path=path, is_dir=is_dir):
+                self.assertEqual(GitIgnorePatternSet(patterns).matches(path, is_dir), ignored)
+
+    def test_parse_gitignore_line(self):
+        """Lines split into (pattern, negated, anchored, directory_only) as git reads them"""
+        cases = [
+            ('', None),
+            ('# comment', None),
+            ('\\#hash', ('\\#hash', False, False, False)),
+            ('!keep.log', ('keep.log', True, False, False)),
+            ('\\!bang', ('\\!bang', False, False, False)),
+            ('trailing   ', ('trailing', False, False, False)),
+            ('escaped\\ ', ('escaped\\ ', False, False, False)),
+            ('build/', ('build', False, False, True)),
+            ('/root.txt', ('root.txt', False, True, False)),
+            ('doc/frotz/', ('doc/frotz', False, True, True)),
+            ('**/foo', ('**/foo', False, True, False)),
+            ('/', None),
+        ]
+        for line, parsed in cases:
+            with self.subTest(line=line):
+                self.assertEqual(parse_gitignore_line(line), parsed)
+
+    def test_patterns_match_like_git(self):
+        """Rows checked against git check-ignore"""
+        self.assert_matches([
+        # ** forms
+        (['**/foo'], 'foo', False, True),
+        (['**/foo'], 'a/b/foo', False, True),
+        (['a/**/b'], 'a/b', False, True),
+        (['a/**/b'], 'a/x/y/b', False, True),
+        (['a/**/b'], 'x/a/b', False, False),
+        (['a/**'], 'a/x/y', False, True),
+        (['a**b'], 'axyb', False, True),
+        (['a**b'], 'ax/yb', False, False),
+        # Wildcards do not cross '/'
+        (['a/*.c'], 'a/x.c', False, True),
+        (['a/*.c'], 'a/b/x.c', False, False),
+        (['*.c'], 'a/b/x.c', False, True),
+        (['a?c'], 'a/c', False, False),
+        # Negation: the last matching pattern wins
+        (['*.log', '!keep.log'], 'keep.log', False, False),
+        (['*.log', '!keep.log'], 'other.log', False, True),
+        (['!keep.log', '*.log'], 'keep.log', False, True),
+        # Escapes
+        (['\\#notes'], '#notes', False, True),
+        (['#notes'], '#notes', False, False),
+        (['\\!important'], '!important', False, True),
+        (['trail\\ '], 'trail ', False, True),
+        (['trail  '], 'trail', False, True),
+        (['a\\*b'], 'a*b', False, True),
+        (['a\\*b'], 'axb', False, False),
+        # Directory-only patterns
+        (['build/'], 'build', True, True),
+        (['build/'], 'build', False, False),
+        (['build/'], 'src/build', True, True),
+        (['*.tmp/'], 'x.tmp', True, True),
+        (['*.tmp/'], 'x.tmp', False, False),
+        # Anchoring: a slash anywhere but at the end ties the pattern to the .gitignore directory
+        (['/root.txt'], 'root.txt', False, True),
+        (['/root.txt'], 'sub/root.txt', False, False),
+        (['doc/frotz'], 'doc/frotz', False, True),
+        (['doc/frotz'], 'a/doc/frotz', False, False),
+        (['frotz'], 'a/doc/frotz', False, True),
+        (['/*.c'], 'x.c', False, True),
+        (['/*.c'], 'sub/x.c', False, False),
+        ])
+
+    def test_posix_character_classes(self):
+        """Bracket expressions understand [:class:] like git's wildmatch"""
+        with self.assertLogs('consolidate', 'WARNING'):
+            self.assert_matches([
+                (['*[[:upper:]]xt'], 'fooAxt', False, True),
+                (['*[[:upper:]]xt'], 'foo1xt', False, False),
+                (['[[:digit:]]*'], '1abc', False, True),
+                (['[[:digit:]]*'], 'abc', False, False),
+                (['[![:alpha:]]z'], '1z', False, True),
+                (['[![:alpha:]]z'], 'az', False, False),
+                (['[[:alnum:]_]x'], '_x', False, True),
+                (['a[[:space:]]b'], 'a b', False, True),
+                (['a[[:punct:]]b'], 'a-b', False, True),
+                (['a[[:punct:]]b'], 'a/b', False, False),
+                (['x[[:lower:][:digit:]]'], 'x7', False, True),
+                (['a[[:bogus:]]'], 'ab', False, False),
+            ])
+
+
+@unittest.skipUnless(shutil.which('git'), "needs git")
+class TestGitIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.git('init', '-q')
+        self.git('config', 'user.email', 'test@example.com')
+        self.git('config', 'user.name', 'test')
+        # Nested paths sharing prefixes exercise version 4's prefix compression
+        for rel_path in ('src/deep/er/a.py', 'src/deep/er/b.py', 'src/deep/c.py', 'src/d.py', 'docs/readme.md',
+                         'docs/guide/intro.md', 'sp ace \u00e9.txt'):
+            path = os.path.join(self.root, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(rel_path + '\n')
+        os.symlink('src/d.py', os.path.join(self.root, 'link.py'))
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'fixture')
+
+    def git(self, *args, input=None):
+        return subprocess.run(['git', '-c', 'core.quotepath=off', *args], cwd=self.root, input=input,
+                              check=True, capture_output=True).stdout
+
+    def add_submodule_and_conflict(self):
+        """A submodule (gitlink) entry and a path with three conflict stages"""
+        head = self.git('rev-parse', 'HEAD').decode().strip()
+        self.git('update-index', '--add', '--cacheinfo', f'160000,{head},vendor/sub')
+        blob = self.git('hash-object', '-w', 'src/d.py').decode().strip()
+        self.git('update-index', '--index-info',
+                 input=''.join(f'100644 {blob} {stage}\tconflict.txt\n' for stage in (1, 2, 3)).encode())
+
+    def assert_index_matches_ls_files(self, version):
+        self.git('update-index', '--index-version', str(version))
+        index_path = os.path.join(self.root, '.git', 'index')
+        with open(index_path, 'rb') as f:
+            self.assertEqual(int.from_bytes(f.read(8)[4:], 'big'), version)
+
+        files, submodules = [], []
+        for line in self.git('ls-files', '-z', '-s', '-t').decode('utf-8').split('\0'):
+            if not line:
+                continue
+            info, path = line.split('\t', 1)
+            tag, mode = info.split()[:2]
+            if tag == 'S':
+                continue
+            if mode == '160000':
+                submodules.append(path)
+            elif not files or files[-1] != path:
+                files.append(path)
+
+        self.assertEqual(read_git_index(index_path), (files, submodules))
+        return files, submodules
+
+    def test_version_2(self):
+        self.add_submodule_and_conflict()
+        files, submodules = self.assert_index_matches_ls_files(2)
+        self.assertIn('conflict.txt', files)
+        self.assertEqual(submodules, ['vendor/sub'])
+
+    def test_version_3_with_skip_worktree(self):
+        """Skip-worktree entries set extended flags, which need version 3"""
+        self.add_submodule_and_conflict()
+        self.git('update-index', '--skip-worktree', 'docs/readme.md')
+        files, _ = self.assert_index_matches_ls_files(3)
+        self.assertNotIn('docs/readme.md', files)
+
+    def test_version_4_with_skip_worktree(self):
+        self.add_submodule_and_conflict()
+        self.git('update-index', '--skip-worktree', 'src/deep/er/a.py')
+        files, _ = self.assert_index_matches_ls_files(4)
+        self.assertEqual(files[:2], ['conflict.txt', 'docs/guide/intro.md'])
+        self.assertNotIn('src/deep/er/a.py', files)
+
+    def test_sparse_directory_entries(self):
+        """A sparse index records docs/ as a single directory entry, which is left out"""
+        self.git('sparse-checkout', 'set', '--cone', '--sparse-index', 'src')
+        self.assertIn('docs/', self.git('ls-files', '--sparse').decode('utf-8').split('\n'))
+        for version in (3, 4):
+            with self.subTest(version=version):
+                files, _ = self.assert_index_matches_ls_files(version)
+                self.assertFalse([path for path in files if path.startswith('docs/')])
+
+
+class TestStripCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_path = os.path.join(self.directory, 'cache.sqlite3')
+        self.source = os.path.join(self.directory, 'module.py')
+        self.cache = self.open_cache()
+
+    def open_cache(self, **kwargs):
+        cache = StripCache(self.cache_path, 'signature', **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def write_source(self, text, mtime):
+        with open(self.source, 'w', encoding='utf-8') as f:
+            f.write(text)
+        # Old enough that the stat is trusted (see RACY_MTIME_SECONDS)
+        os.utime(self.source, (mtime, mtime))
+        return os.stat(self.source)
+
+    def test_unchanged_stat_hits(self):
+        stat = self.write_source('x = 1\n', 1_000_000)
+        self.cache.store(self.source, stat, hash_text('x = 1\n'), 'stripped')
+
+        self.assertEqual(self.cache.lookup(self.source, os.stat(self.source)), 'stripped')
+
+    def test_changed_mtime_or_size_misses(self):
+        """A changed stat invalidates the entry unless the content hash still matches"""
+        stat = self.write_source('x = 1\n', 1_000_000)
+        self.cache.store(self.source, stat, hash_text('x = 1\n'), 'stripped')
+
+        touched = self.write_source('x = 1\n', 1_000_100)
+        self.assertIsNone(self.cache.lookup(self.source, touched))
+        self.assertEqual(self.cache.lookup_by_hash(self.source, touched, hash_text('x = 1\n')), 'stripped')
+
+        resized = self.write_source('x = 10\n', 1_000_100)
+        self.assertIsNone(self.cache.lookup(self.source, resized))
+        self.assertIsNone(self.cache.lookup_by_hash(self.source, resized, hash_text('x = 10\n')))
+
+    def test_unused_entries_are_pruned_on_open(self):
+        stat = self.write_source('x = 1\n', 1_000_000)
+        self.cache.store(self.source, stat, hash_text('x = 1\n'), 'stripped')
+        self.cache.store_ignore_decisions(self.directory, 'context', 'fingerprint', {'build/': True})
+        self.cache.store_estimate('text-hash', 'estimator', 42)
+        self.cache.flush()
+
+        self.assertEqual(self.open_cache().lookup(self.source, stat), 'stripped')
+        self.assertEqual(self.open_cache().lookup_estimate('text-hash', 'estimator'), 42)
+        reopened = self.open_cache(max_age_seconds=-60)
+        self.assertIsNone(reopened.lookup(self.source, stat))
+        self.assertIsNone(reopened.lookup_ignore_decisions(self.directory, 'context', 'fingerprint'))
+        self.assertIsNone(reopened.lookup_estimate('text-hash', 'estimator'))
+
+
+class TestChunks(unittest.TestCase):
+
+    measure = staticmethod(budget_measure('bytes'))
+
+    def test_chunks_cover_the_text_within_the_size(self):
+        text = ''.join(f"def function_{i}(value):\n    total = value * {i}\n    return total\n" for i in range(30))
+        chunks = list(chunk_text(text, self.measure, 200))
+
+        self.assertEqual(''.join(chunk for _, _, chunk in chunks), text)
+        self.assertTrue(all(self.measure(chunk) <= 200 for _, _, chunk in chunks))
+        lines = text.splitlines(keepends=True)
+        for start_line, end_line, chunk in chunks:
+            self.assertEqual(''.join(lines[start_line - 1:end_line]), chunk)
+
+    def test_chunks_end_before_declarations(self):
+        """Once a chunk is half full, it is cut before the next declaration rather than inside a function"""
+        text = ''.join(f"def function_{i}(value):\n    total = value * {i}\n    return total\n" for i in range(30))
+        for _, _, chunk in list(chunk_text(text, self.measure, 200))[:-1]:
+            self.assertTrue(chunk.startswith('def '))
+            self.assertTrue(chunk.endswith('return total\n'))
+
+    def test_overlap_repeats_the_last_lines(self):
+        text = ''.join(f"line {i}\n" for i in range(20))
+        chunks = list(chunk_text(text, self.measure, 30, overlap_lines=1))
+
+        for (_, previous_end, _), (start, _, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(start, previous_end)
+
+    def test_long_lines_are_split(self):
+        chunks = list(chunk_text('x' * 250 + '\nshort\n', self.measure, 100))
+
+        self.assertEqual([(start, end) for start, end, _ in chunks], [(1, 1), (1, 1), (1, 1), (2, 2)])
+        self.assertEqual(''.join(chunk for _, _, chunk in chunks), 'x' * 250 + '\nshort\n')
+
+    def export(self, path, files, exported=None):
+        exporter = ChunkExporter(path, self.measure, 60, exported=exported)
+        for rel_path, text in files.items():
+            exporter.add_file(rel_path, text)
+        result = exporter.finish()
+        records = []
+        if result is not None:
+            with open(result, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+        return exporter, records
+
+    def test_incremental_export(self):
+        """A second export writes only new chunks and lists the ids of those that are gone"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'out.chunks.jsonl')
+        unchanged = ''.join(f"unchanged line {i}\n" for i in range(6))
+        files = {'same.txt': unchanged, 'edited.txt': 'first version\n', 'removed.txt': 'going away\n'}
+        first, records = self.export(path, files)
+        self.assertEqual(first.written, len(first.produced))
+        self.assertEqual({record['path'] for record in records}, set(files))
+
+        second, records = self.export(path, {'same.txt': unchanged, 'edited.txt': 'second version\n'},
+                                      first.produced)
+
+        written = [record for record in records if 'id' in record]
+        deleted = {record['path'] for record in records if 'deleted' in record}
+        self.assertEqual([record['text'] for record in written], ['second version\n'])
+        self.assertEqual(deleted, {'edited.txt', 'removed.txt'})
+        self.assertEqual(second.skipped, len([chunk_id for chunk_id, rel_path in first.produced.items()
+                                              if rel_path == 'same.txt']))
+
+        third, records = self.export(path, {'same.txt': unchanged, 'edited.txt': 'second version\n'},
+                                     second.produced)
+        self.assertEqual(records, [])
+        self.assertEqual((third.written, third.deleted), (0, 0))
+
+    def test_export_chunks_remembers_the_last_export_in_the_cache(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        cache_path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+        self.addCleanup(shutil.rmtree, os.path.dirname(cache_path))
+        for name, text in (('kept.py', 'def kept():\n    return 1\n'), ('edited.py', 'def edited():\n    return 1\n'),
+                           ('removed.py', 'def removed():\n    return 1\n')):
+            with open(os.path.join(root, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+
+        def export():
+            handler = FileHandler(root, ['py'], cache_path=cache_path, budget_unit='bytes', chunk_size=200)
+            handler.initialize_gitignore_manager(root)
+            try:
+                result = handler.consolidate_directory(root, ['py'], write_up_a_level=False)
+            finally:
+                handler.get_strip_cache().close()
+            if result is None:
+                return []
+            with open(result, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+            os.remove(result)
+            return records
+
+        self.assertEqual(sorted(record['path'] for record in export()), ['edited.py', 'kept.py', 'removed.py'])
+        with open(os.path.join(root, 'edited.py'), 'w', encoding='utf-8') as f:
+            f.write('def edited():\n    return 2\n')
+        os.remove(os.path.join(root, 'removed.py'))
+
+        records = export()
+        self.assertEqual([(record['path'], record['text']) for record in records if 'id' in record],
+                         [('edited.py', 'def edited():\n    return 2\n')])
+        self.assertEqual(sorted(record['path'] for record in records if 'deleted' in record),
+                         ['edited.py', 'removed.py'])
+        self.assertEqual(export(), [])
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def write(self, rel_path, text):
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_stat_cache_only_holds_yielded_files(self):
+        """Files rejected by the size filters leave no stat behind for the read stage"""
+        kept = self.write('src/kept.py', 'x = 1\n')
+        self.write('src/empty.py', '')
+        self.write('src/large.py', 'x' * 4096)
+        handler = FileHandler(self.root, ['py'])
+        handler.initialize_gitignore_manager(self.root)
+
+        found = list(handler.iter_hierarchy_files(self.root, ['py'], max_size_kb=1))
+
+        self.assertEqual(found, [kept])
+        self.assertEqual(set(handler.stat_cache), {kept})
+
+    def test_deeper_gitignore_wins(self):
+        """A .gitignore further down overrides the ones above it, in both directions"""
+        self.write('.gitignore', '*.log\n!special.py\n')
+        self.write('sub/.gitignore', '!keep.log\n*.py\n')
+        kept_log = self.write('sub/keep.log', 'kept\n')
+        self.write('sub/other.log', 'ignored\n')
+        self.write('sub/special.py', 'ignored = True\n')
+        special = self.write('special.py', 'kept = True\n')
+        handler = FileHandler(self.root, ['py', 'log'])
+        handler.initialize_gitignore_manager(self.root)
+
+        self.assertEqual(sorted(handler.iter_hierarchy_files(self.root, ['py', 'log'])), [special, kept_log])
+
+    def test_nothing_inside_an_ignored_directory_is_reincluded(self):
+        """Like git, a '!' pattern cannot bring back a file whose directory is ignored"""
+        self.write('.gitignore', 'out/\n!out/keep.py\n')
+        self.write('out/keep.py', 'x = 1\n')
+        kept = self.write('src/main.py', 'x = 2\n')
+        handler = FileHandler(self.root, ['py'])
+        handler.initialize_gitignore_manager(self.root)
+
+        self.assertEqual(list(handler.iter_hierarchy_files(self.root, ['py'])), [kept])
+
+    def test_additional_patterns_cannot_be_reincluded_by_gitignore(self):
+        """A '!' pattern in a .gitignore does not override the additional ignore patterns"""
+        self.write('.gitignore', '!*.py\n!generated/\n')
+        kept = self.write('src/kept.py', 'x = 1\n')
+        self.write('src/secret.py', 'x = 2\n')
+        self.write('generated/out.py', 'x = 3\n')
+        handler = FileHandler(self.root, ['py'], extra_ignores='secret.py\ngenerated/')
+        handler.initialize_gitignore_manager(self.root)
+
+        self.assertEqual(list(handler.iter_hierarchy_files(self.root, ['py'])), [kept])
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.texts = {f"src/module_{i}.py": f"def function_{i}():\n    return {i}\n" * (i + 1) for i in range(6)}
+
+    def write(self, **options):
+        writer = OutputWriter(os.path.join(self.directory, 'out.txt'),
+                              manifest_path=os.path.join(self.directory, 'manifest.json'), **options)
+        for rel_path, text in self.texts.items():
+            writer.write_section(rel_path, text)
+        self.assertEqual(writer.close(), writer.manifest_path)
+        with open(writer.manifest_path, encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+
+    def read_shard(self, manifest, index):
+        with open_output_shard(os.path.join(self.directory, manifest['shards'][index]['path']),
+                               manifest['compression']) as stream:
+            return stream.read()
+
+    def assert_offsets(self, manifest, newline='\n'):
+        """Seeking to each manifest offset finds the file's header just before it and its text at it"""
+        for rel_path, entry in manifest['files'].items():
+            with self.subTest(path=rel_path):
+                header = f"# File: {rel_path}\n\n".replace('\n', newline).encode('utf-8')
+                text = self.texts[rel_path].replace('\n', newline).encode('utf-8')
+                shard = manifest['shards'][entry['shard']]
+                with open_output_shard(os.path.join(self.directory, shard['path']), manifest['compression']) as stream:
+                    stream.seek(entry['offset'] - len(header))
+                    self.assertEqual(stream.read(len(header)), header)
+                    self.assertEqual(stream.read(entry['length']), text)
+
+    def test_shards_roll_over_without_splitting_sections(self):
+        manifest = self.write(shard_bytes=200)
+
+        self.assertGreater(len(manifest['shards']), 1)
+        self.assertEqual([shard['path'] for shard in manifest['shards']][:2], ['out.part001.txt', 'out.part002.txt'])
+        self.assertEqual(sum(shard['files'] for shard in manifest['shards']), len(self.texts))
+        for index, shard in enumerate(manifest['shards']):
+            content = self.read_shard(manifest, index)
+            self.assertTrue(content.startswith(OUTPUT_HEADER.encode('utf-8')))
+            self.assertEqual(len(content), shard['bytes'])
+            # Only a shard holding a single oversized section may pass the limit
+            self.assertTrue(shard['bytes'] <= 200 or shard['files'] == 1)
+        self.assert_offsets(manifest)
+
+    def test_offsets_in_gzip_shards(self):
+        manifest = self.write(shard_bytes=200, compression='gzip')
+
+        self.assertTrue(manifest['shards'][0]['path'].endswith('.txt.gz'))
+        self.assert_offsets(manifest)
+
+    def test_offsets_count_translated_line_ends(self):
+        """Line ends are written as a text-mode file would on Windows, and offsets follow the written bytes"""
+        manifest = self.write(newline='\r\n')
+
+        self.assertEqual(len(manifest['shards']), 1)
+        self.assertTrue(self.read_shard(manifest, 0).startswith(OUTPUT_HEADER.replace('\n', '\r\n').encode('utf-8')))
+        self.assert_offsets(manifest, newline='\r\n')
+
+
+class TestDeduplicator(unittest.TestCase):
+
+    def test_identical_copies_refer_to_a_file_written_in_full(self):
+        """A copy of a near-duplicate is not referred to it, since its section is only a diff"""
+        base = ''.join(f"def function_{i}(value):\n    return value * {i}\n" for i in range(40))
+        variant = base.replace('function_5(', 'renamed(')
+        texts = {'base.py': base}
+        deduplicator = Deduplicator(0.5, reload=texts.get)
+
+        self.assertIsNone(deduplicator.check('base.py', base, 'base.py'))
+        near = deduplicator.check('variant.py', variant, 'variant.py')
+        self.assertIn('diff against it', near[1])
+        copy = deduplicator.check('copy.py', variant, 'copy.py')
+
+        self.assertEqual(copy[1:], ('98% similar to base.py, diff against it', None))
+        self.assertEqual(deduplicator.check('base_copy.py', base), ('', 'identical to base.py', 'base.py'))
+
+
+if __name__ == '__main__':
+    unittest.main()
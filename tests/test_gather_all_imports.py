@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Unit tests for hmi-webpage-tools/shared/gather_all_imports.py
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'hmi-webpage-tools', 'shared'))
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from gather_all_imports import TypeScriptImportAnalyzer
+
+
+class TestScanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_path = os.path.join(self.directory, 'cache.json')
+        self.source = os.path.join(self.directory, 'widget.ts')
+        self.scanned = []
+
+    def write_source(self, text, mtime=1_000_000):
+        with open(self.source, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.source, (mtime, mtime))
+
+    def scan(self, content):
+        self.scanned.append(content)
+        return TypeScriptImportAnalyzer.scan_source_exports(content)
+
+    def run_scan(self):
+        """Scan the source with a fresh analyzer sharing the cache file, as a new run would"""
+        analyzer = TypeScriptImportAnalyzer(self.directory, self.cache_path)
+        results = analyzer.scan_file(self.source, 'source', self.scan)
+        analyzer.save_cache()
+        return results, analyzer
+
+    def test_unchanged_file_is_not_rescanned(self):
+        self.write_source("export class Widget {}\n")
+        self.assertEqual(self.run_scan()[0], ['Widget'])
+
+        results, analyzer = self.run_scan()
+
+        self.assertEqual(results, ['Widget'])
+        self.assertEqual(analyzer.rescanned_files, set())
+        self.assertEqual(len(self.scanned), 1)
+
+    def test_changed_size_or_mtime_rescans(self):
+        self.write_source("export class Widget {}\n")
+        self.run_scan()
+        self.write_source("export class Gadget {}\n", mtime=1_000_001)
+        self.assertEqual(self.run_scan()[0], ['Gadget'])
+        self.write_source("export class Gadget {}\nexport class Gizmo {}\n", mtime=1_000_001)
+
+        self.assertEqual(self.run_scan()[0], ['Gadget', 'Gizmo'])
+        self.assertEqual(len(self.scanned), 3)
+
+    def test_touched_file_with_same_hash_is_not_rescanned(self):
+        self.write_source("export class Widget {}\n")
+        self.run_scan()
+        os.utime(self.source, (2_000_000, 2_000_000))
+        results, analyzer = self.run_scan()
+
+        self.assertEqual(results, ['Widget'])
+        self.assertEqual(analyzer.rescanned_files, set())
+        self.assertEqual(len(self.scanned), 1)
+
+    def test_recently_modified_file_is_not_trusted(self):
+        """A same-size edit in the same mtime tick as the cached scan is still seen"""
+        self.write_source("export class Widget {}\n", mtime=None)
+        self.run_scan()
+        mtime_ns = os.stat(self.source).st_mtime_ns
+        self.write_source("export class Gadget {}\n", mtime=None)
+        os.utime(self.source, ns=(time.time_ns(), mtime_ns))
+
+        self.assertEqual(self.run_scan()[0], ['Gadget'])
+
+
+if __name__ == '__main__':
+    unittest.main()